@@ -1,6 +1,9 @@
 # coding=utf-8
 import json
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from typing import Literal
+
 import openai
 import tiktoken
 from pdfminer.high_level import extract_text
@@ -90,6 +93,86 @@ def _summarize_prompt(
     return prompt
 
 
+def _complete(messages: list[dict[str, str]], *args: any, **kwargs: any) -> str:
+    response_message = openai.ChatCompletion.create(*args, messages=messages, **kwargs)
+    first_choice, = response_message.choices
+    first_message = first_choice.message
+    output = first_message.content
+    return output
+
+
+def _reduce_groups(summaries: list[str], budget: int, model_name: str) -> list[list[str]]:
+    # consecutive summaries are packed into groups that fit the budget, at least two per group so every round shrinks
+    groups = list()
+    group = list()
+    len_group = 0
+    for each_summary in summaries:
+        len_summary = get_token_len([{"role": "user", "content": each_summary}], model_name)
+        if 2 <= len(group) and budget < len_group + len_summary:
+            groups.append(group)
+            group = list()
+            len_group = 0
+        group.append(each_summary)
+        len_group += len_summary
+
+    if len(group) == 1 and 0 < len(groups):
+        groups[-1].append(group[0])
+    elif 0 < len(group):
+        groups.append(group)
+    return groups
+
+
+def _summarize_map_reduce(
+        content: str,
+        *args: any,
+        additional_instruction: str | None,
+        max_input_ratio: float,
+        segment_length: int,
+        max_workers: int,
+        _margin: float,
+        _content_tag: str,
+        _context_tag: str,
+        **kwargs: any) -> str:
+
+    model_name = kwargs["model"]
+    max_tokens = get_max_tokens(model_name)
+
+    def summarize_part(part: str) -> str:
+        return summarize(
+            part,
+            *args,
+            additional_instruction=additional_instruction,
+            max_input_ratio=max_input_ratio,
+            segment_length=segment_length,
+            mode="map_reduce",
+            max_workers=max_workers,
+            _margin=_margin,
+            _content_tag=_content_tag,
+            _context_tag=_context_tag,
+            **kwargs
+        ).strip()
+
+    # token budget for the summaries in one reduce call, without the tags and the instruction around them
+    empty_prompt = _summarize_prompt("", None, additional_instruction, _content_tag, _context_tag)
+    len_overhead = get_token_len([{"role": "user", "content": empty_prompt}], model_name)
+    budget = max(1, int(max_tokens * max_input_ratio / (1. + _margin)) - len_overhead)
+
+    segments = list(segment_text(content, segment_length=segment_length))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        print(f"map: {len(segments)} segments")
+        summaries = list(executor.map(summarize_part, segments))
+
+        round_index = 0
+        while 1 < len(summaries):
+            round_index += 1
+            groups = _reduce_groups(summaries, budget, model_name)
+            print(f"reduce round {round_index}: {len(summaries)} summaries in {len(groups)} groups")
+            summaries = list(executor.map(summarize_part, ("\n\n".join(each_group) for each_group in groups)))
+
+    summary, = summaries
+    return summary
+
+
 def summarize(
         content: str,
         *args: any,
@@ -97,10 +180,15 @@ def summarize(
         additional_instruction: str | None = None,
         max_input_ratio: float = .7,
         segment_length: int = 2_000,
+        mode: Literal["sequential", "map_reduce"] = "sequential",
+        max_workers: int = 8,
         _margin: float = .1,
         _content_tag: str = "Content",
         _context_tag: str = "Context",
         **kwargs: any) -> str:
+    # "sequential" conditions every segment on a rolling summary, for order-sensitive text. "map_reduce" summarizes
+    # segments concurrently and merges them in a tree, so N segments take about log(N) rounds instead of 2N calls.
+    # `context` only applies to the sequential mode.
 
     model_name = kwargs["model"]
     max_tokens = get_max_tokens(model_name)
@@ -110,13 +198,23 @@ def summarize(
     len_tokenized_prompt = get_token_len(messages, model_name) * (1. + _margin)
 
     if max_input_ratio >= len_tokenized_prompt / max_tokens:
-        response_message = openai.ChatCompletion.create(*args, messages=messages, **kwargs)
-        first_choice, = response_message.choices
-        first_message = first_choice.message
-        output = first_message.content
-        return output
+        return _complete(messages, *args, **kwargs)
 
     print("segmenting...")
+    if mode == "map_reduce":
+        return _summarize_map_reduce(
+            content,
+            *args,
+            additional_instruction=additional_instruction,
+            max_input_ratio=max_input_ratio,
+            segment_length=segment_length,
+            max_workers=max_workers,
+            _margin=_margin,
+            _content_tag=_content_tag,
+            _context_tag=_context_tag,
+            **kwargs
+        )
+
     rolling_summary = None
     summaries = list()
     segments = list(segment_text(content, segment_length=segment_length))
@@ -177,6 +275,39 @@ def _response_prompt(
     return prompt
 
 
+def count_tokens(text: str | None, model_name: str) -> int:
+    if text is None:
+        return 0
+    encoding = tiktoken.encoding_for_model(model_name)
+    return len(encoding.encode(text))
+
+
+def plan_compaction(lengths: dict[str, int], ratios: dict[str, float], budget: int) -> dict[str, int]:
+    # target token length per part. parts that fit their share of the budget keep their length,
+    # what they do not use is shared among the others in proportion to their ratios.
+    targets = dict(lengths)
+    pending = {each_part: ratios[each_part] for each_part, each_length in lengths.items() if 0 < each_length}
+    remaining = budget
+    while 0 < len(pending):
+        sum_ratios = sum(pending.values())
+        fitting = [each_part for each_part, each_ratio in pending.items() if lengths[each_part] <= remaining * each_ratio / sum_ratios]
+        if len(fitting) < 1:
+            for each_part, each_ratio in pending.items():
+                targets[each_part] = max(1, int(remaining * each_ratio / sum_ratios))
+            break
+
+        for each_part in fitting:
+            remaining -= lengths[each_part]
+            del pending[each_part]
+
+    return targets
+
+
+def _length_instruction(target_tokens: int) -> str:
+    # about .75 words per token for english text
+    return f"Use at most {max(1, int(target_tokens * .75))} words."
+
+
 def respond(
         instruction: str, *args: any,
         data: str | None = None,
@@ -185,65 +316,81 @@ def respond(
         ratio_recap: float = .3,
         ratio_data: float = .3,
         ratio_response: float = .3,
+        max_workers: int = 3,
         _margin: float = .1,
         _recap_tag: str = "ConversationLog",
         _summary_tag: str = "ConversationSummary",
         _data_tag: str = "AdditionalData",
         **kwargs: any) -> Response:
-
-    ratio_recap = 0. if recap is None else ratio_recap
-    ratio_data = 0. if data is None else ratio_data
-
-    sum_ratios = ratio_instruction + ratio_recap + ratio_data + ratio_response
-    ratio_response_target = ratio_response / sum_ratios
+    # every part is measured in tokens once, parts over their planned size are compacted concurrently in a single round.
+    # `Response.summary` is the recap for the next call, it is folded into a summary as soon as it outgrows its share.
 
     model_name = kwargs["model"]
     max_tokens = get_max_tokens(model_name)
 
-    prompt = _response_prompt(instruction, recap, data, _recap_tag, _data_tag)
-    messages = [{"role": "user", "content": prompt}]
-    len_tokenized_prompt = get_token_len(messages, model_name) * (1. + _margin)
-
-    sum_input_ratios = ratio_instruction + ratio_recap + ratio_data
-    while ratio_response_target < len_tokenized_prompt / max_tokens:
-        ratio_instruction_is = len(instruction) / len_tokenized_prompt
-        ratio_instruction_delta = ratio_instruction_is - ratio_instruction / sum_input_ratios
-        ratio_recap_is = 0. if recap is None else len(recap) / len_tokenized_prompt
-        ratio_recap_delta = ratio_recap_is - ratio_recap / sum_input_ratios
-        ratio_data_is = 0. if data is None else len(data) / len_tokenized_prompt
-        ratio_data_delta = ratio_data_is - ratio_data / sum_input_ratios
-
-        max_delta = max(ratio_instruction_delta, ratio_recap_delta, ratio_data_delta)
-
-        if ratio_instruction_delta == max_delta:
-            instruction = summarize(instruction, *args, context=recap, **kwargs)
-
-        elif ratio_data_delta == max_delta:
-            focus_instruction = f"Transcribe this into a more concise format. Ignore information that is not relevant to the instruction \"{instruction.strip()}\""
-            data = summarize(data, *args, context=recap, additional_instructions=focus_instruction, **kwargs)
+    ratios = {
+        "instruction": ratio_instruction,
+        "recap": 0. if recap is None else ratio_recap,
+        "data": 0. if data is None else ratio_data,
+    }
+    sum_ratios = sum(ratios.values()) + ratio_response
+    empty_prompt = _response_prompt("", None, None, _recap_tag, _data_tag)
+    len_overhead = count_tokens(empty_prompt, model_name) + 2 * count_tokens(_make_element(" ", _data_tag), model_name)
+    input_budget = int(max_tokens * (1. - ratio_response / sum_ratios) / (1. + _margin)) - len_overhead
+
+    lengths = {
+        "instruction": count_tokens(instruction, model_name),
+        "recap": count_tokens(recap, model_name),
+        "data": count_tokens(data, model_name),
+    }
+    targets = plan_compaction(lengths, ratios, input_budget)
 
-        else:
-            focus_conversation = "Be very concise but preserve literal information and conversational character."
-            recap_text = summarize(recap, *args, additional_instruction=focus_conversation, **kwargs)
-            recap = _make_element(recap_text, _summary_tag)
+    def compact_instruction() -> str:
+        return summarize(instruction, *args, additional_instruction=_length_instruction(targets["instruction"]), **kwargs)
 
-        prompt = _response_prompt(instruction, recap, data, _recap_tag, _data_tag)
-        messages = [{"role": "user", "content": prompt}]
-        len_tokenized_prompt = get_token_len(messages, model_name) * (1. + _margin)
+    def compact_data() -> str:
+        focus_instruction = (
+            f"Transcribe this into a more concise format. Ignore information that is not relevant to the instruction "
+            f"\"{instruction.strip()}\". {_length_instruction(targets['data'])}"
+        )
+        return summarize(data, *args, additional_instruction=focus_instruction, mode="map_reduce", **kwargs)
+
+    def compact_recap() -> str:
+        focus_conversation = f"Be very concise but preserve literal information and conversational character. {_length_instruction(targets['recap'])}"
+        recap_text = summarize(recap, *args, additional_instruction=focus_conversation, **kwargs)
+        return _make_element(recap_text, _summary_tag)
+
+    compactions = {"instruction": compact_instruction, "recap": compact_recap, "data": compact_data}
+    over_budget = [each_part for each_part, each_length in lengths.items() if targets[each_part] < each_length]
+    if 0 < len(over_budget):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {each_part: executor.submit(compactions[each_part]) for each_part in over_budget}
+        compacted = {each_part: each_future.result() for each_part, each_future in futures.items()}
+        instruction = compacted.get("instruction", instruction)
+        recap = compacted.get("recap", recap)
+        data = compacted.get("data", data)
 
-    response_message = openai.ChatCompletion.create(*args, messages=messages, **kwargs)
-    first_choice, = response_message.choices
-    first_message = first_choice.message
-    output = first_message.content
+    prompt = _response_prompt(instruction, recap, data, _recap_tag, _data_tag)
+    messages = [{"role": "user", "content": prompt}]
+    output = _complete(messages, *args, **kwargs)
 
-    updated_recap_content = (
-            (f"" if recap is None else recap) +
+    exchange = (
             _make_element(
                 (f"" if data is None else _make_element(data.rstrip(), _data_tag)) +
                 _make_element(instruction.rstrip(), "Instruction"),
                 "UserRequest") +
             _make_element(output.rstrip(), "AssistantResponse")
     )
+
+    # only the earlier conversation is summarized, the latest exchange stays literal
+    recap_budget = int(input_budget * ratio_recap / (ratio_instruction + ratio_recap + ratio_data))
+    len_exchange = count_tokens(exchange, model_name)
+    len_recap = count_tokens(recap, model_name)
+    if recap is not None and recap_budget < len_recap + len_exchange:
+        targets["recap"] = max(1, recap_budget - len_exchange)
+        recap = compact_recap()
+
+    updated_recap_content = (f"" if recap is None else recap) + exchange
     return Response(output, updated_recap_content)
 
 
@@ -262,7 +409,7 @@ def run_summarize() -> None:
     text = extract_text("/home/mark/Downloads/2308.10379.pdf")
     # text = extract_text("/home/mark/Downloads/About – __countercloud.pdf")
 
-    summary = summarize(text, model="gpt-3.5-turbo")
+    summary = summarize(text, model="gpt-3.5-turbo", mode="map_reduce")
     print(summary)
 
 
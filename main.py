@@ -28,5 +28,10 @@ if __name__ == "__main__":
     print(request)
     print()
     perpetual = PerpetualAgent(request, vector_database)
+    # perpetual = PerpetualAgent.resume("<project name>", vector_database)
+    # perpetual = PerpetualAgent(request, vector_database, compact_facts="pq")
+    # perpetual = PerpetualAgent(request, vector_database, trace=True)
+    # one agent per database also consolidates the shared global facts
+    # perpetual = PerpetualAgent(request, vector_database, consolidate_every=15 * 60., consolidate_global_facts=True)
     response = perpetual.process()
     print(response)
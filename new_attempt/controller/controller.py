@@ -1,6 +1,7 @@
 from new_attempt.model.agent.callbacks import Callbacks as AgentCallbacks
 from new_attempt.model.storages.vector_storage.callbacks import Callbacks as VectorCallsView
 from new_attempt.model.storages.agent_storage.callbacks import Callbacks as AgentStorageCallsView
+from new_attempt.controller.update_bus import UpdateBus
 from new_attempt.model.model import Model
 from new_attempt.view.view import View
 from new_attempt.view.callbacks import ViewCallbacks as ViewCallsRest
@@ -9,6 +10,7 @@ from new_attempt.view.callbacks import ViewCallbacks as ViewCallsRest
 class Controller:
     def __init__(self) -> None:
         self.model = Model()
+        self.update_bus = UpdateBus()
 
         # process ui input
         view_callbacks = ViewCallsRest(
@@ -16,9 +18,13 @@ class Controller:
             self.model.agent_storage.get_agents,
             self.model.fact_storage.get_elements,
             self.model.action_storage.get_elements,
+            self.model.fact_storage.get_page,
+            self.model.action_storage.get_page,
             lambda agent: print(f"Pausing agent {agent.agent_id}"),
             lambda agent: print(f"Starting agent {agent.agent_id}"),
             lambda agent: print(f"Deleting agent {agent.agent_id}"),
+            self.model.set_actions_idempotent,
+            self.update_bus.flush,
         )
         self.view = View(view_callbacks)
 
@@ -55,6 +61,8 @@ class Controller:
             self.view.update_action_is_successful,
             self.view.update_summary,
             self.view.update_is_fulfilled,
-            self.view.fill_main
+            self.view.update_partial,
+            lambda agent_id: self.view.fill_main()
         )
-        self.model.agent_storage.connect_agent_callbacks(agent_calls_view)
+        self.update_bus.connect_callbacks(agent_calls_view, lambda agent_id: self.view.get_selected_agent_id() == agent_id)
+        self.model.agent_storage.connect_agent_callbacks(self.update_bus.agent_callbacks())
@@ -0,0 +1,75 @@
+# coding=utf-8
+from __future__ import annotations
+
+import threading
+from typing import Callable
+
+from new_attempt.model.agent.callbacks import Callbacks as AgentCallbacks
+
+
+class UpdateBus:
+    # agent threads publish here, the view drains the bus once per ui frame (see `View.run`)
+
+    _STRUCTURAL = {"new_action_attempts"}
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending = dict[str, list[tuple[str, tuple[any, ...]]]]()
+        self._is_viewed = None
+        self.callbacks = None
+
+    def connect_callbacks(self, callbacks: AgentCallbacks, is_viewed: Callable[[str], bool]) -> None:
+        self.callbacks = callbacks
+        self._is_viewed = is_viewed
+
+    def _publisher(self, kind: str) -> Callable[..., None]:
+        return lambda agent_id, *args: self.publish(agent_id, kind, *args)
+
+    def agent_callbacks(self) -> AgentCallbacks:
+        return AgentCallbacks(
+            self._publisher("new_thought"),
+            self._publisher("new_relevant_facts"),
+            self._publisher("new_action_attempts"),
+            self._publisher("new_action"),
+            self._publisher("new_action_arguments"),
+            self._publisher("new_action_output"),
+            self._publisher("new_fact"),
+            self._publisher("new_was_successful"),
+            self._publisher("new_summary"),
+            self._publisher("new_is_fulfilled"),
+            self._publisher("new_partial"),
+            self._publisher("update_view"),
+        )
+
+    def publish(self, agent_id: str, kind: str, *args: any) -> None:
+        # nobody looks at this agent, so there is nothing to draw
+        if self.callbacks is None or not self._is_viewed(agent_id):
+            return
+
+        with self._lock:
+            events = self._pending.setdefault(agent_id, list())
+
+            if kind == "update_view":
+                # a full redraw supersedes all incremental updates before it
+                events.clear()
+
+            elif 0 < len(events) and events[-1][0] == kind and kind not in UpdateBus._STRUCTURAL:
+                # only the latest value of a repeated update reaches the client
+                events.pop()
+
+            events.append((kind, args))
+
+    def flush(self) -> None:
+        with self._lock:
+            if len(self._pending) < 1:
+                return
+            pending = self._pending
+            self._pending = dict()
+
+        for agent_id, events in pending.items():
+            # selection might have changed since the events were published
+            if not self._is_viewed(agent_id):
+                continue
+
+            for kind, args in events:
+                getattr(self.callbacks, kind)(agent_id, *args)
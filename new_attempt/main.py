@@ -1,10 +1,28 @@
 # coding=utf-8
+import os
+
 from new_attempt.controller.controller import Controller
+from utils.tracing import TRACER, ChromeTraceExporter, JsonlExporter, OtlpExporter
+
+
+def attach_trace_exporters() -> None:
+    # spans of agent steps, llm calls, tools, embeddings and vector queries, see `utils.tracing`. off unless asked for:
+    #   TRACE_DIRECTORY=../resources/traces             trace.jsonl and trace.json (for chrome://tracing) in there
+    #   OTLP_ENDPOINT=http://localhost:4318/v1/traces   to an opentelemetry collector
+    trace_directory = os.environ.get("TRACE_DIRECTORY")
+    if trace_directory:
+        TRACER.add_exporter(JsonlExporter(os.path.join(trace_directory, "trace.jsonl")))
+        TRACER.add_exporter(ChromeTraceExporter(os.path.join(trace_directory, "trace.json")))
+
+    otlp_endpoint = os.environ.get("OTLP_ENDPOINT")
+    if otlp_endpoint:
+        TRACER.add_exporter(OtlpExporter(otlp_endpoint))
 
 
 def main():
     # https://chat.openai.com/share/4dcf41b8-436c-48d7-b909-fa3c7b6d82f4
 
+    attach_trace_exporters()
     controller = Controller()
 
 
@@ -4,11 +4,19 @@ import enum
 import random
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import asdict, dataclass
+from typing import Generator, Iterable
+
+import numpy
 
 from new_attempt.model.agent.callbacks import Callbacks
 from new_attempt.model.agent.step_elements import Thought, Fact, Action, ActionArguments, ActionOutput, ActionWasSuccessful, Summary, IsFulfilled, ActionAttempt, Step
+from new_attempt.model.storages.vector_storage.indexer import similarities
 from new_attempt.model.storages.vector_storage.storage import VectorStorage
+from new_attempt.model.storages.vector_storage.tiered_memory import TieredMemory
+from utils.action_values import ActionRanker
+from utils.tracing import TRACER
 
 
 @dataclass
@@ -30,6 +38,9 @@ class AgentArguments:
     llm_fact:               str
     llm_summary:            str
 
+    # more than one runs the best idempotent actions at the same time, see `Agent._attempt_actions_concurrently`
+    concurrent_attempts:    int = 1
+
 
 class Status(enum.StrEnum):
     FINISHED = "finished"
@@ -69,6 +80,10 @@ class Agent(threading.Thread):
 
         self.fact_storage = fact_storage
         self.action_storage = action_storage
+        # this agent's local facts and, if it reads them, the global ones
+        self.fact_memory = TieredMemory[Fact](fact_storage, is_visible=self._is_visible_fact)
+        # stored actions less similar to a thought than this are not worth trying, a new one is made instead
+        self.action_ranker = ActionRanker(min_similarity=.5)
 
         self.status = _status
         self.summary = _summary
@@ -82,6 +97,16 @@ class Agent(threading.Thread):
 
         self.iterations = 0
 
+    def _is_visible_fact(self, storage_id: str) -> bool:
+        if storage_id.startswith(f"local_{self.agent_id}:"):
+            return True
+        return self.arguments.read_facts_global and storage_id.startswith("global:")
+
+    def _is_visible_action(self, storage_id: str) -> bool:
+        if storage_id.startswith(f"local_{self.agent_id}:"):
+            return True
+        return self.arguments.read_actions_global and storage_id.startswith("global:")
+
     def __hash__(self) -> int:
         return hash(self.agent_id)
 
@@ -94,31 +119,73 @@ class Agent(threading.Thread):
             "history": [each_step.to_dict() for each_step in self.history],
         }
 
-    def _infer(self, user_input: str, summary: str) -> Thought:
-        time.sleep(2)
-
-        return Thought(f"thought {self.iterations}")
+    @staticmethod
+    def _placeholder_tokens(text: str, duration: float = 2.) -> Generator[str, None, None]:
+        # stands in for `LLMMethods.stream_respond` until the steps call the llm
+        words = text.split(" ")
+        for i, each_word in enumerate(words):
+            time.sleep(duration / len(words))
+            yield each_word if i < 1 else f" {each_word}"
+
+    def _stream(self, element_type: str, chunks: Iterable[str], is_shown: bool = True) -> str | None:
+        # forwards the content to the view while it is generated, stops reading once the agent is paused. None then,
+        # the incomplete content is not to be used.
+        # concurrent attempts are not shown before they are done, their partials would overwrite each other.
+        content = ""
+        try:
+            for each_chunk in chunks:
+                if self.status != Status.WORKING:
+                    return None
+                content += each_chunk
+                if is_shown:
+                    self.callbacks.new_partial(self.agent_id, element_type, content)
+
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+        return content
+
+    @TRACER.traced()
+    def _infer(self, user_input: str, summary: str) -> Thought | None:
+        content = self._stream("thought", Agent._placeholder_tokens(f"thought {self.iterations}"))
+        return None if content is None else Thought(content)
+
+    def _retrieve_action_from_repo(self, thought: str, exclude: list[Action] | None = None, no_candidates: int = 32) -> Action:
+        return self._retrieve_actions_from_repo(thought, exclude=exclude, k=1, no_candidates=no_candidates)[0]
+
+    @TRACER.traced()
+    def _retrieve_actions_from_repo(self, thought: str, exclude: list[Action] | None = None, k: int = 1, no_candidates: int = 32) -> list[Action]:
+        # the `k` most promising stored actions by similarity and past success, see `ActionRanker`.
+        # a new action if none is stored.
+        embedding, = self.action_storage.embed([thought])
+        candidates = [
+            (each_action, each_distance)
+            for each_action, each_distance, _ in self.action_storage.get_nearest(embedding, no_candidates)
+            if self._is_visible_action(each_action.storage_id)
+        ]
+        if 0 < len(candidates):
+            actions = {each_action.storage_id: each_action for each_action, _ in candidates}
+            action_similarities = similarities(numpy.array([each_distance for _, each_distance in candidates]), space=self.action_storage.space())
+            ranked = self.action_ranker.rank(
+                list(actions), action_similarities,
+                [each_action.success for each_action, _ in candidates], [each_action.failure for each_action, _ in candidates],
+                exclude=[each_action.storage_id for each_action in exclude or list()], k=k
+            )
+            if 0 < len(ranked):
+                return [actions[each_id] for each_id in ranked]
 
-    def _retrieve_action_from_repo(self, thought: str, exclude: list[Action] | None = None) -> Action:
         time.sleep(2)
 
-        action, = self.action_storage.store_contents([f"action for {thought}"], self.agent_id)
-        return action
+        local_agent_id = self.agent_id if self.arguments.write_actions_local else None
+        return self.action_storage.store_contents([f"action for {thought}"], local_agent_id)
 
+    @TRACER.traced()
     def _retrieve_facts_from_memory(self, thought: str) -> list[Fact]:
-        time.sleep(2)
-
-        all_global_facts = self.fact_storage.get_elements()
-        all_local_facts = self.fact_storage.get_elements(ids=None, local_agent_id=self.agent_id)
-        selected_global = random.sample(all_global_facts, k=min(3, len(all_global_facts)))
-        selected_local = random.sample(all_local_facts, k=min(2, len(all_local_facts)))
-        total = selected_local + selected_global
-        now = time.time()
-        for each_fact in total:
-            each_fact.retrieved = now
-        self.fact_storage.update_elements(total)
-        return total
+        # sets `retrieved`, mostly without leaving the process
+        return self.fact_memory.retrieve(thought, n=5)
 
+    @TRACER.traced()
     def _extract_arguments(self, thought: str, retrieved_facts: list[Fact], selected_action: Action) -> ActionArguments:
         time.sleep(2)
 
@@ -129,21 +196,27 @@ class Agent(threading.Thread):
         })
 
     def _execute_action(self, selected_action: Action, action_arguments: ActionArguments) -> ActionOutput:
-        time.sleep(2)
+        with TRACER.span("tool", action=selected_action.storage_id):
+            time.sleep(2)
 
         return ActionOutput(f"output for {selected_action.content}")
 
-    def _generate_fact(self, thought: str, output: str) -> tuple[Fact, ActionWasSuccessful]:
-        time.sleep(2)
-
-        fact_content = f"fact combining {thought} and {output}"
+    @TRACER.traced()
+    def _generate_fact(self, thought: str, output: str, is_shown: bool = True) -> tuple[Fact, ActionWasSuccessful] | None:
+        # None if the agent was paused while the fact was generated, nothing is stored then
+        fact_content = self._stream("fact", Agent._placeholder_tokens(f"fact combining {thought} and {output}"), is_shown=is_shown)
+        if fact_content is None:
+            return None
         fact, = self.fact_storage.store_contents([fact_content], self.agent_id)
+        self.fact_memory.promote([fact])
         return fact, ActionWasSuccessful(random.choice([True, False]))
 
-    def _update_summary(self, request: str, previous_summary: str, fact: Fact) -> tuple[Summary, IsFulfilled]:
-        time.sleep(2)
-
-        return Summary(f"summary including {fact.storage_id}"), IsFulfilled(random.random() < .1)
+    @TRACER.traced()
+    def _update_summary(self, request: str, previous_summary: str, fact: Fact) -> tuple[Summary, IsFulfilled] | None:
+        summary_content = self._stream("summary", Agent._placeholder_tokens(f"summary including {fact.storage_id}"))
+        if summary_content is None:
+            return None
+        return Summary(summary_content), IsFulfilled(random.random() < .1)
 
     def _increase_action_value(self, action: Action) -> None:
         action.success += 1
@@ -153,6 +226,49 @@ class Agent(threading.Thread):
         action.failure += 1
         self.action_storage.update_elements([action])
 
+    @TRACER.traced()
+    def _attempt_action(self, thought: str, retrieved_facts: list[Fact], action: Action, cancel: threading.Event) -> ActionAttempt | None:
+        # one of several concurrent attempts, None if it was cancelled before the action was executed or the agent was
+        # paused before it was judged. the outcome of a judged action counts for the action's value.
+        if cancel.is_set():
+            return None
+        action_arguments = self._extract_arguments(thought, retrieved_facts, action)
+        if cancel.is_set():
+            return None
+        output = self._execute_action(action, action_arguments)
+        generated = self._generate_fact(thought, output, is_shown=False)
+        if generated is None:
+            return None
+        fact, was_successful = generated
+        return ActionAttempt(action=action, action_arguments=action_arguments, output=output, fact=fact, was_successful=was_successful)
+
+    def _attempt_actions_concurrently(self, thought: str, retrieved_facts: list[Fact], actions: list[Action]) -> list[ActionAttempt]:
+        # the first success cancels the attempts that did not execute their action yet, the others are waited for.
+        # returns the finished attempts in the order they finished.
+        cancel = threading.Event()
+        attempts = list()
+        with ThreadPoolExecutor(max_workers=len(actions), thread_name_prefix=f"attempt_{self.agent_id}") as executor:
+            attempt_action = TRACER.propagate(self._attempt_action)
+            futures = [executor.submit(attempt_action, thought, retrieved_facts, each_action, cancel) for each_action in actions]
+            for each_future in as_completed(futures):
+                each_attempt = each_future.result()
+                if each_attempt is None:
+                    continue
+                attempts.append(each_attempt)
+                if each_attempt.was_successful.value:
+                    cancel.set()
+        return attempts
+
+    def _show_action_attempt(self, current_step: Step, action_attempt: ActionAttempt) -> None:
+        # a finished attempt, element by element like a running one
+        current_step.action_attempts.append(action_attempt)
+        self.callbacks.new_action_attempts(self.agent_id)
+        self.callbacks.new_action(self.agent_id, action_attempt.action)
+        self.callbacks.new_action_arguments(self.agent_id, action_attempt.action_arguments)
+        self.callbacks.new_action_output(self.agent_id, action_attempt.output)
+        self.callbacks.new_fact(self.agent_id, action_attempt.fact)
+        self.callbacks.new_was_successful(self.agent_id, action_attempt.was_successful)
+
     def run(self) -> None:
         if self.callbacks is None:
             raise ValueError("View callbacks not connected")
@@ -160,61 +276,104 @@ class Agent(threading.Thread):
         iteration = 0
 
         while self.status == "working":
-            current_step = Step()
-            self.history.append(current_step)
-
-            thought = self._infer(self.arguments.task, self.summary)
-            current_step.thought = thought
-            self.callbacks.new_thought(thought)
-
-            retrieved_facts = self._retrieve_facts_from_memory(thought)
-            current_step.relevant_facts = retrieved_facts
-            self.callbacks.new_relevant_facts(retrieved_facts)
-
-            failed_actions = list()
-            while True:
-                current_action_attempt = ActionAttempt()
-                current_step.action_attempts.append(current_action_attempt)
-                self.callbacks.new_action_attempts()
-
-                selected_action = self._retrieve_action_from_repo(thought, failed_actions)
-                current_action_attempt.action = selected_action
-                self.callbacks.new_action(selected_action)
-
-                action_arguments = self._extract_arguments(thought, retrieved_facts, selected_action)
-                current_action_attempt.action_arguments = action_arguments
-                self.callbacks.new_action_arguments(action_arguments)
-
-                output = self._execute_action(selected_action, action_arguments)
-                current_action_attempt.output = output
-                self.callbacks.new_action_output(output)
-
-                fact, was_successful = self._generate_fact(thought, output)
-                current_action_attempt.fact = fact
-                self.callbacks.new_fact(fact)
-                current_action_attempt.was_successful = was_successful
-                self.callbacks.new_was_successful(was_successful)
-
-                if was_successful:
-                    self._increase_action_value(selected_action)
+            with TRACER.span("step", agent=self.agent_id, step=iteration):
+                current_step = Step()
+                self.history.append(current_step)
+
+                # whenever the agent is paused while an element is streamed, the incomplete step is discarded
+                thought = self._infer(self.arguments.task, self.summary)
+                if thought is None:
+                    self.history.pop()
                     break
 
-                self._decrease_action_value(selected_action)
+                current_step.thought = thought
+                self.callbacks.new_thought(self.agent_id, thought)
+
+                retrieved_facts = self._retrieve_facts_from_memory(thought)
+                current_step.relevant_facts = retrieved_facts
+                self.callbacks.new_relevant_facts(self.agent_id, retrieved_facts)
+
+                failed_actions = list()
+                while True:
+                    no_attempts = min(self.arguments.concurrent_attempts, self.arguments.action_attempts - len(failed_actions))
+                    selected_actions = self._retrieve_actions_from_repo(thought, failed_actions, k=max(1, int(no_attempts)))
+                    # only if the best action is idempotent, the others would jump the queue
+                    concurrent_actions = [each_action for each_action in selected_actions if each_action.idempotent] if selected_actions[0].idempotent else list()
+                    if 1 < len(concurrent_actions):
+                        action_attempts = self._attempt_actions_concurrently(thought, retrieved_facts, concurrent_actions)
+                        was_successful = False
+                        for each_attempt in action_attempts:
+                            self._show_action_attempt(current_step, each_attempt)
+                            if each_attempt.was_successful.value:
+                                self._increase_action_value(each_attempt.action)
+                                if not was_successful:
+                                    fact = each_attempt.fact
+                                    was_successful = True
+                            else:
+                                self._decrease_action_value(each_attempt.action)
+                                failed_actions.append(each_attempt.action)
+                                if not was_successful:
+                                    fact = each_attempt.fact
+
+                        if was_successful or len(failed_actions) >= self.arguments.action_attempts or self.status != Status.WORKING:
+                            break
+                        continue
+
+                    current_action_attempt = ActionAttempt()
+                    current_step.action_attempts.append(current_action_attempt)
+                    self.callbacks.new_action_attempts(self.agent_id)
+
+                    selected_action = selected_actions[0]
+                    current_action_attempt.action = selected_action
+                    self.callbacks.new_action(self.agent_id, selected_action)
+
+                    action_arguments = self._extract_arguments(thought, retrieved_facts, selected_action)
+                    current_action_attempt.action_arguments = action_arguments
+                    self.callbacks.new_action_arguments(self.agent_id, action_arguments)
+
+                    output = self._execute_action(selected_action, action_arguments)
+                    current_action_attempt.output = output
+                    self.callbacks.new_action_output(self.agent_id, output)
+
+                    generated = self._generate_fact(thought, output)
+                    if generated is None:
+                        break
+                    fact, was_successful = generated
+                    current_action_attempt.fact = fact
+                    self.callbacks.new_fact(self.agent_id, fact)
+                    current_action_attempt.was_successful = was_successful
+                    self.callbacks.new_was_successful(self.agent_id, was_successful)
+
+                    if was_successful.value:
+                        self._increase_action_value(selected_action)
+                        break
+
+                    self._decrease_action_value(selected_action)
+
+                    failed_actions.append(selected_action)
+                    if len(failed_actions) >= self.arguments.action_attempts:
+                        break
+
+                if self.status != Status.WORKING:
+                    self.history.pop()
+                    break
 
-                failed_actions.append(selected_action)
-                if len(failed_actions) >= self.arguments.action_attempts:
+                updated = self._update_summary(self.arguments.task, self.summary, fact)
+                if updated is None:
+                    self.history.pop()
                     break
+                self.summary, is_fulfilled = updated
+                current_step.summary = self.summary
+                self.callbacks.new_summary(self.agent_id, self.summary)
 
-            self.summary, is_fulfilled = self._update_summary(self.arguments.task, self.summary, fact)
-            current_step.summary = self.summary
-            self.callbacks.new_summary(self.summary)
+                current_step.is_fulfilled = is_fulfilled
+                self.callbacks.new_is_fulfilled(self.agent_id, is_fulfilled)
 
-            current_step.is_fulfilled = is_fulfilled
-            self.callbacks.new_is_fulfilled(is_fulfilled)
+                self.save_state(self)
 
-            self.save_state(self)
+                if is_fulfilled.value:
+                    self.status = "finished"
 
-            if is_fulfilled:
-                self.status = "finished"
+                iteration += 1
 
-            iteration += 1
+        self.fact_memory.write_back()
@@ -0,0 +1,148 @@
+import random
+import threading
+from typing import Callable, Generator
+
+import chromadb
+import numpy
+import pytest
+
+from new_attempt.model.agent.agent import Agent, AgentArguments, Status
+from new_attempt.model.agent.callbacks import Callbacks
+from new_attempt.model.agent.step_elements import Action, ActionArguments, ActionOutput, ActionWasSuccessful, Fact
+from new_attempt.model.storages.vector_storage.callbacks import Callbacks as StorageCallbacks
+from new_attempt.model.storages.vector_storage.storage import VectorStorage
+
+
+def _embed(texts: list[str]) -> list[list[float]]:
+    return [numpy.random.default_rng(sum(each_text.encode())).normal(size=8).tolist() for each_text in texts]
+
+
+class InstantAgent(Agent):
+    # the placeholder steps without their waiting
+    def _extract_arguments(self, thought: str, retrieved_facts: list[Fact], selected_action: Action) -> ActionArguments:
+        return ActionArguments({"action_name": selected_action.content})
+
+    def _execute_action(self, selected_action: Action, action_arguments: ActionArguments) -> ActionOutput:
+        return ActionOutput(f"output for {selected_action.content}")
+
+
+class ConcurrentAgent(InstantAgent):
+    # attempts its idempotent actions, the ones in `succeeding` succeed. an action in `waits_for` waits for the event
+    # there before its arguments are extracted.
+    def __init__(self, *args: any, **kwargs: any) -> None:
+        super().__init__(*args, **kwargs)
+        self.actions = list[Action]()
+        self.succeeding = set[str]()
+        self.waits_for = dict[str, Callable[[], threading.Event]]()
+        self.executed = {"fast": threading.Event(), "slow": threading.Event()}
+        self.cancel = None
+
+    def _retrieve_actions_from_repo(self, thought: str, exclude: list[Action] | None = None, k: int = 1, no_candidates: int = 32) -> list[Action]:
+        excluded_ids = {each_action.storage_id for each_action in exclude or list()}
+        return [each_action for each_action in self.actions if each_action.storage_id not in excluded_ids][:k]
+
+    def _attempt_action(self, thought: str, retrieved_facts: list[Fact], action: Action, cancel: threading.Event) -> any:
+        self.cancel = cancel
+        return super()._attempt_action(thought, retrieved_facts, action, cancel)
+
+    def _extract_arguments(self, thought: str, retrieved_facts: list[Fact], selected_action: Action) -> ActionArguments:
+        if selected_action.content in self.waits_for:
+            assert self.waits_for[selected_action.content]().wait(5.)
+        return super()._extract_arguments(thought, retrieved_facts, selected_action)
+
+    def _execute_action(self, selected_action: Action, action_arguments: ActionArguments) -> ActionOutput:
+        self.executed[selected_action.content].set()
+        return super()._execute_action(selected_action, action_arguments)
+
+    def _generate_fact(self, thought: str, output: str, is_shown: bool = True) -> tuple[Fact, ActionWasSuccessful] | None:
+        fact, _ = super()._generate_fact(thought, output, is_shown=is_shown)
+        return fact, ActionWasSuccessful(output.removeprefix("output for ") in self.succeeding)
+
+
+def _storage(client: any, name: str, clazz: type) -> VectorStorage:
+    storage = VectorStorage(client.get_or_create_collection(name), clazz, embed=_embed)
+    storage.connect_callbacks(StorageCallbacks(lambda elements: None, lambda elements: None))
+    return storage
+
+
+def _agent(tmp_path: any, clazz: type = InstantAgent, **arguments: any) -> Agent:
+    client = chromadb.PersistentClient(path=str(tmp_path))
+    fact_storage = _storage(client, "facts", Fact)
+    action_storage = _storage(client, "actions", Action)
+    action_storage.store_contents(["stored action"])
+    action_storage.flush()
+
+    agent_arguments = AgentArguments(
+        "task", True, True, True, False, False, 3,
+        "gpt-4", "gpt-4", "gpt-4", "gpt-4", "gpt-4", "gpt-4",
+        **arguments
+    )
+    callbacks = Callbacks(*[lambda *args: None for _ in range(12)])
+    agent = clazz("agent_0", agent_arguments, fact_storage, action_storage, callbacks, _status=Status.WORKING)
+    agent.save_state = lambda agent: None
+    return agent
+
+
+@pytest.mark.parametrize("paused_in", ["thought", "fact", "summary"])
+def test_pausing_mid_stream_discards_the_step(tmp_path: any, monkeypatch: any, paused_in: str) -> None:
+    agent = _agent(tmp_path)
+
+    def tokens(text: str, duration: float = 0.) -> Generator[str, None, None]:
+        for i, each_word in enumerate(text.split(" ")):
+            if 0 < i and text.startswith(paused_in):
+                agent.status = Status.PAUSED
+            yield each_word if i < 1 else f" {each_word}"
+
+    monkeypatch.setattr(Agent, "_placeholder_tokens", staticmethod(tokens))
+    # every action succeeds
+    monkeypatch.setattr(random, "choice", lambda options: options[0])
+    agent.run()
+
+    assert agent.history == [] and agent.summary == ""
+    agent.fact_storage.flush()
+    # a fact is only stored once it is complete
+    assert len(agent.fact_storage) == (1 if paused_in == "summary" else 0)
+
+
+def _concurrent_agent(tmp_path: any, monkeypatch: any) -> ConcurrentAgent:
+    agent = _agent(tmp_path, ConcurrentAgent, concurrent_attempts=2)
+    monkeypatch.setattr(Agent, "_placeholder_tokens", staticmethod(lambda text, duration=0.: iter([text])))
+    # fulfilled after the first step
+    monkeypatch.setattr(random, "random", lambda: 0.)
+    agent.actions = agent.action_storage.store_contents(["fast", "slow"])
+    for each_action in agent.actions:
+        each_action.idempotent = True
+    agent.action_storage.update_elements(agent.actions)
+    return agent
+
+
+def _counts(agent: Agent) -> dict[str, tuple[int, int]]:
+    agent.action_storage.flush()
+    actions = agent.action_storage.get_elements([each_action.storage_id for each_action in agent.actions])
+    return {each_action.content: (each_action.success, each_action.failure) for each_action in actions}
+
+
+def test_the_first_success_cancels_the_other_attempts(tmp_path: any, monkeypatch: any) -> None:
+    agent = _concurrent_agent(tmp_path, monkeypatch)
+    agent.succeeding = {"fast"}
+    # slow only gets going once it is cancelled
+    agent.waits_for = {"slow": lambda: agent.cancel}
+    agent.run()
+
+    assert agent.status == Status.FINISHED
+    step, = agent.history
+    assert [each_attempt.action.content for each_attempt in step.action_attempts] == ["fast"]
+    assert not agent.executed["slow"].is_set()
+    assert _counts(agent) == {"fast": (1, 0), "slow": (0, 0)}
+
+
+def test_every_concurrent_attempt_counts(tmp_path: any, monkeypatch: any) -> None:
+    agent = _concurrent_agent(tmp_path, monkeypatch)
+    agent.succeeding = {"slow"}
+    # slow only succeeds after fast failed
+    agent.waits_for = {"slow": lambda: agent.executed["fast"]}
+    agent.run()
+
+    step, = agent.history
+    assert sorted(each_attempt.action.content for each_attempt in step.action_attempts) == ["fast", "slow"]
+    assert _counts(agent) == {"fast": (0, 1), "slow": (1, 0)}
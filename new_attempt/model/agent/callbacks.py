@@ -7,19 +7,20 @@ from new_attempt.model.agent.step_elements import Thought, Fact, Action, ActionA
 
 class Callbacks:
     def __init__(self,
-                 new_thought: Callable[[Thought], None],
-                 new_relevant_facts: Callable[[list[Fact]], None],
+                 new_thought: Callable[[str, Thought], None],
+                 new_relevant_facts: Callable[[str, list[Fact]], None],
 
-                 new_action_attempts: Callable[[], None],
-                 new_action: Callable[[Action], None],
-                 new_action_arguments: Callable[[ActionArguments], None],
-                 new_action_output: Callable[[ActionOutput], None],
-                 new_fact: Callable[[Fact], None],
-                 new_was_successful: Callable[[ActionWasSuccessful], None],
-                 new_summary: Callable[[Summary], None],
-                 new_is_fulfilled: Callable[[IsFulfilled], None],
+                 new_action_attempts: Callable[[str], None],
+                 new_action: Callable[[str, Action], None],
+                 new_action_arguments: Callable[[str, ActionArguments], None],
+                 new_action_output: Callable[[str, ActionOutput], None],
+                 new_fact: Callable[[str, Fact], None],
+                 new_was_successful: Callable[[str, ActionWasSuccessful], None],
+                 new_summary: Callable[[str, Summary], None],
+                 new_is_fulfilled: Callable[[str, IsFulfilled], None],
+                 new_partial: Callable[[str, str, str], None],
 
-                 update_view: Callable[[], None]) -> None:
+                 update_view: Callable[[str], None]) -> None:
 
         self._new_thought = new_thought
         self._new_relevant_facts = new_relevant_facts
@@ -31,38 +32,43 @@ class Callbacks:
         self._new_was_successful = new_was_successful
         self._new_summary = new_summary
         self._new_is_fulfilled = new_is_fulfilled
+        self._new_partial = new_partial
         self._update_view = update_view
 
-    def new_thought(self, thought: Thought) -> None:
-        self._new_thought(thought)
+    def new_thought(self, agent_id: str, thought: Thought) -> None:
+        self._new_thought(agent_id, thought)
 
-    def new_relevant_facts(self, relevant_facts: list[Fact]) -> None:
-        self._new_relevant_facts(relevant_facts)
+    def new_relevant_facts(self, agent_id: str, relevant_facts: list[Fact]) -> None:
+        self._new_relevant_facts(agent_id, relevant_facts)
 
-    def new_action_attempts(self) -> None:
-        self._new_action_attempts()
+    def new_action_attempts(self, agent_id: str) -> None:
+        self._new_action_attempts(agent_id)
 
-    def new_action(self, action: Action) -> None:
-        self._new_action(action)
+    def new_action(self, agent_id: str, action: Action) -> None:
+        self._new_action(agent_id, action)
 
-    def new_action_arguments(self, action_arguments: ActionArguments) -> None:
-        self._new_action_arguments(action_arguments)
+    def new_action_arguments(self, agent_id: str, action_arguments: ActionArguments) -> None:
+        self._new_action_arguments(agent_id, action_arguments)
 
-    def new_action_output(self, action_output: ActionOutput) -> None:
-        self._new_action_output(action_output)
+    def new_action_output(self, agent_id: str, action_output: ActionOutput) -> None:
+        self._new_action_output(agent_id, action_output)
 
-    def new_fact(self, fact: Fact) -> None:
-        self._new_fact(fact)
+    def new_fact(self, agent_id: str, fact: Fact) -> None:
+        self._new_fact(agent_id, fact)
 
-    def new_was_successful(self, was_successful: ActionWasSuccessful) -> None:
-        self._new_was_successful(was_successful)
+    def new_was_successful(self, agent_id: str, was_successful: ActionWasSuccessful) -> None:
+        self._new_was_successful(agent_id, was_successful)
 
-    def new_summary(self, summary: Summary) -> None:
-        self._new_summary(summary)
+    def new_summary(self, agent_id: str, summary: Summary) -> None:
+        self._new_summary(agent_id, summary)
 
-    def new_is_fulfilled(self, is_fulfilled: IsFulfilled) -> None:
-        self._new_is_fulfilled(is_fulfilled)
+    def new_is_fulfilled(self, agent_id: str, is_fulfilled: IsFulfilled) -> None:
+        self._new_is_fulfilled(agent_id, is_fulfilled)
 
-    def update_view(self) -> None:
-        self._update_view()
+    def new_partial(self, agent_id: str, element_type: str, partial_content: str) -> None:
+        # the element of `element_type` generated so far, e.g. `"thought"`, while its tokens are streamed
+        self._new_partial(agent_id, element_type, partial_content)
+
+    def update_view(self, agent_id: str) -> None:
+        self._update_view(agent_id)
 
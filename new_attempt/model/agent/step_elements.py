@@ -34,16 +34,18 @@ class Fact(ContentElement, Dictable):
         fact.storage_id = element_dict["storage_id"]
         return fact
 
-    def __init__(self, content: str, created: float = time.time(), retrieved: float | None = None) -> None:
+    def __init__(self, content: str, created: float | None = None, retrieved: float | None = None, timestamp: float | None = None) -> None:
+        # `timestamp` is how the creation time is stored, elements are made from their stored metadata
+        created = created or timestamp or time.time()
         super().__init__(content, timestamp=created, retrieved=retrieved or created)
 
     @property
     def created(self) -> float:
-        return self.kwargs["created"]
+        return self.kwargs["timestamp"]
 
     @created.setter
     def created(self, created: float) -> None:
-        self.kwargs["created"] = created
+        self.kwargs["timestamp"] = created
 
     @property
     def retrieved(self) -> float:
@@ -61,12 +63,14 @@ class Action(ContentElement, Dictable):
         kwargs = element_dict["kwargs"]
         success = kwargs["success"]
         failure = kwargs["failure"]
-        action = Action(content, success=success, failure=failure)
+        idempotent = kwargs.get("idempotent", False)
+        action = Action(content, success=success, failure=failure, idempotent=idempotent)
         action.storage_id = element_dict["storage_id"]
         return action
 
-    def __init__(self, content: str, success: int = 0, failure: int = 0) -> None:
-        super().__init__(content, success=success, failure=failure)
+    def __init__(self, content: str, success: int = 0, failure: int = 0, idempotent: bool = False) -> None:
+        # idempotent actions only read or can be repeated without harm, they may be attempted concurrently
+        super().__init__(content, success=success, failure=failure, idempotent=idempotent)
 
     @property
     def success(self) -> int:
@@ -84,6 +88,14 @@ class Action(ContentElement, Dictable):
     def failure(self, failure: int) -> None:
         self.kwargs["failure"] = failure
 
+    @property
+    def idempotent(self) -> bool:
+        return self.kwargs.get("idempotent", False)
+
+    @idempotent.setter
+    def idempotent(self, idempotent: bool) -> None:
+        self.kwargs["idempotent"] = idempotent
+
 
 class ActionArguments(dict[str, any], Dictable):
     @staticmethod
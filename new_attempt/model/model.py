@@ -6,6 +6,10 @@ import redislite
 from new_attempt.model.agent.step_elements import Fact, Action
 from new_attempt.model.storages.agent_storage.agent_storage import AgentStorage
 from new_attempt.model.storages.vector_storage.storage import VectorStorage
+from utils.ann_index import AnnIndex
+from utils.basic_llm_calls import RATE_LIMITER
+from utils.embedding_backends import get_embedding_backend
+from utils.fact_consolidation import FactArchive, FactConsolidator, PeriodicJob
 
 
 class Model:
@@ -18,19 +22,39 @@ class Model:
         fact_database = chroma_client.get_or_create_collection("facts")
         action_database = chroma_client.get_or_create_collection("actions")
 
-        self.fact_storage = VectorStorage[Fact](fact_database, Fact)
-        self.action_storage = VectorStorage[Action](action_database, Action)
+        # same model as chroma's default, resident and batched
+        embed = get_embedding_backend("onnx")
+        fact_index = AnnIndex(directory="../resources/databases/facts_index")
+        action_index = AnnIndex(directory="../resources/databases/actions_index")
+        # facts that consolidation archives stay retrievable as the cold tier of the agents' memories
+        fact_archive = FactArchive("../resources/databases/facts_archive.jsonl.gz")
+        self.fact_storage = VectorStorage[Fact](fact_database, Fact, embed=embed, index=fact_index, archive=fact_archive)
+        self.action_storage = VectorStorage[Action](action_database, Action, embed=embed, index=action_index)
+
+        # near duplicate facts are merged and cold ones archived in the background, at most 100,000 stay searchable
+        fact_consolidator = FactConsolidator(fact_archive, retrieved_key="retrieved", created_key="timestamp", max_facts=100_000)
+        self.fact_consolidation = PeriodicJob(lambda: self.fact_storage.consolidate(fact_consolidator), 15 * 60., name="fact consolidation")
 
         redis_dbs = {
             "agents":    0,
             "facts":     1,
             "actions":   2,
+            "rate_limits": 3,
         }
         redis_db_path = "../resources/databases/redis.db"
         redis_config = {"decode_responses": True, "serverconfig": {"appendonly": "yes"}}
         agent_database = redislite.StrictRedis(redis_db_path, db=0, **redis_config)
+        # api rate limits are shared with every process on the same database
+        RATE_LIMITER.use_redis(redislite.StrictRedis(redis_db_path, db=redis_dbs["rate_limits"], **redis_config))
         self.agent_storage = AgentStorage(
             agent_database,
             self.fact_storage,
             self.action_storage
         )
+
+    def set_actions_idempotent(self, action_ids: list[str], idempotent: bool) -> None:
+        # idempotent actions may be attempted concurrently by agents with more than one concurrent attempt
+        actions = self.action_storage.get_elements(action_ids)
+        for each_action in actions:
+            each_action.idempotent = idempotent
+        self.action_storage.update_elements(actions)
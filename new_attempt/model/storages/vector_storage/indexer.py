@@ -0,0 +1,216 @@
+import queue
+import threading
+import time
+from typing import Callable
+
+import numpy
+from chromadb.api.models.Collection import Collection
+
+from utils.ann_index import AnnIndex
+from utils.misc import LOGGER
+
+
+class IndexingError(Exception):
+    pass
+
+
+class _PendingElement:
+    __slots__ = "document", "metadata", "embedding", "revision"
+
+    def __init__(self, document: str, metadata: dict[str, any], revision: int = 0) -> None:
+        self.document = document
+        self.metadata = metadata
+        self.embedding = None
+        self.revision = revision
+
+
+def distances(embeddings: numpy.ndarray, embedding: numpy.ndarray, space: str = "l2") -> numpy.ndarray:
+    # same measures as chroma's hnsw spaces, so distances from both sides can be compared
+    if space == "cosine":
+        norms = numpy.linalg.norm(embeddings, axis=1) * numpy.linalg.norm(embedding)
+        return 1. - (embeddings @ embedding) / numpy.where(norms == 0., 1., norms)
+    if space == "ip":
+        return 1. - embeddings @ embedding
+    return ((embeddings - embedding) ** 2).sum(axis=1)
+
+
+def similarities(distances: numpy.ndarray, space: str = "l2") -> numpy.ndarray:
+    # the cosine similarities the distances of unit vectors correspond to
+    if space == "l2":
+        return 1. - distances / 2.
+    return 1. - distances
+
+
+class Indexer:
+    # elements are readable from the overlay as soon as they are submitted. a background thread embeds whatever
+    # queued up in one batch, upserts it into the collection and only then drops it from the overlay.
+    # a batch that fails to be written is queued again after `retry_delay` seconds, twice as long after every
+    # further failure up to `max_retry_delay`, until it is written.
+
+    def __init__(self,
+                 collection: Collection, embed: Callable[[list[str]], list[list[float]]],
+                 index: AnnIndex | None = None, max_batch: int = 64,
+                 retry_delay: float = 1., max_retry_delay: float = 60.) -> None:
+        self.collection = collection
+        self.embed = embed
+        self.index = index
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._lock = threading.Lock()
+        self._pending = dict[str, _PendingElement]()
+        self._failed_writes = 0
+        self._consecutive_failures = 0
+        self.last_error = None
+
+        self._queue = queue.Queue[str]()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, ids: list[str], documents: list[str], metadatas: list[dict[str, any]]) -> None:
+        with self._lock:
+            for each_id, each_document, each_metadata in zip(ids, documents, metadatas):
+                self._pending[each_id] = _PendingElement(each_document, dict(each_metadata))
+
+        for each_id in ids:
+            self._queue.put(each_id)
+
+    def update(self, storage_id: str, document: str, metadata: dict[str, any]) -> bool:
+        # false if the element is not pending (anymore), it has to be updated in the collection then
+        with self._lock:
+            old_element = self._pending.get(storage_id)
+            if old_element is None:
+                return False
+
+            new_element = _PendingElement(document, dict(metadata), revision=old_element.revision + 1)
+            if document == old_element.document:
+                new_element.embedding = old_element.embedding
+            self._pending[storage_id] = new_element
+            return True
+
+    def remove(self, ids: list[str]) -> None:
+        with self._lock:
+            for each_id in ids:
+                self._pending.pop(each_id, None)
+
+    def pending(self, ids: list[str] | None = None) -> dict[str, tuple[str, dict[str, any]]]:
+        with self._lock:
+            selected_ids = self._pending.keys() if ids is None else [each_id for each_id in ids if each_id in self._pending]
+            return {
+                each_id: (self._pending[each_id].document, dict(self._pending[each_id].metadata))
+                for each_id in selected_ids
+            }
+
+    def _embed_pending(self) -> dict[str, _PendingElement]:
+        with self._lock:
+            snapshot = dict(self._pending)
+
+        missing = [each_id for each_id, each_element in snapshot.items() if each_element.embedding is None]
+        if 0 < len(missing):
+            # outside of the lock, embedding takes long
+            embeddings = self.embed([snapshot[each_id].document for each_id in missing])
+            for each_id, each_embedding in zip(missing, embeddings):
+                # if the element was updated in the meantime, the new revision is embedded on its next read or write
+                snapshot[each_id].embedding = each_embedding
+
+        return snapshot
+
+    def nearest(self, embedding: list[float], n: int, space: str = "l2") -> list[tuple[float, str, str, dict[str, any], list[float]]]:
+        # (distance, id, document, metadata, embedding) of the n pending elements closest to `embedding`
+        snapshot = self._embed_pending()
+        if len(snapshot) < 1:
+            return list()
+
+        ids = list(snapshot)
+        matrix = numpy.array([snapshot[each_id].embedding for each_id in ids], dtype=numpy.float32)
+        pending_distances = distances(matrix, numpy.array(embedding, dtype=numpy.float32), space=space)
+        best = numpy.argsort(pending_distances)[:n]
+        return [
+            (float(pending_distances[i]), ids[i], snapshot[ids[i]].document, dict(snapshot[ids[i]].metadata), matrix[i].tolist())
+            for i in best
+        ]
+
+    def _take_batch(self) -> list[str]:
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list[str]) -> None:
+        with self._lock:
+            elements = {each_id: self._pending[each_id] for each_id in dict.fromkeys(batch) if each_id in self._pending}
+            revisions = {each_id: each_element.revision for each_id, each_element in elements.items()}
+        if len(elements) < 1:
+            return
+
+        missing = [each_id for each_id, each_element in elements.items() if each_element.embedding is None]
+        if 0 < len(missing):
+            embeddings = dict(zip(missing, self.embed([elements[each_id].document for each_id in missing])))
+        else:
+            embeddings = dict()
+
+        ids = list(elements)
+        vectors = [embeddings.get(each_id, elements[each_id].embedding) for each_id in ids]
+        self.collection.upsert(
+            ids=ids,
+            embeddings=vectors,
+            metadatas=[elements[each_id].metadata for each_id in ids],
+            documents=[elements[each_id].document for each_id in ids]
+        )
+        if self.index is not None:
+            self.index.add(ids, vectors)
+
+        with self._lock:
+            for each_id in ids:
+                each_element = self._pending.get(each_id)
+                if each_element is None:
+                    continue
+                if each_element.revision == revisions[each_id]:
+                    del self._pending[each_id]
+                else:
+                    # updated while it was written, upsert the new revision as well
+                    self._queue.put(each_id)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            try:
+                self._write(batch)
+                self._consecutive_failures = 0
+
+            except Exception as e:
+                # failed elements stay readable from the overlay until they are written
+                self._consecutive_failures += 1
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** (self._consecutive_failures - 1))
+                LOGGER.error(f"Indexing {len(batch)} elements failed, retrying in {delay:.0f} seconds: {e}")
+                with self._queue.all_tasks_done:
+                    self._failed_writes += 1
+                    self.last_error = e
+                    # waiting flushes learn about it
+                    self._queue.all_tasks_done.notify_all()
+                time.sleep(delay)
+                # queued again before the failed batch is done, flushes keep waiting for it
+                for each_id in batch:
+                    self._queue.put(each_id)
+
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self) -> None:
+        # blocks until every submitted element is in the collection. raises if a write fails meanwhile, the failed
+        # elements are retried in the background.
+        condition = self._queue.all_tasks_done
+        with condition:
+            failed_writes = self._failed_writes
+            condition.wait_for(lambda: self._queue.unfinished_tasks < 1 or failed_writes < self._failed_writes)
+            if failed_writes < self._failed_writes:
+                raise IndexingError(f"{self._queue.unfinished_tasks} elements are not written yet, retrying.") from self.last_error
@@ -0,0 +1,40 @@
+import time
+
+import pytest
+
+from new_attempt.model.storages.vector_storage.indexer import Indexer, IndexingError
+
+
+class FailingCollection:
+    # fails its first `no_failures` upserts
+    def __init__(self, no_failures: int) -> None:
+        self.no_failures = no_failures
+        self.rows = dict()
+
+    def upsert(self, ids: list[str], embeddings: list[list[float]], metadatas: list[dict[str, any]], documents: list[str]) -> None:
+        if 0 < self.no_failures:
+            self.no_failures -= 1
+            raise ConnectionError("database unavailable")
+        self.rows.update(zip(ids, documents))
+
+
+def _embed(texts: list[str]) -> list[list[float]]:
+    return [[float(len(each_text)), 1.] for each_text in texts]
+
+
+def test_failed_writes_are_retried_and_reported() -> None:
+    collection = FailingCollection(no_failures=2)
+    indexer = Indexer(collection, _embed, retry_delay=.01)
+    indexer.submit(["a", "b"], ["fact a", "fact b"], [dict(), dict()])
+
+    with pytest.raises(IndexingError) as error:
+        indexer.flush()
+    assert isinstance(error.value.__cause__, ConnectionError)
+    # still readable while it is retried
+    assert set(indexer.pending()) == {"a", "b"}
+
+    deadline = time.monotonic() + 5.
+    while len(indexer) > 0 and time.monotonic() < deadline:
+        time.sleep(.01)
+    indexer.flush()
+    assert collection.rows == {"a": "fact a", "b": "fact b"} and len(indexer) == 0
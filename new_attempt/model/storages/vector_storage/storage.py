@@ -1,51 +1,142 @@
-from functools import lru_cache
-from typing import Generic, Type
+import threading
+import weakref
+from typing import Callable, Generic, Type
 
 from chromadb.api.models.Collection import Collection
 from chromadb.utils import embedding_functions
 
 from new_attempt.model.storages.vector_storage.callbacks import Callbacks
 from new_attempt.model.storages.vector_storage.element import CONTENT_ELEMENT
+from new_attempt.model.storages.vector_storage.indexer import Indexer, IndexingError
+from utils.ann_index import AnnIndex
+from utils.fact_consolidation import Consolidation, FactArchive, FactConsolidator
+from utils.tracing import TRACER
 
 
 class VectorStorage(Generic[CONTENT_ELEMENT]):
+    # stored with the metadata of local elements, so the database selects the elements of one agent
+    _AGENT_KEY = "local_agent_id"
+
     @staticmethod
     def _compose_id(element_id: str, local_agent_id: str | None = None) -> str:
         return f"global:{element_id}" if local_agent_id is None else f"local_{local_agent_id}:{element_id}"
 
     @staticmethod
-    @lru_cache(maxsize=128)
-    def _embed(documents: list[str]) -> list[tuple[float, ...]]:
-        # check: https://huggingface.co/spaces/mteb/leaderboard
-        embedding_function = embedding_functions.DefaultEmbeddingFunction()
-
-        vectors = embedding_function(documents)
-        return [
-            tuple(float(x) if not isinstance(x, float) else x for x in each_vector)
-            for each_vector in vectors
-        ]
+    def _local_agent_id(storage_id: str) -> str | None:
+        prefix, _, _ = storage_id.rpartition(":")
+        return prefix.removeprefix("local_") if prefix.startswith("local_") else None
 
-    def __init__(self, collection: Collection, clazz: Type[CONTENT_ELEMENT]) -> None:
+    @staticmethod
+    def _stored_metadata(storage_id: str, kwargs: dict[str, any]) -> dict[str, any]:
+        local_agent_id = VectorStorage._local_agent_id(storage_id)
+        if local_agent_id is None:
+            return dict(kwargs)
+        return kwargs | {VectorStorage._AGENT_KEY: local_agent_id}
+
+    def __init__(self,
+                 collection: Collection, clazz: Type[CONTENT_ELEMENT],
+                 embed: Callable[[list[str]], list[list[float]]] | None = None,
+                 index: AnnIndex | None = None,
+                 archive: FactArchive | None = None) -> None:
+        # check: https://huggingface.co/spaces/mteb/leaderboard
+        # `embed` defaults to chroma's model, created once and kept for all calls.
+        # with an `index`, similarity queries go to it instead of to chroma.
+        # `archive` is where consolidation moves elements to, caches read it as their cold tier.
         self.collection = collection
         self.clazz = clazz
+        self.embed = embed or embedding_functions.DefaultEmbeddingFunction()
+        self.archive = archive
         self.callbacks = None
+        self._caches = weakref.WeakSet()
+        self._id_lock = threading.Lock()
+        # sorted ids of recent page queries, until elements are added, removed, or change their content
+        self._page_lock = threading.Lock()
+        self._page_ids = dict[tuple[str | None, str | None, bool, str | None], list[str]]()
+        self._page_generation = 0
+
+        # the collection's metadata is not persisted, ids continue after the highest stored one
+        if collection.metadata is None:
+            collection.metadata = dict()
+        stored_ids = collection.get(include=[])["ids"]
+        next_storage_id = max((VectorStorage._id_sort_key(each_id)[1] for each_id in stored_ids), default=-1) + 1
+        collection.metadata["next_storage_id"] = max(self._get_storage_id(), next_storage_id)
+        self._tag_local_elements([each_id for each_id in stored_ids if VectorStorage._local_agent_id(each_id) is not None])
+
+        self.index = index
+        if index is not None:
+            index.sync(stored_ids, self._get_embeddings)
+            index.save()
+        self.indexer = Indexer(collection, self.embed, index=index)
 
     def __len__(self) -> int:
-        return self.collection.count()
+        return self.collection.count() + len(self.indexer)
+
+    def space(self) -> str:
+        if self.index is not None:
+            return self.index.space
+        return (self.collection.metadata or dict()).get("hnsw:space", "l2")
+
+    def _tag_local_elements(self, ids: list[str], page_size: int = 4_096) -> None:
+        # local elements stored before their metadata named their agent
+        for offset in range(0, len(ids), page_size):
+            result = self.collection.get(ids=ids[offset:offset + page_size], include=["metadatas"])
+            untagged = {
+                each_id: VectorStorage._stored_metadata(each_id, each_metadata or dict())
+                for each_id, each_metadata in zip(result["ids"], result["metadatas"])
+                if VectorStorage._AGENT_KEY not in (each_metadata or dict())
+            }
+            if 0 < len(untagged):
+                self.collection.update(ids=list(untagged), metadatas=list(untagged.values()))
+
+    def _get_embeddings(self, ids: list[str]) -> list[list[float]]:
+        result = self.collection.get(ids=ids, include=["embeddings"])
+        embeddings = dict(zip(result["ids"], result["embeddings"]))
+        return [embeddings[each_id] for each_id in ids]
+
+    def make_element(self, document: str, storage_id: str, metadata: dict[str, any]) -> CONTENT_ELEMENT:
+        kwargs = {each_key: each_value for each_key, each_value in metadata.items() if each_key != VectorStorage._AGENT_KEY}
+        element = self.clazz(document, **kwargs)
+        element.storage_id = storage_id
+        return element
 
     def _increment_storage_id(self) -> None:
         self.collection.metadata["next_storage_id"] = self._get_storage_id() + 1
 
     def _get_storage_id(self, incr: bool = False) -> int:
-        storage_id = self.collection.metadata.get("next_storage_id", 0)
-        if incr:
-            self._increment_storage_id()
-        return storage_id
+        # agents and their concurrent action attempts store at the same time
+        with self._id_lock:
+            storage_id = self.collection.metadata.get("next_storage_id", 0)
+            if incr:
+                self.collection.metadata["next_storage_id"] = storage_id + 1
+            return storage_id
 
     def connect_callbacks(self, callbacks: Callbacks) -> None:
         self.callbacks = callbacks
 
+    def register_cache(self, cache: any) -> None:
+        # `cache.invalidate(ids)` is called for elements that are removed or rewritten here, until the cache is garbage
+        self._caches.add(cache)
+
+    def _invalidate(self, ids: list[str]) -> None:
+        for each_cache in list(self._caches):
+            each_cache.invalidate(ids)
+
+    def _invalidate_pages(self, contents_only: bool = False) -> None:
+        # the id order only changes with the set of ids, content order and filters with the contents as well
+        with self._page_lock:
+            self._page_generation += 1
+            if not contents_only:
+                self._page_ids.clear()
+                return
+            for each_key in [each_key for each_key in self._page_ids if each_key[1] == "content" or each_key[3] is not None]:
+                del self._page_ids[each_key]
+
+    def flush(self) -> None:
+        self.indexer.flush()
+
     def store_contents(self, contents: list[str], local_agent_id: str | None = None) -> list[CONTENT_ELEMENT]:
+        # returns before the contents are embedded, the indexer writes them in the background.
+        # until then they are served from its overlay.
         ids = list()
         metadatas = list()
         documents = list()
@@ -60,38 +151,72 @@ class VectorStorage(Generic[CONTENT_ELEMENT]):
             each_element.storage_id = storage_id
 
             ids.append(storage_id)
-            metadatas.append(each_element.kwargs)
+            metadatas.append(VectorStorage._stored_metadata(storage_id, each_element.kwargs))
             documents.append(each_content)
 
-        embeddings = VectorStorage._embed(documents)
-
-        self.collection.add(
-            ids=ids,
-            metadatas=metadatas,
-            documents=documents,
-            embeddings=embeddings
-        )
+        self.indexer.submit(ids, documents, metadatas)
+        self._invalidate_pages()
         self.callbacks.upsert_elements(elements)
         return elements
 
+    def restore_elements(self, elements: list[CONTENT_ELEMENT]) -> list[CONTENT_ELEMENT]:
+        # brings archived elements back under their old ids. ids that were given to new elements in the meantime are
+        # skipped, the restored elements are returned.
+        ids = [each_element.storage_id for each_element in elements]
+        taken = set(self.collection.get(ids=ids, include=[])["ids"]) | set(self.indexer.pending(ids=ids))
+        restored = [each_element for each_element in elements if each_element.storage_id not in taken]
+        if len(restored) < 1:
+            return restored
+
+        self.indexer.submit(
+            [each_element.storage_id for each_element in restored],
+            [each_element.content for each_element in restored],
+            [VectorStorage._stored_metadata(each_element.storage_id, each_element.kwargs) for each_element in restored]
+        )
+        self._invalidate_pages()
+        if self.callbacks is not None:
+            self.callbacks.upsert_elements(restored)
+        return restored
+
     def update_elements(self, elements: list[CONTENT_ELEMENT]) -> None:
+        pending = self.indexer.pending(ids=[each_element.storage_id for each_element in elements])
+        if any(each_element.content != pending[each_element.storage_id][0] for each_element in elements if each_element.storage_id in pending):
+            self._invalidate_pages(contents_only=True)
+
+        stored_elements = [
+            each_element
+            for each_element in elements
+            if not self.indexer.update(each_element.storage_id, each_element.content, VectorStorage._stored_metadata(each_element.storage_id, each_element.kwargs))
+        ]
+        if 0 < len(stored_elements):
+            self._update_stored(stored_elements)
+        self.callbacks.upsert_elements(elements)
+
+    def _update_stored(self, elements: list[CONTENT_ELEMENT]) -> None:
         ids = [each_element.storage_id for each_element in elements]
         results = self.collection.get(ids=ids, include=["embeddings", "metadatas", "documents"])
-        # not UPSERT, only UPDATE: raises exception if elements are not found
+        # not UPSERT, only UPDATE: elements that consolidation removed in the meantime are skipped
+        elements = [each_element for each_element in elements if each_element.storage_id in results["ids"]]
 
         old_embeddings = dict(zip(results["ids"], results["embeddings"]))
         old_metadatas = dict(zip(results["ids"], results["metadatas"]))
         old_documents = dict(zip(results["ids"], results["documents"]))
 
-        ids_changed_document = {
-            each_element.storage_id
+        # a list, the embeddings below come back in this order
+        changed_elements = [
+            each_element
             for each_element in elements
             if each_element.content != old_documents[each_element.storage_id]
-        }
+        ]
 
-        changed_contents = [each_element.content for each_element in elements if each_element.storage_id in ids_changed_document]
-        updated_embeddings = dict(zip(ids_changed_document, VectorStorage._embed(changed_contents)))
-        updated_metadata = {each_element.storage_id: each_element.kwargs for each_element in elements if each_element.kwargs != old_metadatas[each_element.storage_id]}
+        self._invalidate([each_element.storage_id for each_element in changed_elements])
+        if 0 < len(changed_elements):
+            self._invalidate_pages(contents_only=True)
+        changed_contents = [each_element.content for each_element in changed_elements]
+        changed_embeddings = self.embed(changed_contents) if 0 < len(changed_contents) else list()
+        updated_embeddings = dict(zip([each_element.storage_id for each_element in changed_elements], changed_embeddings))
+        stored_metadata = {each_element.storage_id: VectorStorage._stored_metadata(each_element.storage_id, each_element.kwargs) for each_element in elements}
+        updated_metadata = {each_id: each_metadata for each_id, each_metadata in stored_metadata.items() if each_metadata != old_metadatas[each_id]}
 
         new_ids = list()
         new_metadatas = list()
@@ -111,49 +236,190 @@ class VectorStorage(Generic[CONTENT_ELEMENT]):
             new_documents.append(each_element.content)
             new_embeddings.append(each_embedding)
 
+        if len(new_ids) < 1:
+            return
+
         self.collection.update(
             ids=new_ids,
             embeddings=new_embeddings,
             metadatas=new_metadatas,
             documents=new_documents
         )
-        self.callbacks.upsert_elements(elements)
+        if self.index is not None:
+            self.index.add(new_ids, new_embeddings)
 
     def remove_elements(self, ids: list[str]) -> None:
+        # rare, waiting for pending writes is simpler than cancelling them
+        try:
+            self.flush()
+
+        except IndexingError:
+            # what is still pending failed to be written, the removed elements are dropped from the retries below
+            pass
         elements = self.get_elements(ids=ids)
+        self.indexer.remove(ids)
         self.collection.delete(ids=ids)
+        if self.index is not None:
+            self.index.remove(ids)
+        self._invalidate(ids)
+        self._invalidate_pages()
         self.callbacks.remove_elements(elements)
 
+    def consolidate(self, consolidator: FactConsolidator) -> Consolidation:
+        # pending elements are not written yet and left alone
+        consolidation = consolidator.run(self.collection)
+        updated_ids = list(consolidation.updated)
+        removed_ids = list(consolidation.removed)
+        if self.index is not None:
+            self.index.add(updated_ids, [consolidation.updated[each_id][2] for each_id in updated_ids])
+            self.index.remove(removed_ids)
+            self.index.compact()
+        self._invalidate(updated_ids + removed_ids)
+        if 0 < len(updated_ids) + len(removed_ids):
+            self._invalidate_pages()
+
+        if self.callbacks is not None:
+            self.callbacks.upsert_elements([
+                self.make_element(each_document, each_id, each_metadata)
+                for each_id, (each_document, each_metadata, _) in consolidation.updated.items()
+            ])
+            self.callbacks.remove_elements([
+                self.make_element(each_document, each_id, each_metadata)
+                for each_id, (each_document, each_metadata) in consolidation.removed.items()
+            ])
+        return consolidation
+
     def get_elements(self, ids: list[str] | None = None, local_agent_id: str | None = None) -> list[CONTENT_ELEMENT]:
+        # pending elements are newer than their stored versions
+        pending = self.indexer.pending(ids=ids)
         result = self.collection.get(ids=ids)
 
         documents = result["documents"]
-        ids = result["ids"]
+        result_ids = result["ids"]
         metadatas = result["metadatas"]
 
         elements = list()
 
-        for each_doc, each_id, each_metadata in zip(documents, ids, metadatas):
+        for each_doc, each_id, each_metadata in zip(documents, result_ids, metadatas):
             if local_agent_id is not None and not each_id.startswith(f"local_{local_agent_id}:"):
                 continue
-            each_element = self.clazz(each_doc, **each_metadata)
-            each_element.storage_id = each_id
-            elements.append(each_element)
+            each_doc, each_metadata = pending.pop(each_id, (each_doc, each_metadata))
+            elements.append(self.make_element(each_doc, each_id, each_metadata))
 
-        return elements
+        for each_id, (each_doc, each_metadata) in pending.items():
+            if local_agent_id is not None and not each_id.startswith(f"local_{local_agent_id}:"):
+                continue
+            elements.append(self.make_element(each_doc, each_id, each_metadata))
 
-    def get_similar_elements(self, content: str, n: int = 5) -> list[CONTENT_ELEMENT]:
-        embedding, = self._embed([content])
-        result = self.collection.query(embedding, n_results=n)
-        metadatas = result["metadatas"][0]
-        documents = result["documents"][0]
-        ids = result["ids"][0]
+        return elements
 
-        elements = list()
-        for each_doc, each_id, each_meta in zip(documents, ids, metadatas):
-            each_element = self.clazz(each_doc, **each_meta)
-            each_element.storage_id = each_id
-            elements.append(each_element)
+    @staticmethod
+    def _id_sort_key(storage_id: str) -> tuple[str, int]:
+        prefix, _, raw_id = storage_id.rpartition(":")
+        return prefix, int(raw_id) if raw_id.isdigit() else -1
+
+    def get_page(self,
+                 local_agent_id: str | None = None,
+                 offset: int = 0, limit: int = 50,
+                 sort_by: str | None = None, descending: bool = False,
+                 contains: str | None = None) -> tuple[list[CONTENT_ELEMENT], int]:
+        # full elements are loaded for the requested page alone. the sorted ids of the query are kept until the
+        # storage changes, paging through them does not go back to the database.
+        contains = None if contains is None or len(contains) < 1 else contains
+        ids = self._sorted_ids(local_agent_id, sort_by, descending, contains)
+
+        page_ids = ids[offset:offset + limit]
+        if len(page_ids) < 1:
+            return list(), len(ids)
+
+        elements = {each_element.storage_id: each_element for each_element in self.get_elements(ids=page_ids)}
+        return [elements[each_id] for each_id in page_ids if each_id in elements], len(ids)
+
+    def _sorted_ids(self, local_agent_id: str | None, sort_by: str | None, descending: bool, contains: str | None, max_queries: int = 16) -> list[str]:
+        key = local_agent_id, sort_by, descending, contains
+        with self._page_lock:
+            ids = self._page_ids.get(key)
+            generation = self._page_generation
+        if ids is not None:
+            return ids
+
+        # only ids, and documents if sorted by content, cross the database boundary
+        include = ["documents"] if sort_by == "content" else []
+        where = None if local_agent_id is None else {VectorStorage._AGENT_KEY: local_agent_id}
+        where_document = None if contains is None else {"$contains": contains}
+        prefix = None if local_agent_id is None else f"local_{local_agent_id}:"
+        pending = {
+            each_id: each_doc
+            for each_id, (each_doc, _) in self.indexer.pending().items()
+            if (prefix is None or each_id.startswith(prefix)) and (contains is None or contains in each_doc)
+        }
+        result = self.collection.get(include=include, where=where, where_document=where_document)
+        # stores with chroma's interface may ignore `where`
+        stored_ids = result["ids"] if prefix is None else [each_id for each_id in result["ids"] if each_id.startswith(prefix)]
+
+        ids = list(dict.fromkeys(stored_ids + list(pending)))
+        if sort_by == "content":
+            keys = dict(zip(result["ids"], result["documents"])) | pending
+            ids.sort(key=lambda each_id: keys[each_id], reverse=descending)
+        else:
+            ids.sort(key=VectorStorage._id_sort_key, reverse=descending)
+
+        with self._page_lock:
+            # not if the storage changed while they were sorted
+            if generation == self._page_generation:
+                if max_queries <= len(self._page_ids):
+                    del self._page_ids[next(iter(self._page_ids))]
+                self._page_ids[key] = ids
+        return ids
+
+    def get_embeddings(self, ids: list[str]) -> dict[str, list[float]]:
+        # of the stored elements among `ids`
+        result = self.collection.get(ids=ids, include=["embeddings"])
+        return dict(zip(result["ids"], result["embeddings"]))
+
+    def _query_stored(self, embedding: list[float], n: int) -> list[tuple[str, float, str, dict[str, any], list[float]]]:
+        include = ["documents", "metadatas", "embeddings"]
+        if self.index is not None:
+            (ids,), (distances,) = self.index.search([embedding], n)
+            result = self.collection.get(ids=ids, include=include)
+            found = {
+                each_id: (each_doc, each_meta, each_embedding)
+                for each_id, each_doc, each_meta, each_embedding in zip(result["ids"], result["documents"], result["metadatas"], result["embeddings"])
+            }
+            return [
+                (each_id, each_distance, *found[each_id])
+                for each_id, each_distance in zip(ids, distances)
+                if each_id in found
+            ]
+
+        no_stored = self.collection.count()
+        if no_stored < 1:
+            return list()
+        result = self.collection.query(embedding, n_results=min(n, no_stored), include=["documents", "metadatas", "embeddings", "distances"])
+        return list(zip(result["ids"][0], result["distances"][0], result["documents"][0], result["metadatas"][0], result["embeddings"][0]))
+
+    def get_nearest(self, embedding: list[float], n: int = 5) -> list[tuple[CONTENT_ELEMENT, float, list[float]]]:
+        # the n elements closest to `embedding` with their distances and embeddings, closest first. the collection and
+        # the indexer's overlay are queried with the same embedding and merged by distance, so an agent finds what it
+        # stored a moment ago.
+        space = self.space()
+        with TRACER.span("vector.query", store=self.collection.name, n=n):
+            candidates = {
+                each_id: (each_distance, each_doc, each_meta, each_embedding)
+                for each_distance, each_id, each_doc, each_meta, each_embedding in self.indexer.nearest(embedding, n, space=space)
+            }
+
+            for each_id, each_distance, each_doc, each_meta, each_embedding in self._query_stored(embedding, n):
+                # the pending version of an element that is also stored wins
+                candidates.setdefault(each_id, (each_distance, each_doc, each_meta, each_embedding))
+
+        best_ids = sorted(candidates, key=lambda each_id: candidates[each_id][0])[:n]
+        return [
+            (self.make_element(candidates[each_id][1], each_id, candidates[each_id][2]), candidates[each_id][0], candidates[each_id][3])
+            for each_id in best_ids
+        ]
 
-        return elements
+    def get_similar_elements(self, content: str, n: int = 5) -> list[CONTENT_ELEMENT]:
+        embedding, = self.embed([content])
+        return [each_element for each_element, _, _ in self.get_nearest(embedding, n)]
 
@@ -0,0 +1,37 @@
+import chromadb
+import numpy
+
+from new_attempt.model.agent.step_elements import Fact
+from new_attempt.model.storages.vector_storage.callbacks import Callbacks
+from new_attempt.model.storages.vector_storage.storage import VectorStorage
+
+
+def _embed(texts: list[str]) -> list[list[float]]:
+    return [numpy.random.default_rng(sum(each_text.encode())).normal(size=8).tolist() for each_text in texts]
+
+
+def test_pages_select_agents_in_the_database_and_keep_their_order(tmp_path: any) -> None:
+    collection = chromadb.PersistentClient(path=str(tmp_path)).get_or_create_collection("facts")
+    # stored before local metadata named the agent
+    collection.add(ids=["local_a:0"], embeddings=_embed(["old fact"]), metadatas=[{"timestamp": 1.}], documents=["old fact"])
+    storage = VectorStorage[Fact](collection, Fact, embed=_embed)
+    storage.connect_callbacks(Callbacks(lambda elements: None, lambda elements: None))
+    assert collection.get(ids=["local_a:0"])["metadatas"] == [{"timestamp": 1., "local_agent_id": "a"}]
+
+    storage.store_contents(["b fact", "a fact"], local_agent_id="a")
+    storage.store_contents(["global fact"])
+    storage.store_contents(["other"], local_agent_id="b")
+    storage.flush()
+
+    elements, total = storage.get_page("a", sort_by="content")
+    assert [each_element.content for each_element in elements] == ["a fact", "b fact", "old fact"] and total == 3
+    assert all("local_agent_id" not in each_element.kwargs for each_element in elements)
+    assert storage.get_page(None, contains="fact")[1] == 4
+
+    # paging reuses the sorted ids, writes replace them
+    collection.delete(ids=["local_a:0"])
+    assert storage.get_page("a", sort_by="content")[1] == 3
+    elements[0].content = "z fact"
+    storage.update_elements([elements[0]])
+    elements, total = storage.get_page("a", sort_by="content", offset=1, limit=1)
+    assert [each_element.content for each_element in elements] == ["z fact"] and total == 2
@@ -0,0 +1,227 @@
+import collections
+import threading
+import time
+import weakref
+from typing import Callable, Generic
+
+import numpy
+
+from new_attempt.model.storages.vector_storage.element import CONTENT_ELEMENT
+from new_attempt.model.storages.vector_storage.indexer import distances
+from new_attempt.model.storages.vector_storage.storage import VectorStorage
+from utils.ann_index import AnnIndex
+from utils.fact_consolidation import FactArchive
+
+
+class ArchiveIndex:
+    # the records of a fact archive in an ann index. the archive is read once, later only what was appended since.
+    # the last record of an element counts, elements that were merged into others are left out.
+
+    def __init__(self, archive: FactArchive, space: str = "l2") -> None:
+        self.archive = archive
+        self._lock = threading.Lock()
+        self._index = AnnIndex(space=space)
+        self._records = dict[str, tuple[str, dict[str, any]]]()
+        self._offset = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._index)
+
+    def _refresh(self) -> None:
+        # with the lock held
+        records, self._offset = self.archive.read(self._offset)
+        for each_record in records:
+            each_id = each_record["id"]
+            if "merged_into" in each_record:
+                self._records.pop(each_id, None)
+                self._index.remove([each_id])
+            else:
+                self._records[each_id] = each_record["document"], each_record["metadata"]
+                self._index.add([each_id], [each_record["embedding"]])
+
+    def search(self, embedding: numpy.ndarray, n: int, is_visible: Callable[[str], bool], max_distance: float) -> list[tuple[str, float, str, dict[str, any], numpy.ndarray]]:
+        # (id, distance, document, metadata, embedding) of the n closest visible records within `max_distance`
+        with self._lock:
+            self._refresh()
+            # records of other agents are skipped, more are asked for to make up for them
+            (ids,), (record_distances,) = self._index.search([embedding], 4 * n)
+            found = [
+                (each_id, each_distance)
+                for each_id, each_distance in zip(ids, record_distances)
+                if each_distance <= max_distance and is_visible(each_id)
+            ][:n]
+            vectors = self._index.vectors([each_id for each_id, _ in found])
+            return [
+                (each_id, each_distance, *self._records[each_id], each_vector)
+                for (each_id, each_distance), each_vector in zip(found, vectors)
+            ]
+
+    def remove(self, ids: list[str]) -> None:
+        # back in the storage, archived again they are read again
+        with self._lock:
+            for each_id in ids:
+                self._records.pop(each_id, None)
+            self._index.remove(ids)
+
+
+# one per archive, shared by the memories of all agents
+_ARCHIVE_INDEXES = weakref.WeakKeyDictionary[FactArchive, ArchiveIndex]()
+_ARCHIVE_INDEXES_LOCK = threading.Lock()
+
+
+def get_archive_index(archive: FactArchive, space: str = "l2") -> ArchiveIndex:
+    with _ARCHIVE_INDEXES_LOCK:
+        index = _ARCHIVE_INDEXES.get(archive)
+        if index is None:
+            index = ArchiveIndex(archive, space=space)
+            _ARCHIVE_INDEXES[archive] = index
+        return index
+
+
+class TieredMemory(Generic[CONTENT_ELEMENT]):
+    # one agent's view of elements with a `retrieved` timestamp, in three tiers:
+    #   hot:  the `capacity` most recently retrieved elements with their embeddings, in process
+    #   warm: the vector storage
+    #   cold: the storage's archive, where consolidation moves elements that were not retrieved for long, in an ann index
+    #         that is shared by all memories of the archive
+    # a retrieval is served by the hot tier if its `n` best are within `hit_distance` (in the storage's space), by the
+    # warm tier otherwise, and by the cold one if not even one of the warm tier's is. retrieved and promoted elements
+    # become hot, cold ones are restored to the storage, and the least recently retrieved hot ones drop out. retrieval
+    # times are written back to the storage in batches of `write_back_every`, consolidation archives by them. the hot
+    # tier starts from the `capacity` stored elements nearest to the first retrieval.
+
+    def __init__(self,
+                 storage: VectorStorage[CONTENT_ELEMENT],
+                 is_visible: Callable[[str], bool] = lambda storage_id: True,
+                 capacity: int = 256, hit_distance: float = .5, write_back_every: int = 16) -> None:
+        # the default `hit_distance` is a cosine similarity of .75 for unit vectors in the "l2" space
+
+        self.storage = storage
+        self.is_visible = is_visible
+        self.capacity = capacity
+        self.hit_distance = hit_distance
+        self.write_back_every = write_back_every
+
+        self._lock = threading.Lock()
+        self._hot = collections.OrderedDict[str, tuple[CONTENT_ELEMENT, numpy.ndarray]]()
+        self._dirty = dict[str, CONTENT_ELEMENT]()
+        self._is_warmed_up = False
+        self.hits = {"hot": 0, "warm": 0, "cold": 0}
+
+        storage.register_cache(self)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._hot)
+
+    def invalidate(self, ids: list[str]) -> None:
+        with self._lock:
+            for each_id in ids:
+                self._hot.pop(each_id, None)
+                self._dirty.pop(each_id, None)
+
+    def _warm_up(self, embedding: numpy.ndarray) -> None:
+        # a bounded query for the elements nearest to the first retrieval. they were not retrieved, so they are the
+        # first to drop out, the farthest before the others.
+        nearest = self.storage.get_nearest(embedding.tolist(), self.capacity)
+        with self._lock:
+            for each_element, _, each_embedding in nearest:
+                if self.is_visible(each_element.storage_id) and each_element.storage_id not in self._hot:
+                    self._hot[each_element.storage_id] = each_element, numpy.asarray(each_embedding, dtype=numpy.float32)
+                    self._hot.move_to_end(each_element.storage_id, last=False)
+            self._is_warmed_up = True
+
+    def _make_hot(self, elements: list[CONTENT_ELEMENT], embeddings: list[numpy.ndarray]) -> None:
+        # with the lock held, the least recently retrieved drop out
+        for each_element, each_embedding in zip(elements, embeddings):
+            self._hot[each_element.storage_id] = each_element, each_embedding
+            self._hot.move_to_end(each_element.storage_id)
+        while self.capacity < len(self._hot):
+            self._hot.popitem(last=False)
+
+    def promote(self, elements: list[CONTENT_ELEMENT]) -> None:
+        # elements the agent just stored, a hot tier that keeps hitting would not show them otherwise
+        embeddings = [numpy.asarray(each_embedding, dtype=numpy.float32) for each_embedding in self.storage.embed([each_element.content for each_element in elements])]
+        with self._lock:
+            self._make_hot(elements, embeddings)
+
+    def _search_hot(self, embedding: numpy.ndarray, n: int) -> list[tuple[CONTENT_ELEMENT, float, numpy.ndarray]]:
+        with self._lock:
+            entries = [each_entry for each_id, each_entry in self._hot.items() if self.is_visible(each_id)]
+        if len(entries) < 1:
+            return list()
+
+        hot_distances = distances(numpy.stack([each_embedding for _, each_embedding in entries]), embedding, space=self.storage.space())
+        best = numpy.argsort(hot_distances)[:n]
+        return [(entries[i][0], float(hot_distances[i]), entries[i][1]) for i in best]
+
+    def _search_warm(self, embedding: numpy.ndarray, n: int) -> list[tuple[CONTENT_ELEMENT, float, numpy.ndarray]]:
+        # elements of other agents are skipped, more are asked for to make up for them
+        nearest = self.storage.get_nearest(embedding.tolist(), 4 * n)
+        return [
+            (each_element, each_distance, numpy.asarray(each_embedding, dtype=numpy.float32))
+            for each_element, each_distance, each_embedding in nearest
+            if self.is_visible(each_element.storage_id)
+        ][:n]
+
+    def _search_cold(self, embedding: numpy.ndarray, n: int) -> list[tuple[CONTENT_ELEMENT, float, numpy.ndarray]]:
+        # only elements within `hit_distance` are worth restoring
+        archive = self.storage.archive
+        if archive is None:
+            return list()
+
+        archive_index = get_archive_index(archive, space=self.storage.space())
+        found = archive_index.search(embedding, n, self.is_visible, self.hit_distance)
+        elements = {
+            each_id: (self.storage.make_element(each_document, each_id, each_metadata), each_distance, each_embedding)
+            for each_id, each_distance, each_document, each_metadata, each_embedding in found
+        }
+        restored = self.storage.restore_elements([each_element for each_element, _, _ in elements.values()])
+        # restored here or elsewhere, they are in the storage
+        archive_index.remove(list(elements))
+        return [
+            (each_element, elements[each_element.storage_id][1], elements[each_element.storage_id][2])
+            for each_element in restored
+        ]
+
+    def _is_hit(self, found: list[tuple[CONTENT_ELEMENT, float, numpy.ndarray]], n: int) -> bool:
+        return n <= len(found) and found[n - 1][1] <= self.hit_distance
+
+    def retrieve(self, content: str, n: int = 5) -> list[CONTENT_ELEMENT]:
+        embedding = numpy.asarray(self.storage.embed([content])[0], dtype=numpy.float32)
+        if not self._is_warmed_up:
+            self._warm_up(embedding)
+
+        found = self._search_hot(embedding, n)
+        tier = "hot"
+        if not self._is_hit(found, n):
+            found = self._search_warm(embedding, n)
+            tier = "warm"
+            if len(found) < 1 or self.hit_distance < found[0][1]:
+                cold = self._search_cold(embedding, n)
+                if 0 < len(cold):
+                    found = sorted(found + cold, key=lambda each_found: each_found[1])[:n]
+                    tier = "cold"
+
+        now = time.time()
+        with self._lock:
+            self.hits[tier] += 1
+            for each_element, _, _ in found:
+                each_element.kwargs["retrieved"] = now
+                self._dirty[each_element.storage_id] = each_element
+            # evicted elements that are dirty are still written back
+            self._make_hot([each_element for each_element, _, _ in found], [each_embedding for _, _, each_embedding in found])
+            is_due = self.write_back_every <= len(self._dirty)
+
+        if is_due:
+            self.write_back()
+        return [each_element for each_element, _, _ in found]
+
+    def write_back(self) -> None:
+        # the retrieval times of everything retrieved since the last write back, in one update
+        with self._lock:
+            elements = list(self._dirty.values())
+            self._dirty.clear()
+        if 0 < len(elements):
+            self.storage.update_elements(elements)
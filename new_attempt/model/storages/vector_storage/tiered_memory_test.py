@@ -0,0 +1,99 @@
+import chromadb
+
+from new_attempt.model.agent.step_elements import Fact
+from new_attempt.model.storages.vector_storage.callbacks import Callbacks
+from new_attempt.model.storages.vector_storage.storage import VectorStorage
+from new_attempt.model.storages.vector_storage.tiered_memory import TieredMemory, get_archive_index
+from utils.fact_consolidation import FactArchive
+
+VECTORS = {
+    "apple": [1., 0., 0., 0.],
+    "apricot": [.9, .1, 0., 0.],
+    "banana": [0., 1., 0., 0.],
+    "cherry": [0., 0., 1., 0.],
+    "date": [0., 0., 0., 1.],
+}
+
+
+def _embed(texts: list[str]) -> list[list[float]]:
+    return [VECTORS[each_text] for each_text in texts]
+
+
+def _is_visible(storage_id: str) -> bool:
+    return storage_id.startswith("local_a:") or not storage_id.startswith("local_")
+
+
+def _storage(tmp_path: any, archive: FactArchive | None = None) -> VectorStorage:
+    collection = chromadb.PersistentClient(path=str(tmp_path / "chroma")).get_or_create_collection("facts")
+    storage = VectorStorage[Fact](collection, Fact, embed=_embed, archive=archive)
+    storage.connect_callbacks(Callbacks(lambda elements: None, lambda elements: None))
+    return storage
+
+
+def _record(storage_id: str, document: str) -> dict[str, any]:
+    return {"id": storage_id, "document": document, "metadata": {"retrieved": 1.}, "embedding": VECTORS[document], "archived": 2.}
+
+
+def test_retrievals_are_served_by_the_hot_tier_then_the_warm_one(tmp_path: any) -> None:
+    storage = _storage(tmp_path)
+    storage.store_contents(["apple", "banana"], local_agent_id="a")
+    storage.store_contents(["cherry"], local_agent_id="b")
+    storage.flush()
+    memory = TieredMemory(storage, is_visible=_is_visible, capacity=1, write_back_every=2)
+
+    # warmed up with the element nearest to the first retrieval only
+    assert [each_element.content for each_element in memory.retrieve("apricot", n=1)] == ["apple"]
+    assert memory.hits == {"hot": 1, "warm": 0, "cold": 0} and len(memory) == 1
+
+    assert [each_element.content for each_element in memory.retrieve("banana", n=1)] == ["banana"]
+    assert [each_element.content for each_element in memory.retrieve("banana", n=1)] == ["banana"]
+    assert memory.hits == {"hot": 2, "warm": 1, "cold": 0} and len(memory) == 1
+    # other agents' elements are not retrieved
+    assert "cherry" not in [each_element.content for each_element in memory.retrieve("cherry", n=3)]
+
+    # retrieval times are written back in batches
+    storage.flush()
+    assert all("retrieved" in each_element.kwargs for each_element in storage.get_elements(local_agent_id="a"))
+
+
+def test_the_cold_tier_restores_archived_elements_once(tmp_path: any) -> None:
+    archive = FactArchive(str(tmp_path / "archive.jsonl.gz"))
+    archive.append([_record("local_a:7", "cherry"), _record("local_b:8", "cherry"), _record("local_a:9", "banana")])
+    # merged into another element, not worth restoring
+    archive.append([{**_record("local_a:9", "banana"), "merged_into": "local_a:0"}])
+    storage = _storage(tmp_path, archive=archive)
+    storage.store_contents(["apple"], local_agent_id="a")
+    storage.flush()
+    memory = TieredMemory(storage, is_visible=_is_visible)
+
+    # the warm tier has something, but nothing close
+    assert [each_element.content for each_element in memory.retrieve("cherry", n=1)] == ["cherry"]
+    assert memory.hits["cold"] == 1
+    memory.retrieve("banana", n=1)
+    assert memory.hits["cold"] == 1
+    storage.flush()
+    assert [each_element.storage_id for each_element in storage.get_elements(local_agent_id="a")] == ["local_a:0", "local_a:7"]
+    # only the other agent's record is left, appended records are read on the next retrieval
+    assert len(get_archive_index(archive)) == 1
+    archive.append([_record("local_a:10", "date")])
+    assert [each_element.storage_id for each_element in memory.retrieve("date", n=1)] == ["local_a:10"]
+    assert memory.hits["cold"] == 2
+
+
+def test_removed_and_changed_elements_leave_the_hot_tier(tmp_path: any) -> None:
+    storage = _storage(tmp_path)
+    apple, banana = storage.store_contents(["apple", "banana"])
+    storage.flush()
+    memory = TieredMemory(storage, capacity=2)
+    memory.retrieve("apple", n=1)
+    assert len(memory) == 2
+
+    storage.remove_elements([banana.storage_id])
+    assert len(memory) == 1
+    assert [each_element.content for each_element in memory.retrieve("banana", n=1)] == ["apple"]
+
+    apple.content = "date"
+    storage.update_elements([apple])
+    storage.flush()
+    assert [each_element.content for each_element in memory.retrieve("date", n=1)] == ["date"]
+    assert memory.hits["warm"] == 2
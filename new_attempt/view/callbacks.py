@@ -10,17 +10,25 @@ class ViewCallbacks:
                  get_agents: Callable[[list[str] | None], list[Agent]],
                  get_facts: Callable[[list[str] | None, str | None], list[Fact]],
                  get_actions: Callable[[list[str] | None, str | None], list[Action]],
+                 get_fact_page: Callable[[str | None, int, int, str | None, bool, str | None], tuple[list[Fact], int]],
+                 get_action_page: Callable[[str | None, int, int, str | None, bool, str | None], tuple[list[Action], int]],
                  pause_agent: Callable[[Agent], None],
                  start_agent: Callable[[Agent], None],
-                 delete_agent: Callable[[Agent], None]) -> None:
+                 delete_agent: Callable[[Agent], None],
+                 set_actions_idempotent: Callable[[list[str], bool], None],
+                 flush_updates: Callable[[], None]) -> None:
 
         self._create_agent = create_agent
         self._get_agents = get_agents
         self._get_facts = get_facts
         self._get_actions = get_actions
+        self._get_fact_page = get_fact_page
+        self._get_action_page = get_action_page
         self._pause_agent = pause_agent
         self._start_agent = start_agent
         self._delete_agent = delete_agent
+        self._set_actions_idempotent = set_actions_idempotent
+        self._flush_updates = flush_updates
 
     def create_agent(self, arguments: AgentArguments) -> Agent:
         return self._create_agent(arguments)
@@ -34,6 +42,16 @@ class ViewCallbacks:
     def get_actions(self, action_ids: list[str] | None = None, agent_id: str | None = None) -> list[Action]:
         return self._get_actions(action_ids, agent_id)
 
+    def get_fact_page(self,
+                      agent_id: str | None, offset: int, limit: int,
+                      sort_by: str | None = None, descending: bool = False, contains: str | None = None) -> tuple[list[Fact], int]:
+        return self._get_fact_page(agent_id, offset, limit, sort_by, descending, contains)
+
+    def get_action_page(self,
+                        agent_id: str | None, offset: int, limit: int,
+                        sort_by: str | None = None, descending: bool = False, contains: str | None = None) -> tuple[list[Action], int]:
+        return self._get_action_page(agent_id, offset, limit, sort_by, descending, contains)
+
     def pause_agent(self, agent: Agent) -> None:
         self._pause_agent(agent)
 
@@ -42,3 +60,9 @@ class ViewCallbacks:
 
     def delete_agent(self, agent: Agent) -> None:
         self._delete_agent(agent)
+
+    def set_actions_idempotent(self, action_ids: list[str], idempotent: bool) -> None:
+        self._set_actions_idempotent(action_ids, idempotent)
+
+    def flush_updates(self) -> None:
+        self._flush_updates()
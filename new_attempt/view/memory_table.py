@@ -0,0 +1,97 @@
+# coding=utf-8
+from __future__ import annotations
+
+from typing import Callable
+
+import nicegui
+from nicegui.events import GenericEventArguments, ValueChangeEventArguments
+
+from new_attempt.model.storages.vector_storage.element import CONTENT_ELEMENT
+
+
+class MemoryTable:
+    # server-side paginated table: the client only ever holds the rows of the current page,
+    # `index` maps the storage ids of these rows to the row dicts for constant time upserts and deletes
+
+    def __init__(self,
+                 field: str,
+                 get_page: Callable[[int, int, str | None, bool, str | None], tuple[list[CONTENT_ELEMENT], int]],
+                 on_selection: Callable[[list[dict[str, any]]], None],
+                 rows_per_page: int = 25) -> None:
+
+        self.field = field
+        self.get_page = get_page
+        self.contains = None
+        self.index = dict[str, dict[str, str]]()
+
+        columns = [
+            {"name": field, "label": field.capitalize(), "field": field, "required": True, "align": "left", "type": "text", "sortable": True},
+            {"name": "id", "label": "ID", "field": "id", "required": True, "align": "left", "type": "text", "sortable": True}
+        ]
+        pagination = {"page": 1, "rowsPerPage": rows_per_page, "sortBy": None, "descending": False, "rowsNumber": 0}
+
+        search = nicegui.ui.input(placeholder="Filter", on_change=self._on_filter)
+        search.props("dense clearable debounce=300")
+        search.classes("full-width")
+
+        self.table = nicegui.ui.table(columns=columns, rows=list(), row_key="id", selection="multiple", pagination=pagination)
+        self.table.on("request", self._on_request, ["pagination"])
+        self.table.on("selection", lambda: on_selection(self.table.selected))
+        self.table.style('background-color: #ebf1fa')
+
+        self.refresh()
+
+    @property
+    def selected(self) -> list[dict[str, any]]:
+        return self.table.selected
+
+    def _to_row(self, element: CONTENT_ELEMENT) -> dict[str, str]:
+        return {"id": element.storage_id, self.field: element.content}
+
+    def _on_request(self, event: GenericEventArguments) -> None:
+        self.refresh(event.args["pagination"])
+
+    def _on_filter(self, event: ValueChangeEventArguments) -> None:
+        self.contains = event.value or None
+        self.refresh(self.table.pagination | {"page": 1})
+
+    def refresh(self, pagination: dict[str, any] | None = None) -> None:
+        pagination = dict(pagination or self.table.pagination)
+        rows_per_page = pagination["rowsPerPage"]
+        offset = (pagination["page"] - 1) * rows_per_page
+
+        sort_by = {self.field: "content", "id": None}.get(pagination.get("sortBy"))
+        elements, total = self.get_page(offset, rows_per_page, sort_by, pagination.get("descending", False), self.contains)
+
+        rows = [self._to_row(each_element) for each_element in elements]
+        self.index = {each_row["id"]: each_row for each_row in rows}
+        self.table.rows[:] = rows
+        self.table.pagination = pagination | {"rowsNumber": total}
+
+    def upsert(self, elements: list[CONTENT_ELEMENT]) -> None:
+        added = 0
+        for each_element in elements:
+            each_row = self.index.get(each_element.storage_id)
+            if each_row is None:
+                added += 1
+            else:
+                each_row.update(self._to_row(each_element))
+
+        if 0 < added:
+            # new elements only change the page count, they show up once their page is requested
+            self.table.pagination = self.table.pagination | {"rowsNumber": self.table.pagination.get("rowsNumber", 0) + added}
+        else:
+            self.table.update()
+
+    def delete(self, elements: list[CONTENT_ELEMENT]) -> None:
+        removed_ids = {each_element.storage_id for each_element in elements}
+        visible_ids = removed_ids & self.index.keys()
+        for each_id in visible_ids:
+            del self.index[each_id]
+
+        if 0 < len(visible_ids):
+            self.table.rows[:] = [each_row for each_row in self.table.rows if each_row["id"] not in visible_ids]
+            self.table.selected[:] = [each_row for each_row in self.table.selected if each_row["id"] not in visible_ids]
+
+        total = max(self.table.pagination.get("rowsNumber", 0) - len(removed_ids), 0)
+        self.table.pagination = self.table.pagination | {"rowsNumber": total}
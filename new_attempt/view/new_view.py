@@ -1,6 +1,7 @@
 # coding=utf-8
 from __future__ import annotations
-from typing import Literal
+import json
+from typing import Callable, Literal
 
 from nicegui import ui
 
@@ -8,8 +9,130 @@ from new_attempt.model.agent.agent import Agent, Status
 from new_attempt.model.agent.step_elements import Thought, Fact, Action, ActionArguments, ActionOutput, Summary, ActionWasSuccessful, IsFulfilled, ActionAttempt, Step
 
 
-# coding=utf-8
+def _color_class(value: bool | None) -> str:
+    if value is None:
+        return "bg-yellow-300"
+    return "bg-green-300" if value else "bg-red-300"
+
+
+def _lazy_expansion(text: str, render: Callable[[], None], **kwargs: any) -> ui.expansion:
+    # children are only created when the expansion is opened for the first time
+    is_rendered = False
+
+    def on_open(is_open: bool) -> None:
+        nonlocal is_rendered
+        if not is_open or is_rendered:
+            return
+        is_rendered = True
+        with expansion:
+            render()
+
+    expansion = ui.expansion(text=text, on_value_change=lambda event: on_open(event.value), **kwargs)
+    if expansion.value:
+        on_open(True)
+    return expansion
+
+
+class StepView:
+    _inline_limit = 2_000
+
+    def __init__(self, step: Step, lazy: bool = False) -> None:
+        self.step = step
+        self.attempt = None
+        self.attempt_count = 0
+
+        if lazy:
+            self.expansion = _lazy_expansion(step.thought or "...", self._render)
+        else:
+            self.expansion = ui.expansion(text=step.thought or "...", value=True)
+            self._render()
+
+        self.expansion.classes(f"full-width rounded-lg {_color_class(None)}")
+
+    @staticmethod
+    def _code_block(label: str, content: str, language: str = "") -> None:
+        if len(content) < StepView._inline_limit:
+            ui.markdown(f"```{language}\n{content}\n```")
+            return
+
+        # large blocks are only sent to the client on request
+        _lazy_expansion(
+            f"{label} ({len(content):,} characters)",
+            lambda: ui.markdown(f"```{language}\n{content}\n```")
+        ).classes("full-width")
+
+    def _render(self) -> None:
+        if self.step.relevant_facts is not None:
+            self.set_relevant_facts(self.step.relevant_facts)
+
+        for each_attempt in self.step.action_attempts:
+            self.add_action_attempt()
+            if each_attempt.action is not None:
+                self.set_action(each_attempt.action)
+            if each_attempt.action_arguments is not None:
+                self.set_action_arguments(each_attempt.action_arguments)
+            if each_attempt.output is not None:
+                self.set_action_output(each_attempt.output)
+            if each_attempt.fact is not None:
+                self.set_fact(each_attempt.fact)
+            if each_attempt.was_successful is not None:
+                self.set_was_successful(each_attempt.was_successful)
+
+        if self.step.summary is not None:
+            self.set_summary(self.step.summary)
+
+    def collapse(self) -> None:
+        self.expansion.value = False
+
+    def set_relevant_facts(self, relevant_facts: list[Fact]) -> None:
+        with self.expansion:
+            with ui.expansion(text=f"relevant facts ({len(relevant_facts)})") as fact_expansion:
+                fact_expansion.classes("full-width pl-8 bg-blue-300")
+                for each_fact in relevant_facts:
+                    each_label = ui.label(each_fact.content)
+                    each_label.classes("flex-1 m-3 p-3 rounded-lg")
+
+    def add_action_attempt(self) -> None:
+        self.attempt_count += 1
+        with self.expansion:
+            self.attempt = ui.expansion(text=f"attempt #{self.attempt_count}", value=True)
+            self.attempt.classes(f"full-width pl-8 {_color_class(None)}")
+
+    def set_action(self, action: Action) -> None:
+        self.attempt.text = f"attempt #{self.attempt_count}: {action.content}"
+
+    def set_action_arguments(self, action_arguments: ActionArguments) -> None:
+        with self.attempt:
+            StepView._code_block("arguments", json.dumps(action_arguments, indent=4), language="json")
+
+    def set_action_output(self, action_output: ActionOutput) -> None:
+        with self.attempt:
+            StepView._code_block("output", str(action_output))
+
+    def set_fact(self, fact: Fact) -> None:
+        with self.attempt:
+            fact_label = ui.label(fact.content)
+            fact_label.classes("flex-1 m-3 p-3 bg-blue-200 rounded-lg")
+
+    def set_was_successful(self, was_successful: ActionWasSuccessful) -> None:
+        self.attempt.classes(remove=_color_class(None), add=_color_class(was_successful.value))
+        self.attempt.value = False
+        self.expansion.classes(remove=" ".join(_color_class(each) for each in (None, True, False)), add=_color_class(was_successful.value))
+
+    def set_summary(self, summary: Summary) -> None:
+        with self.expansion:
+            summary_label = ui.label(summary)
+            summary_label.classes("flex-1 m-3 p-3 bg-white rounded-lg")
+
+    def set_is_fulfilled(self, is_fulfilled: IsFulfilled) -> None:
+        if is_fulfilled.value:
+            with self.expansion:
+                ui.markdown("**Request fulfilled.**")
+
+
 class View:
+    _steps_per_batch = 20
+
     def __init__(self) -> None:
         self.header = None
 
@@ -17,6 +140,11 @@ class View:
         self.agent_table = None
 
         self.main = None
+        self.stream = None
+        self.history = None
+        self.step_views = list[StepView]()
+        self.hidden_steps = 0
+        self.earlier_steps_button = None
 
         self.right_drawer = None
 
@@ -153,7 +281,32 @@ class View:
         print(f"Delete dialog for agent {agent.agent_id}")
 
     def _render_history(self, stream: ui.column, history: list[Step]) -> None:
-        ui.markdown("History")
+        # only the latest step is rendered in full, earlier ones are placeholders that render when opened.
+        # beyond the latest batch, steps are not even created until requested.
+        self.stream = stream
+        self.history = history
+        self.step_views.clear()
+        self.hidden_steps = max(len(history) - View._steps_per_batch, 0)
+
+        with stream:
+            self.earlier_steps_button = ui.button("show earlier steps", on_click=self._show_earlier_steps)
+            self.earlier_steps_button.set_visibility(0 < self.hidden_steps)
+
+            for i in range(self.hidden_steps, len(history)):
+                self.step_views.append(StepView(history[i], lazy=i < len(history) - 1))
+
+    def _show_earlier_steps(self) -> None:
+        first = max(self.hidden_steps - View._steps_per_batch, 0)
+        with self.stream:
+            earlier_views = [StepView(self.history[i], lazy=True) for i in range(first, self.hidden_steps)]
+
+        for i, each_view in enumerate(earlier_views):
+            # keep the button on top
+            each_view.expansion.move(target_index=i + 1)
+
+        self.step_views[:0] = earlier_views
+        self.hidden_steps = first
+        self.earlier_steps_button.set_visibility(0 < first)
 
     def _agent_details(self, agent: Agent) -> None:
         task_label = ui.markdown(f"**Task:** {agent.arguments.task}")
@@ -162,8 +315,8 @@ class View:
         progress_label = ui.markdown(f"**Progress summary:** {agent.summary}")
         progress_label.classes("flex-none")
 
-        with ui.scroll_area() as self.main:
-            self.main.classes("flex-1")
+        with ui.scroll_area() as scroll_area:
+            scroll_area.classes("flex-1")
 
             with ui.column() as stream:
                 stream.classes("flex flex-col full-width")
@@ -227,64 +380,56 @@ class View:
             case _:
                 raise Exception("Invalid source")
 
+    def _current_step_view(self) -> StepView:
+        if len(self.step_views) < 1:
+            raise Exception("No step in stream.")
+        return self.step_views[-1]
+
     def _update_stream(self, content: Status | Thought | list[Fact] | ActionAttempt | Action | ActionArguments | ActionOutput | ActionWasSuccessful | Fact | Summary | IsFulfilled) -> None:
-        # get stream element
-        # raise exception if no stream element
-
-        # agent status change
-        # agent thought update
-        # agent relevant facts update
-        # agent action attempt update
-        # agent action update
-        # agent action arguments update
-        # agent action output update
-        # agent fact (is_successful) update
-        # agent summary (is_fulfilled) update
+        # appends to the selected agent's stream, nothing that is already shown is rendered again
+        if self.stream is None:
+            raise Exception("No stream element.")
 
         if isinstance(content, Status):
-            # update stream color, append status text
-            pass
+            with self.stream:
+                status_label = ui.label(f"status: {content}")
+                status_label.classes("flex-none text-sm")
 
         elif isinstance(content, Thought):
-            # add thought expansion
-            pass
+            if 0 < len(self.step_views):
+                self._current_step_view().collapse()
+
+            with self.stream:
+                self.step_views.append(StepView(Step(thought=content)))
 
         elif isinstance(content, list) and all(isinstance(each, Fact) for each in content):
             # fact previews, click to open details, make navigable
             # https://github.com/zauberzeug/nicegui/tree/main/examples%2Fmodularization
-            pass
+            self._current_step_view().set_relevant_facts(content)
 
         elif isinstance(content, ActionAttempt):
-            pass
-            # add attempt
+            self._current_step_view().add_action_attempt()
 
         elif isinstance(content, Action):
-            # add action
-            pass
+            self._current_step_view().set_action(content)
 
         elif isinstance(content, ActionArguments):
-            # add arguments
-            pass
+            self._current_step_view().set_action_arguments(content)
 
         elif isinstance(content, ActionOutput):
-            # add output
-            pass
+            self._current_step_view().set_action_output(content)
 
         elif isinstance(content, ActionWasSuccessful):
-            pass
-            # update action successful
+            self._current_step_view().set_was_successful(content)
 
         elif isinstance(content, Fact):
-            # add new fact
-            pass
+            self._current_step_view().set_fact(content)
 
         elif isinstance(content, Summary):
-            # add summary
-            pass
+            self._current_step_view().set_summary(content)
 
         elif isinstance(content, IsFulfilled):
-            pass
-            # update fulfilled
+            self._current_step_view().set_is_fulfilled(content)
 
         else:
             raise Exception(f"Invalid element type {type(content)}")
@@ -1,16 +1,15 @@
 # coding=utf-8
 import json
-from typing import Callable
 
 import nicegui
 from nicegui.elements.button import Button
 from nicegui.elements.dialog import Dialog
-from nicegui.elements.table import Table
 
 from new_attempt.model.agent.agent import Agent, AgentArguments
 from new_attempt.model.agent.step_elements import Fact, Action, IsFulfilled, ActionOutput, ActionArguments, ActionWasSuccessful, Summary, Thought
-from new_attempt.model.storages.vector_storage.element import ContentElement, CONTENT_ELEMENT
+from new_attempt.model.storages.vector_storage.element import CONTENT_ELEMENT
 from new_attempt.view.callbacks import ViewCallbacks
+from new_attempt.view.memory_table import MemoryTable
 
 
 class View:
@@ -99,6 +98,9 @@ class View:
         self.fill_right_drawer()
         self.fill_footer()
 
+        # agent updates are collected off the ui thread and drawn in batches at about 10 Hz
+        nicegui.ui.timer(.1, self.view_callbacks.flush_updates)
+
         nicegui.ui.run()
 
     def fill_header(self) -> None:
@@ -227,40 +229,52 @@ class View:
 
         self.stream_of_consciousness()
 
-    def update_thought(self, thought: Thought) -> None:
+    def update_thought(self, agent_id: str, thought: Thought) -> None:
         with self.main_section:
             if self.current_thought_expansion is None:
                 raise Exception("current_thought_expansion is None")
             self.current_thought_expansion.text = thought
 
-    def update_relevant_facts(self, relevant_facts: list[Fact]) -> None:
+    def update_relevant_facts(self, agent_id: str, relevant_facts: list[Fact]) -> None:
         pass
 
-    def update_action_attempt(self) -> None:
+    def update_action_attempt(self, agent_id: str) -> None:
         pass
 
-    def update_action(self, action: Action) -> None:
+    def update_action(self, agent_id: str, action: Action) -> None:
         # create new action attempt
         pass
 
-    def update_action_arguments(self, action_arguments: ActionArguments) -> None:
+    def update_action_arguments(self, agent_id: str, action_arguments: ActionArguments) -> None:
         pass
 
-    def update_action_output(self, action_output: ActionOutput) -> None:
+    def update_action_output(self, agent_id: str, action_output: ActionOutput) -> None:
         pass
 
-    def update_fact(self, resulting_fact: Fact) -> None:
+    def update_fact(self, agent_id: str, resulting_fact: Fact) -> None:
         pass
 
-    def update_action_is_successful(self, is_successful: ActionWasSuccessful) -> None:
+    def update_action_is_successful(self, agent_id: str, is_successful: ActionWasSuccessful) -> None:
         pass
 
-    def update_summary(self, summary: Summary) -> None:
+    def update_summary(self, agent_id: str, summary: Summary) -> None:
         pass
 
-    def update_is_fulfilled(self, is_fulfilled: IsFulfilled) -> None:
+    def update_is_fulfilled(self, agent_id: str, is_fulfilled: IsFulfilled) -> None:
         pass
 
+    def update_partial(self, agent_id: str, element_type: str, partial_content: str) -> None:
+        # streamed tokens replace the "thinking about..." placeholder until the element is complete
+        if self.stream is None:
+            return
+
+        if self.waiting_label is None:
+            with self.stream:
+                self.waiting_label = nicegui.ui.label()
+                self.waiting_label.classes("flex-none text-sm")
+
+        self.waiting_label.text = f"{element_type}: {partial_content}"
+
     def stream_of_consciousness(self) -> None:
 
         # agent, = self.view_callbacks.receive_agents([agent_id], False)
@@ -522,6 +536,7 @@ class View:
 
             confirm_actions = nicegui.ui.checkbox("Requires confirmation", value=True)
             action_attempts = nicegui.ui.number(value=3)
+            concurrent_attempts = nicegui.ui.number("Concurrent attempts", value=1, min=1, precision=0)
 
             with nicegui.ui.row().classes("justify-around full-width flex-none"):
                 button_ok = nicegui.ui.button("OK", color="primary", on_click=lambda: dialog.submit("done"))
@@ -546,6 +561,7 @@ class View:
             llm_result=llm_result.value,
             llm_fact=llm_fact.value,
             llm_summary=llm_summary.value,
+            concurrent_attempts=int(concurrent_attempts.value),
         )
 
         agent = self.view_callbacks.create_agent(arguments)
@@ -575,106 +591,59 @@ class View:
             self.selected_action_ids.append(each_action["id"])
         self.update_memory_buttons(buttons, 0 < len(selected_action_rows))
 
+    def toggle_idempotent_actions(self) -> None:
+        # marks the selected actions idempotent, unless all of them are already
+        actions = self.view_callbacks.get_actions(action_ids=list(self.selected_action_ids))
+        idempotent = not all(each_action.idempotent for each_action in actions)
+        self.view_callbacks.set_actions_idempotent([each_action.storage_id for each_action in actions], idempotent)
+        nicegui.ui.notify(f"{len(actions)} actions marked {'idempotent' if idempotent else 'not idempotent'}.")
+
     def update_selected_facts(self, selected_fact_rows: list[dict[str, any]], buttons: list[Button | None]) -> None:
         self.selected_fact_ids.clear()
         for each_fact in selected_fact_rows:
             self.selected_fact_ids.append(each_fact["id"])
         self.update_memory_buttons([each_button for each_button in buttons if each_button is not None], 0 < len(selected_fact_rows))
 
-    def _action_to_row(self, action: Action) -> dict[str, str]:
-        return {"id": action.storage_id, "action": action.content}
-
-    def _fact_to_row(self, fact: Fact) -> dict[str, str]:
-        return {"id": fact.storage_id, "fact": fact.content}
-
-    def _delete_content_element(self,
-                                content_element: ContentElement,
-                                memory_table: nicegui.ui.table) -> None:
-        for each_row in memory_table.rows:
-            if each_row["id"] == content_element.storage_id:
-                to_remove = each_row
-                break
-        else:
-            raise ValueError(f"Could not find row with id {content_element.storage_id}")
-
-        memory_table.remove_rows(to_remove)
+    def _memory_table(self, storage_id: str, local_table: MemoryTable | None, global_table: MemoryTable | None) -> MemoryTable | None:
+        if storage_id.startswith("global:"):
+            return global_table
+
+        if storage_id.startswith("local_"):
+            selected_agent_id = self.get_selected_agent_id()
+            if not storage_id.startswith(f"local_{selected_agent_id}:"):
+                return None
+            return local_table
+
+        raise ValueError(f"Unknown storage id: {storage_id}")
+
+    def _group_by_table(self,
+                        elements: list[CONTENT_ELEMENT],
+                        local_table: MemoryTable | None,
+                        global_table: MemoryTable | None) -> list[tuple[MemoryTable, list[CONTENT_ELEMENT]]]:
+        grouped = dict[int, tuple[MemoryTable, list[CONTENT_ELEMENT]]]()
+        for each_element in elements:
+            memory_table = self._memory_table(each_element.storage_id, local_table, global_table)
+            if memory_table is None:
+                continue
+            _, table_elements = grouped.setdefault(id(memory_table), (memory_table, list()))
+            table_elements.append(each_element)
+        return list(grouped.values())
 
     def delete_facts(self, facts: list[Fact]) -> None:
-        for each_fact in facts:
-            if each_fact.storage_id.startswith("global:"):
-                memory_table = self.global_facts_table
-
-            elif each_fact.storage_id.startswith("local_"):
-                selected_agent_id = self.get_selected_agent_id()
-                if not each_fact.storage_id.startswith(f"local_{selected_agent_id}"):
-                    continue
-                memory_table = self.local_facts_table
-
-            else:
-                raise ValueError(f"Unknown storage id: {each_fact.storage_id}")
-
-            self._delete_content_element(each_fact, memory_table)
+        for memory_table, table_facts in self._group_by_table(facts, self.local_facts_table, self.global_facts_table):
+            memory_table.delete(table_facts)
 
     def delete_actions(self, actions: list[Action]) -> None:
-        for each_action in actions:
-            if each_action.storage_id.startswith("global:"):
-                memory_table = self.global_actions_table
-
-            elif each_action.storage_id.startswith("local_"):
-                selected_agent_id = self.get_selected_agent_id()
-                if not each_action.storage_id.startswith(f"local_{selected_agent_id}"):
-                    continue
-                memory_table = self.local_actions_table
-
-            else:
-                raise ValueError(f"Unknown storage id: {each_action.storage_id}")
-
-            self._delete_content_element(each_action, memory_table)
-
-    def _upsert_content_element(self,
-                                content_element: ContentElement,
-                                element_to_row: Callable[[CONTENT_ELEMENT], dict[str, str]],
-                                memory_table: nicegui.ui.table) -> None:
-
-        new_row = element_to_row(content_element)
-        for each_row in memory_table.rows:
-            if each_row["id"] == content_element.storage_id:
-                each_row.update(new_row)
-                break
-        else:
-            memory_table.add_rows(new_row)
+        for memory_table, table_actions in self._group_by_table(actions, self.local_actions_table, self.global_actions_table):
+            memory_table.delete(table_actions)
 
     def upsert_facts(self, facts: list[Fact]) -> None:
-        for each_fact in facts:
-            if each_fact.storage_id.startswith("global:"):
-                memory_table = self.global_facts_table
-
-            elif each_fact.storage_id.startswith("local_"):
-                selected_agent_id = self.get_selected_agent_id()
-                if not each_fact.storage_id.startswith(f"local_{selected_agent_id}"):
-                    continue
-                memory_table = self.local_facts_table
-
-            else:
-                raise ValueError(f"Unknown storage id: {each_fact.storage_id}")
-
-            self._upsert_content_element(each_fact, self._fact_to_row, memory_table)
+        for memory_table, table_facts in self._group_by_table(facts, self.local_facts_table, self.global_facts_table):
+            memory_table.upsert(table_facts)
 
     def upsert_actions(self, actions: list[Action]) -> None:
-        for each_action in actions:
-            if each_action.storage_id.startswith("global:"):
-                memory_table = self.global_actions_table
-
-            elif each_action.storage_id.startswith("local_"):
-                selected_agent_id = self.get_selected_agent_id()
-                if not each_action.storage_id.startswith(f"local_{selected_agent_id}"):
-                    continue
-                memory_table = self.local_actions_table
-
-            else:
-                raise ValueError(f"Unknown storage id: {each_action.storage_id}")
-
-            self._upsert_content_element(each_action, self._action_to_row, memory_table)
+        for memory_table, table_actions in self._group_by_table(actions, self.local_actions_table, self.global_actions_table):
+            memory_table.upsert(table_actions)
 
     def upsert_agent(self, agent: Agent) -> None:
         new_row = self._agent_to_row(agent)
@@ -699,13 +668,8 @@ class View:
             first_agent_row = self.agents_table.rows[0]
             self.select_agent(first_agent_row["agent_id"])
 
-    def memory_tables(self, agent_id: str, is_local: bool) -> tuple[Table, Table]:
-        if is_local:
-            facts = self.view_callbacks.get_facts(agent_id=agent_id)
-            actions = self.view_callbacks.get_actions(agent_id=agent_id)
-        else:
-            facts = self.view_callbacks.get_facts()
-            actions = self.view_callbacks.get_actions()
+    def memory_tables(self, agent_id: str | None, is_local: bool) -> tuple[MemoryTable, MemoryTable]:
+        page_agent_id = agent_id if is_local else None
 
         with nicegui.ui.column() as column:
             column.classes("flex flex-col full-height full-width")
@@ -713,32 +677,30 @@ class View:
             with nicegui.ui.row() as row:
                 row.classes("flex flex-1 flex-row full-height full-width")
 
-                move_button, delete_button = None, None
+                move_button, delete_button, idempotent_button = None, None, None
                 with nicegui.ui.scroll_area() as actions_scroll_area:
                     actions_scroll_area.classes("flex-1 full-height")
 
-                    columns = [
-                        {"name": "action", "label": "Action", "field": "action", "required": True, "align": "left", "type": "text"},
-                        {"name": "id", "label": "ID", "field": "id", "required": True, "align": "left", "type": "text"}
-                    ]
-                    rows = [self._action_to_row(each_action) for each_action in actions]
                     # details (remove?, persist?)
-                    actions_table = nicegui.ui.table(columns=columns, rows=rows, row_key="action", selection="multiple")
-                    actions_table.on("selection", lambda: self.update_selected_actions(actions_table.selected, [move_button, delete_button]))
-                    actions_table.style('background-color: #ebf1fa')
+                    actions_table = MemoryTable(
+                        "action",
+                        lambda offset, limit, sort_by, descending, contains: self.view_callbacks.get_action_page(
+                            page_agent_id, offset, limit, sort_by, descending, contains
+                        ),
+                        lambda selected: self.update_selected_actions(selected, [move_button, delete_button, idempotent_button])
+                    )
 
                 with nicegui.ui.scroll_area() as facts_scroll_area:
                     facts_scroll_area.classes("flex-1 full-height")
 
-                    columns = [
-                        {"name": "fact", "label": "Fact", "field": "fact", "required": True, "align": "left", "type": "text"},
-                        {"name": "id", "label": "ID", "field": "id", "required": True, "align": "left", "type": "text"}
-                    ]
-                    rows = [self._fact_to_row(each_fact) for each_fact in facts]
                     # details (remove?, persist?)
-                    facts_table = nicegui.ui.table(columns=columns, rows=rows, row_key="id", selection="multiple")
-                    facts_table.on("selection", lambda: self.update_selected_facts(facts_table.selected, [move_button, delete_button]))
-                    facts_table.style('background-color: #ebf1fa')
+                    facts_table = MemoryTable(
+                        "fact",
+                        lambda offset, limit, sort_by, descending, contains: self.view_callbacks.get_fact_page(
+                            page_agent_id, offset, limit, sort_by, descending, contains
+                        ),
+                        lambda selected: self.update_selected_facts(selected, [move_button, delete_button])
+                    )
 
             with nicegui.ui.row() as button_row:
                 button_row.classes("flex-none justify-around full-width")
@@ -748,4 +710,8 @@ class View:
                 delete_button = nicegui.ui.button("Delete")
                 delete_button.disable()
 
+                # selected actions that only read or can be repeated without harm may be attempted concurrently
+                idempotent_button = nicegui.ui.button("Idempotent", on_click=self.toggle_idempotent_actions)
+                idempotent_button.disable()
+
         return actions_table, facts_table
@@ -1,5 +1,5 @@
 # coding=utf-8
-import openai
+from utils.basic_llm_calls import openai_chat
 
 
 def common_sense(request: str) -> str:
@@ -10,7 +10,9 @@ def common_sense(request: str) -> str:
         {"role": "user", "content": request}
     ]
 
-    response = openai.ChatCompletion.create(
+    response = openai_chat(
+        "common_sense",
+        ack=False,
         model="gpt-3.5-turbo",
         messages=messages
     )
@@ -1,18 +1,14 @@
 # coding=utf-8
-import requests
-from urllib import parse
+from utils.http_cache import HTTP_CACHE
 
 
 def get_scientific_research_articles(query: str) -> list[dict[str, str]]:
-    url = f"https://api.semanticscholar.org/graph/v1/paper/search?query={parse.quote_plus(query)}"
-    # url = f"https://api.semanticscholar.org/graph/v1/paper/search"
-    #params = {
-    #    "query": query,
-    #    "sort": "relevance",
-    #    "limit": 10,
-    #}
-    # response = requests.get(url, params=params)
-    response = requests.get(url)
+    url = "https://api.semanticscholar.org/graph/v1/paper/search"
+    params = {
+        "query": query,
+    }
+    # identical queries are answered from the shared on-disk cache
+    response = HTTP_CACHE.get(url, params=params)
 
     if response.status_code != 200:
         return [{f"Request failed with status code {response.status_code}": response.text}]
@@ -1,11 +1,18 @@
 # coding=utf-8
 import json
-import requests
+from functools import lru_cache
 
+from utils.http_cache import HTTP_CACHE
 
-def get_urls_from_google_query(search_query: str) -> list[str]:
+
+@lru_cache(maxsize=1)
+def _load_config() -> dict[str, str]:
     with open("resources/configs/google.json", mode="r", encoding="utf-8") as f:
-        config = json.load(f)
+        return json.load(f)
+
+
+def get_urls_from_google_query(search_query: str) -> list[str]:
+    config = _load_config()
 
     api_key = config["google_api_key"]
     search_engine_id = config["search_engine_id"]
@@ -16,7 +23,7 @@ def get_urls_from_google_query(search_query: str) -> list[str]:
         "key": api_key,
         "cx": search_engine_id,
     }
-    response = requests.get(url, params=params)
+    response = HTTP_CACHE.get(url, params=params)
 
     if response.status_code != 200:
         return [f"Request failed with status code {response.status_code}: {response.text}"]
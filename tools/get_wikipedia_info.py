@@ -1,6 +1,13 @@
 # coding=utf-8
 import wikipedia
 
+from utils.http_cache import HTTP_CACHE
+
+
+# the library calls `requests.get` for every api request and takes no session. this tool is its only user here, so its
+# module level `requests` is the shared cache for good, nothing is patched per call.
+wikipedia.wikipedia.requests = HTTP_CACHE
+
 
 def get_wikipedia_info(wikipedia_page_name: str) -> str:
     """Retrieves a summary of a specified Wikipedia page.
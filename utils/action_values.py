@@ -0,0 +1,56 @@
+# coding=utf-8
+from __future__ import annotations
+
+from typing import Iterable, Literal
+
+import numpy
+
+
+class ActionRanker:
+    # ranks candidate actions (or tools) for a thought by `similarity + value_weight * value`. the value estimates the
+    # success rate from the success and failure counts, as a draw from the Beta(success + 1, failure + 1) posterior
+    # ("thompson"), or as the posterior mean plus a bonus that shrinks with the number of tries ("ucb"). untried actions
+    # get their chance, failing ones sink, and the similarity keeps the ranking on topic. candidates less similar than
+    # `min_similarity` are never ranked. all candidates are scored at once.
+
+    def __init__(self,
+                 method: Literal["thompson", "ucb"] = "thompson",
+                 value_weight: float = .5, exploration: float = 1.,
+                 min_similarity: float | None = None,
+                 seed: int | None = None) -> None:
+
+        self.method = method
+        self.value_weight = value_weight
+        self.exploration = exploration
+        self.min_similarity = min_similarity
+        self.random = numpy.random.default_rng(seed)
+
+    def values(self, successes: Iterable[int], failures: Iterable[int]) -> numpy.ndarray:
+        successes = numpy.asarray(successes, dtype=numpy.float64)
+        failures = numpy.asarray(failures, dtype=numpy.float64)
+        if self.method == "thompson":
+            return self.random.beta(successes + 1., failures + 1.)
+
+        tries = successes + failures
+        mean = (successes + 1.) / (tries + 2.)
+        return mean + self.exploration * numpy.sqrt(numpy.log(tries.sum() + 1.) / (tries + 1.))
+
+    def scores(self, similarities: Iterable[float], successes: Iterable[int], failures: Iterable[int]) -> numpy.ndarray:
+        similarities = numpy.asarray(similarities, dtype=numpy.float64)
+        scores = similarities + self.value_weight * self.values(successes, failures)
+        if self.min_similarity is not None:
+            scores[similarities < self.min_similarity] = -numpy.inf
+        return scores
+
+    def rank(self,
+             ids: list[str], similarities: Iterable[float], successes: Iterable[int], failures: Iterable[int],
+             exclude: Iterable[str] = (), k: int | None = None) -> list[str]:
+        # ids by descending score, without the excluded ones
+        if len(ids) < 1:
+            return list()
+
+        scores = self.scores(similarities, successes, failures)
+        scores[numpy.isin(numpy.asarray(ids), list(exclude))] = -numpy.inf
+        order = numpy.argsort(-scores, kind="stable")
+        ranked = [ids[i] for i in order.tolist() if numpy.isfinite(scores[i])]
+        return ranked if k is None else ranked[:k]
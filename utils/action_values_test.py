@@ -0,0 +1,31 @@
+import numpy
+
+from utils.action_values import ActionRanker
+
+
+def test_respects_exclusions_and_similarity_floor() -> None:
+    ranker = ActionRanker(method="ucb", min_similarity=.5)
+    ranked = ranker.rank(["a", "b", "c", "d"], [.9, .8, .7, .4], [0, 5, 0, 9], [0, 0, 5, 0], exclude=["a"])
+    # "d" is too dissimilar, "c" keeps failing
+    assert ranked == ["b", "c"]
+    assert ranker.rank(list(), list(), list(), list()) == list()
+
+
+def test_converges_on_the_action_that_works() -> None:
+    # equally similar actions, only "3" tends to succeed
+    ids = [f"{i}" for i in range(8)]
+    rates = numpy.array([.1] * 8)
+    rates[3] = .9
+    successes, failures = numpy.zeros(8, dtype=int), numpy.zeros(8, dtype=int)
+    ranker = ActionRanker(method="thompson", seed=0)
+    random = numpy.random.default_rng(1)
+    choices = list()
+    for _ in range(200):
+        each_choice = int(ranker.rank(ids, [.8] * 8, successes, failures, k=1)[0])
+        choices.append(each_choice)
+        if random.random() < rates[each_choice]:
+            successes[each_choice] += 1
+        else:
+            failures[each_choice] += 1
+
+    assert .9 < choices[-50:].count(3) / 50
@@ -0,0 +1,70 @@
+# coding=utf-8
+import sys
+import time
+
+import numpy
+
+from utils.ann_index import AnnIndex
+
+
+def make_vectors(no_vectors: int, dimensions: int = 384, rank: int = 32, seed: int = 0) -> numpy.ndarray:
+    # unit vectors near a low dimensional subspace, closer to sentence embeddings than uniform noise
+    random = numpy.random.default_rng(seed)
+    basis = random.normal(size=(rank, dimensions)).astype(numpy.float32)
+    vectors = numpy.empty((no_vectors, dimensions), dtype=numpy.float32)
+    for start in range(0, no_vectors, 65_536):
+        end = min(start + 65_536, no_vectors)
+        block = random.normal(size=(end - start, rank)).astype(numpy.float32) @ basis
+        block += .2 * numpy.linalg.norm(block, axis=1, keepdims=True) / numpy.sqrt(dimensions) * random.normal(size=block.shape).astype(numpy.float32)
+        vectors[start:end] = block / numpy.linalg.norm(block, axis=1, keepdims=True)
+    return vectors
+
+
+def brute_force(vectors: numpy.ndarray, queries: numpy.ndarray, k: int) -> tuple[numpy.ndarray, float]:
+    # exact neighbors by squared l2 and the seconds per query
+    norms = (vectors ** 2).sum(axis=1)
+    neighbors = numpy.empty((len(queries), k), dtype=numpy.int64)
+    started = time.perf_counter()
+    for i, each_query in enumerate(queries):
+        distances = norms - 2. * vectors @ each_query
+        best = numpy.argpartition(distances, k)[:k]
+        neighbors[i] = best[numpy.argsort(distances[best])]
+    return neighbors, (time.perf_counter() - started) / len(queries)
+
+
+def benchmark(no_vectors: int, k: int = 10, no_queries: int = 200, m: int = 16, ef_construction: int = 200) -> None:
+    vectors = make_vectors(no_vectors)
+    queries = make_vectors(no_queries, seed=1)
+    true_neighbors, brute_seconds = brute_force(vectors, queries, k)
+    print(f"{no_vectors:,} vectors, brute force {brute_seconds * 1_000:8.2f} ms per query")
+
+    index = AnnIndex(dimensions=vectors.shape[1], m=m, ef_construction=ef_construction, initial_capacity=no_vectors)
+    started = time.perf_counter()
+    for start in range(0, no_vectors, 65_536):
+        index.add([f"{i}" for i in range(start, min(start + 65_536, no_vectors))], vectors[start:start + 65_536])
+    print(f"    built with m={m}, ef_construction={ef_construction} in {time.perf_counter() - started:.1f} s")
+
+    for each_ef in (16, 32, 64, 128, 256):
+        index.set_ef(each_ef)
+        latencies = list()
+        no_found = 0
+        for each_query, each_true in zip(queries, true_neighbors):
+            started = time.perf_counter()
+            (each_ids,), _ = index.search([each_query], k)
+            latencies.append(time.perf_counter() - started)
+            no_found += len(set(int(each_id) for each_id in each_ids) & set(each_true.tolist()))
+
+        recall = no_found / (k * no_queries)
+        mean, p99 = numpy.mean(latencies) * 1_000, numpy.percentile(latencies, 99) * 1_000
+        print(f"    ef={each_ef:<4} recall@{k} {recall:6.3f} {mean:8.3f} ms per query (p99 {p99:.3f} ms) {brute_seconds / numpy.mean(latencies):8.1f}x brute force")
+
+
+def main() -> None:
+    # e.g. `python -m utils.ann_benchmark 10000,100000`. one million 384 dimension vectors need about 4 GB of memory.
+    sizes = [int(each_size) for each_size in sys.argv[1].split(",")] if 1 < len(sys.argv) else [10_000, 100_000, 1_000_000]
+    for each_size in sizes:
+        benchmark(each_size)
+
+
+if __name__ == "__main__":
+    main()
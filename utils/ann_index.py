@@ -0,0 +1,211 @@
+# coding=utf-8
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+from typing import Callable, Literal
+
+import hnswlib
+import numpy
+
+
+class AnnIndex:
+    # approximate nearest neighbors over string ids, an hnsw graph (hnswlib, which chroma ships with).
+    # `m` and `ef_construction` trade build time and memory for graph quality, `ef` trades query latency for recall.
+    # removed ids are only marked, adding them again revives them. with a `directory`, the index is saved there
+    # every `save_every` changes and on `save`, callers sync whatever changed after the last save.
+
+    def __init__(self,
+                 dimensions: int | None = None,
+                 space: Literal["l2", "cosine", "ip"] = "l2",
+                 m: int = 16, ef_construction: int = 200, ef: int = 128,
+                 directory: str | None = None, save_every: int = 1_024,
+                 initial_capacity: int = 1_024) -> None:
+
+        self.dimensions = dimensions
+        self.space = space
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.directory = directory
+        self.save_every = save_every
+        self.initial_capacity = initial_capacity
+
+        self._lock = threading.RLock()
+        self._index = None
+        self._labels = dict[str, int]()
+        self._ids = list[str]()
+        self._removed = set[str]()
+        self._no_changes = 0
+
+        if directory is not None and os.path.exists(os.path.join(directory, "labels.json")):
+            self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._labels) - len(self._removed)
+
+    def __contains__(self, storage_id: str) -> bool:
+        with self._lock:
+            return storage_id in self._labels and storage_id not in self._removed
+
+    def ids(self) -> list[str]:
+        with self._lock:
+            return [each_id for each_id in self._ids if each_id not in self._removed]
+
+    def _new_index(self, capacity: int) -> hnswlib.Index:
+        index = hnswlib.Index(space=self.space, dim=self.dimensions)
+        index.init_index(max_elements=capacity, M=self.m, ef_construction=self.ef_construction)
+        index.set_ef(self.ef)
+        return index
+
+    def set_ef(self, ef: int) -> None:
+        with self._lock:
+            self.ef = ef
+            if self._index is not None:
+                self._index.set_ef(ef)
+
+    def add(self, ids: list[str], vectors: list[list[float]] | numpy.ndarray) -> None:
+        # inserts new ids, replaces the vectors of known ones
+        if len(ids) < 1:
+            return
+
+        vectors = numpy.asarray(vectors, dtype=numpy.float32)
+        with self._lock:
+            if self._index is None:
+                self.dimensions = self.dimensions or vectors.shape[1]
+                self._index = self._new_index(max(self.initial_capacity, len(ids)))
+
+            labels = list()
+            for each_id in ids:
+                each_label = self._labels.get(each_id)
+                if each_label is None:
+                    each_label = len(self._ids)
+                    self._labels[each_id] = each_label
+                    self._ids.append(each_id)
+                self._removed.discard(each_id)
+                labels.append(each_label)
+
+            if self._index.get_max_elements() < len(self._ids):
+                self._index.resize_index(max(len(self._ids), 2 * self._index.get_max_elements()))
+            self._index.add_items(vectors, labels)
+            self._changed(len(ids))
+
+    def vectors(self, ids: list[str]) -> numpy.ndarray:
+        # as stored, the "cosine" space stores them normalized
+        with self._lock:
+            if len(ids) < 1:
+                return numpy.zeros((0, self.dimensions or 0), dtype=numpy.float32)
+            return numpy.asarray(self._index.get_items([self._labels[each_id] for each_id in ids]), dtype=numpy.float32)
+
+    def remove(self, ids: list[str]) -> None:
+        with self._lock:
+            for each_id in ids:
+                if each_id not in self._labels or each_id in self._removed:
+                    continue
+                self._index.mark_deleted(self._labels[each_id])
+                self._removed.add(each_id)
+            self._changed(len(ids))
+
+    def compact(self, min_removed: float = .25) -> bool:
+        # hnswlib only marks removed elements. once they make up `min_removed` of the graph, it is rebuilt without them.
+        with self._lock:
+            if self._index is None or len(self._removed) < max(1., min_removed * len(self._ids)):
+                return False
+
+            live_ids = self.ids()
+            vectors = numpy.asarray(self._index.get_items([self._labels[each_id] for each_id in live_ids]), dtype=numpy.float32)
+            self._index = self._new_index(max(self.initial_capacity, len(live_ids)))
+            self._labels = dict()
+            self._ids = list()
+            self._removed = set()
+            self.add(live_ids, vectors)
+            self.save()
+            return True
+
+    def search(self, vectors: list[list[float]] | numpy.ndarray, k: int) -> tuple[list[list[str]], list[list[float]]]:
+        # ids and distances of the k nearest neighbors for each vector, closest first
+        vectors = numpy.asarray(vectors, dtype=numpy.float32).reshape(-1, self.dimensions or numpy.shape(vectors)[-1])
+        with self._lock:
+            no_live = len(self._labels) - len(self._removed)
+            k = min(k, no_live)
+            if k < 1:
+                return [list() for _ in vectors], [list() for _ in vectors]
+
+            # the graph search needs at least k candidates
+            self._index.set_ef(max(self.ef, k))
+            labels, distances = self._index.knn_query(vectors, k=k)
+            self._index.set_ef(self.ef)
+
+            ids, id_distances = list(), list()
+            for each_labels, each_distances in zip(labels.tolist(), distances.tolist()):
+                # a crash between saving the graph and the labels can leave the graph a few changes ahead
+                each_pairs = [
+                    (self._ids[each_label], each_distance)
+                    for each_label, each_distance in zip(each_labels, each_distances)
+                    if each_label < len(self._ids) and self._ids[each_label] not in self._removed
+                ]
+                ids.append([each_id for each_id, _ in each_pairs])
+                id_distances.append([each_distance for _, each_distance in each_pairs])
+            return ids, id_distances
+
+    def _changed(self, no_changes: int) -> None:
+        self._no_changes += no_changes
+        if self.directory is not None and self.save_every <= self._no_changes:
+            self.save()
+
+    def save(self) -> None:
+        if self.directory is None:
+            return
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            # graph first, labels that are ahead of it could not be searched
+            if self._index is not None:
+                # hnswlib writes in place, so into a temporary file that replaces the old one
+                temp_path = os.path.join(self.directory, "index.bin.tmp")
+                self._index.save_index(temp_path)
+                os.replace(temp_path, os.path.join(self.directory, "index.bin"))
+
+            labels = {
+                "dimensions": self.dimensions, "space": self.space, "m": self.m, "ef_construction": self.ef_construction,
+                "ids": self._ids, "removed": sorted(self._removed),
+            }
+            file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(file_descriptor, mode="w", encoding="utf-8") as file:
+                json.dump(labels, file)
+            os.replace(temp_path, os.path.join(self.directory, "labels.json"))
+            self._no_changes = 0
+
+    def _load(self) -> None:
+        with open(os.path.join(self.directory, "labels.json"), mode="r", encoding="utf-8") as file:
+            labels = json.load(file)
+
+        self.dimensions = labels["dimensions"]
+        self.space = labels["space"]
+        self.m = labels["m"]
+        self.ef_construction = labels["ef_construction"]
+        self._ids = labels["ids"]
+        self._labels = {each_id: each_label for each_label, each_id in enumerate(self._ids)}
+        self._removed = set(labels["removed"])
+
+        index_path = os.path.join(self.directory, "index.bin")
+        if self.dimensions is None or not os.path.exists(index_path):
+            return
+        self._index = hnswlib.Index(space=self.space, dim=self.dimensions)
+        self._index.load_index(index_path, max_elements=max(self.initial_capacity, len(self._ids)))
+        self._index.set_ef(self.ef)
+
+    def sync(self, ids: list[str], get_vectors: Callable[[list[str]], list[list[float]]]) -> None:
+        # makes the index hold exactly `ids`, e.g. after a crash between saves. `get_vectors(missing_ids)` supplies
+        # the vectors of ids the index does not know yet.
+        wanted = set(ids)
+        with self._lock:
+            stale = [each_id for each_id in self.ids() if each_id not in wanted]
+            missing = [each_id for each_id in ids if each_id not in self]
+        if 0 < len(stale):
+            self.remove(stale)
+        if 0 < len(missing):
+            self.add(missing, get_vectors(missing))
@@ -0,0 +1,33 @@
+import numpy
+
+from utils.ann_index import AnnIndex
+
+
+def test_inserts_deletes_and_reloads(tmp_path: any) -> None:
+    vectors = numpy.random.default_rng(0).normal(size=(500, 16)).astype(numpy.float32)
+    ids = [f"{i}" for i in range(len(vectors))]
+    index = AnnIndex(directory=str(tmp_path), ef=100)
+    index.add(ids, vectors)
+    index.remove(["7"])
+
+    (nearest,), (distances,) = index.search([vectors[8]], 3)
+    assert nearest[0] == "8" and distances[0] == 0.
+    assert "7" not in index.search([vectors[7]], 10)[0][0]
+
+    index.save()
+    reloaded = AnnIndex(directory=str(tmp_path))
+    assert len(reloaded) == 499
+    assert reloaded.search([vectors[9]], 1)[0] == [["9"]]
+
+    # revived with a new vector
+    reloaded.add(["7"], vectors[:1])
+    assert reloaded.search([vectors[0]], 2)[0][0] in (["0", "7"], ["7", "0"])
+
+
+def test_search_is_bounded_by_live_elements() -> None:
+    index = AnnIndex()
+    assert index.search([[0., 1.]], 5) == ([[]], [[]])
+
+    index.add(["a", "b"], [[0., 1.], [1., 0.]])
+    index.remove(["b"])
+    assert index.search([[1., 0.]], 5)[0] == [["a"]]
@@ -1,14 +1,24 @@
 # coding=utf-8
+import itertools
 import json
+import threading
 import time
 from traceback import format_exc
+from typing import Generator
 
 import openai
 from openai.openai_object import OpenAIObject
-from sentence_transformers import SentenceTransformer
 import tiktoken
 
+from utils.embedding_backends import get_embedding_backend
+from utils.llm_cache import LLMCache
 from utils.misc import LOGGER
+from utils.rate_limits import RateLimit, RateLimiter
+from utils.tracing import TRACER
+
+
+# deterministic calls only by default, set `similarity_threshold` and `embed` to also match near duplicate prompts
+LLM_CACHE = LLMCache()
 
 
 def openai_chat_deprecated(function_id: str, ack: bool = True, *args: any, **kwargs: any) -> OpenAIObject:
@@ -101,7 +111,8 @@ def truncate_content(content: str, model_name: str, target_tokens: int, truncati
     return ""
 
 
-def truncate_messages(token_limit: int, tokens_reserved: int, messages: list[dict[str, any]], model_name: str) -> list[dict[str, any]]:
+def truncate_messages(token_limit: int, tokens_reserved: int, messages: list[dict[str, any]], model_name: str) -> tuple[list[dict[str, any]], int]:
+    # the messages that fit and their number of tokens
     messages = messages.copy()
     adjusted_token_limit = token_limit - tokens_reserved
     message_tokens = num_tokens_from_messages(messages, model_name)
@@ -117,6 +128,7 @@ def truncate_messages(token_limit: int, tokens_reserved: int, messages: list[dic
                 messages.pop(0)
             else:
                 first_message["content"] = truncated_content
+            message_tokens = num_tokens_from_messages(messages, model_name)
             break
 
         else:
@@ -125,49 +137,215 @@ def truncate_messages(token_limit: int, tokens_reserved: int, messages: list[dic
         message_tokens = num_tokens_from_messages(messages, model_name)
         too_much = max(message_tokens - adjusted_token_limit, 0)
 
-    return messages
+    return messages, message_tokens
+
+
+TOKEN_LIMITS = {  # https://platform.openai.com/docs/models/gpt-4
+    "gpt-3.5-turbo-16k":        16_384,
+    "gpt-3.5-turbo-16k-0613":   16_384,
+    "gpt-4-32k-0613":           32_768,
+    "gpt-4-0613":                8_192,
+    "gpt-4":                     8_192,
+    "gpt-3.5-turbo-0613":        4_096,
+    "gpt-3.5-turbo":             4_096,
+}
+
+
+RATE_LIMITS = {  # https://platform.openai.com/docs/guides/rate-limits, usage tier 1, versions share the limit of their model
+    "gpt-4":                    RateLimit(requests_per_minute=500, tokens_per_minute=10_000),
+    "gpt-3.5-turbo":            RateLimit(requests_per_minute=3_500, tokens_per_minute=60_000),
+    "text-embedding-ada-002":   RateLimit(requests_per_minute=3_000, tokens_per_minute=1_000_000),
+}
+
+# all agents of the process wait their turn here instead of running into the api's limits. `RATE_LIMITER.use_redis`
+# extends it to other processes.
+RATE_LIMITER = RateLimiter(RATE_LIMITS)
+
+
+def _rate_limit_wait(error: Exception) -> float | None:
+    # seconds to back off if the api refused the request for its rate limit. matched by name, the error classes moved
+    # between versions of the openai package.
+    if type(error).__name__ != "RateLimitError":
+        return None
+    headers = getattr(error, "headers", None) or dict()
+    try:
+        return float(headers.get("retry-after", 1.))
+
+    except ValueError:
+        return 1.
+
+
+def _trace_usage(span: any, response: OpenAIObject) -> None:
+    usage = response.get("usage")
+    if usage is not None:
+        span.set(prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
 
 
-def openai_chat(function_id: str, tokens_reserved: int = 1_024, ack: bool = True, *args: any, **kwargs: any) -> OpenAIObject:
-    token_limits = {  # https://platform.openai.com/docs/models/gpt-4
-        "gpt-3.5-turbo-16k":        16_384,
-        "gpt-3.5-turbo-16k-0613":   16_384,
-        "gpt-4-32k-0613":           32_768,
-        "gpt-4-0613":                8_192,
-        "gpt-4":                     8_192,
-        "gpt-3.5-turbo-0613":        4_096,
-        "gpt-3.5-turbo":             4_096,
-    }
+def openai_chat(function_id: str, tokens_reserved: int = 1_024, ack: bool = True, *args: any, use_cache: bool = True, **kwargs: any) -> OpenAIObject:
+    with TRACER.span("llm.chat", function_id=function_id, model=kwargs.get("model")) as span:
+        return _openai_chat(span, function_id, tokens_reserved, ack, use_cache, *args, **kwargs)
 
+
+def _openai_chat(span: any, function_id: str, tokens_reserved: int, ack: bool, use_cache: bool, *args: any, **kwargs: any) -> OpenAIObject:
     messages = kwargs.pop("messages")
     model = kwargs.pop("model")
 
+    use_cache = use_cache and LLM_CACHE.is_cacheable(kwargs)
+    if use_cache:
+        response = LLM_CACHE.lookup(model, messages, **kwargs)
+        if response is not None:
+            LOGGER.info(f"Cached OpenAI API response: {function_id}")
+            span.set(cached=True)
+            return response
+
     while True:
         for i in range(5):
+            admitted_tokens = None
             try:
-                token_limit = token_limits[model]
-                messages_truncated = truncate_messages(token_limit, tokens_reserved, messages, model_name=model)
+                token_limit = TOKEN_LIMITS[model]
+                messages_truncated, prompt_tokens = truncate_messages(token_limit, tokens_reserved, messages, model_name=model)
+                admitted_tokens = RATE_LIMITER.admit(model, prompt_tokens, kwargs.get("max_tokens"))
                 LOGGER.info(f"Calling OpenAI API: {function_id}")
                 response = openai.ChatCompletion.create(*args, messages=messages_truncated, model=model, **kwargs)
+                span.set(retries=i)
+                _trace_usage(span, response)
+                usage = response.get("usage")
+                if usage is not None:
+                    RATE_LIMITER.settle(model, admitted_tokens, usage["prompt_tokens"] + usage["completion_tokens"], completion_tokens=usage["completion_tokens"])
+                if use_cache:
+                    LLM_CACHE.store(model, messages, response, **kwargs)
                 return response
 
             except Exception as e:
                 msg = f"Error {e}. Retrying chat completion {i + 1} of 5"
                 LOGGER.error(msg)
                 LOGGER.debug(format_exc())
-                time.sleep(1)
+                wait = _rate_limit_wait(e)
+                if wait is None:
+                    if admitted_tokens is not None:
+                        # a failed request used none of its tokens, the retry takes them again
+                        RATE_LIMITER.settle(model, admitted_tokens, 0)
+                    time.sleep(1)
+                else:
+                    # the refused request keeps its tokens, the api's budget is spent as well
+                    RATE_LIMITER.back_off(model, wait)
                 continue
 
         if ack:
             input("Chat completion failed. Press enter to retry...")
 
 
+def _open_stream(span: any, function_id: str, tokens_reserved: int, ack: bool, *args: any, **kwargs: any) -> tuple[any, OpenAIObject | None, int, int]:
+    # also returns the prompt tokens and the tokens the request was admitted with
+    messages = kwargs.pop("messages")
+    model = kwargs.pop("model")
+
+    while True:
+        for i in range(5):
+            admitted_tokens = None
+            try:
+                token_limit = TOKEN_LIMITS[model]
+                messages_truncated, prompt_tokens = truncate_messages(token_limit, tokens_reserved, messages, model_name=model)
+                admitted_tokens = RATE_LIMITER.admit(model, prompt_tokens, kwargs.get("max_tokens"))
+                LOGGER.info(f"Streaming OpenAI API: {function_id}")
+                stream = iter(openai.ChatCompletion.create(*args, messages=messages_truncated, model=model, stream=True, **kwargs))
+                # connection and request errors surface with the first chunk
+                first_chunk = next(stream, None)
+                # streamed responses come without usage
+                span.set(retries=i, first_token_latency=span.duration, prompt_tokens=prompt_tokens)
+                return stream, first_chunk, prompt_tokens, admitted_tokens
+
+            except Exception as e:
+                msg = f"Error {e}. Retrying chat completion {i + 1} of 5"
+                LOGGER.error(msg)
+                LOGGER.debug(format_exc())
+                wait = _rate_limit_wait(e)
+                if wait is None:
+                    if admitted_tokens is not None:
+                        RATE_LIMITER.settle(model, admitted_tokens, 0)
+                    time.sleep(1)
+                else:
+                    RATE_LIMITER.back_off(model, wait)
+                continue
+
+        if ack:
+            input("Chat completion failed. Press enter to retry...")
+
+
+def openai_chat_stream(function_id: str,
+                       tokens_reserved: int = 1_024,
+                       ack: bool = True,
+                       *args: any,
+                       use_cache: bool = True,
+                       cancel: threading.Event | None = None,
+                       **kwargs: any) -> Generator[str, None, None]:
+    # yields content deltas as they arrive. stop iterating or set `cancel` to abandon the completion.
+    # only failures before the first delta are retried, later ones are raised to the consumer.
+    kwargs.pop("stream", None)
+    messages = kwargs["messages"]
+    model = kwargs["model"]
+    parameters = {each_key: each_value for each_key, each_value in kwargs.items() if each_key not in ("messages", "model")}
+
+    # the span is not current, the generator runs in the context of whoever iterates it. it ends when the stream is
+    # exhausted, cancelled or abandoned.
+    span = TRACER.start("llm.stream", function_id=function_id, model=model)
+    admitted_tokens = None
+    stream = None
+    content = list()
+    try:
+        use_cache = use_cache and LLM_CACHE.is_cacheable(parameters)
+        if use_cache:
+            response = LLM_CACHE.lookup(model, messages, **parameters)
+            if response is not None:
+                LOGGER.info(f"Cached OpenAI API response: {function_id}")
+                span.set(cached=True)
+                yield response.choices[0]["message"]["content"]
+                return
+
+        stream, first_chunk, prompt_tokens, admitted_tokens = _open_stream(span, function_id, tokens_reserved, ack, *args, **kwargs)
+        chunks = itertools.chain([] if first_chunk is None else [first_chunk], stream)
+
+        finish_reason = None
+        for each_chunk in chunks:
+            if cancel is not None and cancel.is_set():
+                LOGGER.info(f"Cancelled OpenAI API stream: {function_id}")
+                span.set(cancelled=True)
+                return
+
+            each_choice = each_chunk["choices"][0]
+            finish_reason = each_choice.get("finish_reason")
+            each_delta = each_choice["delta"].get("content")
+            if each_delta:
+                content.append(each_delta)
+                # a chunk carries one token
+                span.set(completion_tokens=len(content))
+                yield each_delta
+
+    except Exception as e:
+        span.finish(error=e)
+        raise
+
+    finally:
+        span.finish()
+        if admitted_tokens is not None:
+            # a chunk carries one token, an abandoned stream is charged for what it read
+            RATE_LIMITER.settle(model, admitted_tokens, prompt_tokens + len(content), completion_tokens=len(content))
+        if stream is not None and hasattr(stream, "close"):
+            # a cancelled or abandoned stream releases its connection now, not when it is garbage collected
+            stream.close()
+
+    if use_cache and finish_reason == "stop":
+        # same shape as a non-streamed response, so `openai_chat` can serve it from the cache as well
+        response = OpenAIObject.construct_from({
+            "choices": [{"index": 0, "finish_reason": finish_reason, "message": {"role": "assistant", "content": "".join(content)}}]
+        })
+        LLM_CACHE.store(model, messages, response, **parameters)
+
+
 def _get_embeddings(segments: list[str]) -> list[list[float]]:
-    # model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-    model = SentenceTransformer("ggrn/e5-small-v2")
-    embedding_numpy = model.encode(segments, show_progress_bar=False)
-    embedding = embedding_numpy.tolist()
-    return embedding
+    # resident model, loaded on the first call only
+    # model = "sentence-transformers/all-MiniLM-L6-v2"
+    return get_embedding_backend("sentence-transformers", model_name="ggrn/e5-small-v2")(segments)
 
 
 def get_embeddings(segments: list[str]) -> list[list[float]]:
@@ -178,20 +356,39 @@ def get_embeddings(segments: list[str]) -> list[list[float]]:
     # model = "text-similarity-babbage-001"
     # model = "text-similarity-ada-001"
 
+    with TRACER.span("embed", backend="openai", model=model, no_texts=len(segments)) as span:
+        return _get_openai_embeddings(span, segments, model)
+
+
+def _get_openai_embeddings(span: any, segments: list[str], model: str) -> list[list[float]]:
+    # about four characters per token, the usage of the response corrects the estimate
+    estimated_tokens = sum(len(each_segment) for each_segment in segments) // 4 + 1
     while True:
         for i in range(5):
+            admitted_tokens = None
             try:
+                admitted_tokens = RATE_LIMITER.admit(model, estimated_tokens, completion_tokens=0)
                 result = openai.Embedding.create(
                     input=segments,
                     model=model,
                 )
+                span.set(retries=i)
+                usage = result.get("usage")
+                if usage is not None:
+                    RATE_LIMITER.settle(model, admitted_tokens, usage["total_tokens"])
                 return [record["embedding"] for record in result["data"]]
 
             except Exception as e:
                 msg = f"Error {e}. Retrying embedding {i + 1} of 5"
                 LOGGER.error(format_exc())
                 print(msg)
-                time.sleep(1)
+                wait = _rate_limit_wait(e)
+                if wait is None:
+                    if admitted_tokens is not None:
+                        RATE_LIMITER.settle(model, admitted_tokens, 0)
+                    time.sleep(1)
+                else:
+                    RATE_LIMITER.back_off(model, wait)
                 continue
 
         input("Embedding retrieval failed. Press enter to retry...")
@@ -0,0 +1,67 @@
+# coding=utf-8
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+
+
+class Checkpoint:
+    # append-only journal of records plus a periodic snapshot of the full state. the snapshot remembers the journal
+    # offset it covers, so loading reads the snapshot and only the journal records written after it.
+
+    def __init__(self, directory: str, snapshot_every: int = 10) -> None:
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.journal_path = os.path.join(directory, "journal.jsonl")
+        self.snapshot_path = os.path.join(directory, "snapshot.json")
+        self._records_since_snapshot = 0
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.journal_path) or os.path.isfile(self.snapshot_path)
+
+    def append(self, record: dict[str, any]) -> None:
+        line = json.dumps(record, default=str)
+        with open(self.journal_path, mode="a", encoding="utf-8") as file:
+            file.write(line + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self._records_since_snapshot += 1
+
+    def is_snapshot_due(self) -> bool:
+        return self.snapshot_every <= self._records_since_snapshot
+
+    def snapshot(self, state: dict[str, any]) -> None:
+        offset = os.path.getsize(self.journal_path) if os.path.isfile(self.journal_path) else 0
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(file_descriptor, mode="w", encoding="utf-8") as file:
+            json.dump({"journal_offset": offset, "state": state}, file, default=str)
+            file.flush()
+            os.fsync(file.fileno())
+        # atomic replace, a crash leaves either the old or the new snapshot
+        os.replace(temp_path, self.snapshot_path)
+        self._records_since_snapshot = 0
+
+    def load(self) -> tuple[dict[str, any] | None, list[dict[str, any]]]:
+        # returns the latest snapshot state and the journal records after it
+        state = None
+        offset = 0
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, mode="r", encoding="utf-8") as file:
+                snapshot = json.load(file)
+            state = snapshot["state"]
+            offset = snapshot["journal_offset"]
+
+        records = list()
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, mode="r", encoding="utf-8") as file:
+                file.seek(offset)
+                for each_line in file:
+                    try:
+                        records.append(json.loads(each_line))
+                    except json.JSONDecodeError:
+                        # the last line of a crashed process might be incomplete
+                        break
+
+        self._records_since_snapshot = len(records)
+        return state, records
@@ -0,0 +1,524 @@
+# coding=utf-8
+from __future__ import annotations
+
+import json
+import os
+import re
+import tempfile
+import threading
+from typing import Literal
+
+import numpy
+
+from utils.ann_index import AnnIndex
+
+
+class ProductQuantizer:
+    # splits vectors into `subvectors` parts and replaces each part by the index of its nearest of 256 centroids,
+    # one byte per part. distances to a query are sums over a (subvectors, 256) table (asymmetric distance).
+
+    def __init__(self, dimensions: int, subvectors: int, codebooks: numpy.ndarray | None = None) -> None:
+        if dimensions % subvectors != 0:
+            raise ValueError(f"{dimensions} dimensions cannot be split into {subvectors} subvectors.")
+
+        self.dimensions = dimensions
+        self.subvectors = subvectors
+        self.subdimensions = dimensions // subvectors
+        self.codebooks = codebooks  # (subvectors, 256, subdimensions)
+
+    @staticmethod
+    def default_subvectors(dimensions: int, subdimensions: int = 8) -> int:
+        subvectors = max(1, dimensions // subdimensions)
+        while dimensions % subvectors != 0:
+            subvectors -= 1
+        return subvectors
+
+    def is_trained(self) -> bool:
+        return self.codebooks is not None
+
+    def train(self, sample: numpy.ndarray, iterations: int = 15, seed: int = 0) -> None:
+        random = numpy.random.default_rng(seed)
+        sample = sample.astype(numpy.float32).reshape(len(sample), self.subvectors, self.subdimensions)
+        no_centroids = min(256, len(sample))
+
+        codebooks = numpy.zeros((self.subvectors, 256, self.subdimensions), dtype=numpy.float32)
+        for each_subvector in range(self.subvectors):
+            points = sample[:, each_subvector]
+            centroids = points[random.choice(len(points), size=no_centroids, replace=False)].copy()
+            for _ in range(iterations):
+                assignments = ProductQuantizer._nearest(points, centroids)
+                counts = numpy.bincount(assignments, minlength=no_centroids)
+                sums = numpy.stack([
+                    numpy.bincount(assignments, weights=points[:, each_dimension], minlength=no_centroids)
+                    for each_dimension in range(self.subdimensions)
+                ], axis=1).astype(numpy.float32)
+                is_empty = counts < 1
+                centroids[~is_empty] = sums[~is_empty] / counts[~is_empty, numpy.newaxis]
+                # empty clusters restart from random points
+                centroids[is_empty] = points[random.choice(len(points), size=int(is_empty.sum()))]
+            codebooks[each_subvector, :no_centroids] = centroids
+            codebooks[each_subvector, no_centroids:] = centroids[0]
+
+        self.codebooks = codebooks
+
+    @staticmethod
+    def _nearest(points: numpy.ndarray, centroids: numpy.ndarray) -> numpy.ndarray:
+        distances = (points ** 2).sum(axis=1)[:, numpy.newaxis] - 2. * points @ centroids.T + (centroids ** 2).sum(axis=1)
+        return numpy.argmin(distances, axis=1)
+
+    def encode(self, vectors: numpy.ndarray) -> numpy.ndarray:
+        vectors = vectors.astype(numpy.float32).reshape(len(vectors), self.subvectors, self.subdimensions)
+        codes = numpy.empty((len(vectors), self.subvectors), dtype=numpy.uint8)
+        for each_subvector in range(self.subvectors):
+            codes[:, each_subvector] = ProductQuantizer._nearest(vectors[:, each_subvector], self.codebooks[each_subvector])
+        return codes
+
+    def distance_table(self, query: numpy.ndarray) -> numpy.ndarray:
+        # squared l2 from every part of the query to every centroid of that part
+        parts = query.astype(numpy.float32).reshape(self.subvectors, 1, self.subdimensions)
+        return ((self.codebooks - parts) ** 2).sum(axis=2)
+
+    def distances(self, table: numpy.ndarray, codes: numpy.ndarray) -> numpy.ndarray:
+        # one lookup per column is faster than a single fancy index over the whole code matrix
+        distances = numpy.zeros(len(codes), dtype=numpy.float32)
+        for each_subvector in range(self.subvectors):
+            distances += table[each_subvector, codes[:, each_subvector]]
+        return distances
+
+
+class CompactVectorStore:
+    # vectors as float16 rows of a memory mapped file. with the "int8" (one byte per dimension and a scale per row)
+    # or "pq" codec, compact codes are scanned instead and the best `rerank * n` candidates are re-ranked with their
+    # float16 rows, so results are exact up to float16 rounding. documents and metadata live in an append-only log
+    # and are read from disk for results only.
+    # with an `index`, candidates come from its hnsw graph instead of a scan, at the memory cost of its float32 vectors.
+    # deleted rows stay in the files until `compact` writes the live ones to files of a new generation.
+    # answers the part of chroma's collection interface that the fact memory uses, distances are squared l2.
+
+    _CHUNK_ROWS = 65_536
+    _BLOCK_ROWS = 4_096
+
+    def __init__(self,
+                 directory: str,
+                 codec: Literal["float16", "int8", "pq"] = "float16",
+                 subvectors: int | None = None,
+                 rerank: int = 8,
+                 train_size: int = 8_192,
+                 index: AnnIndex | None = None) -> None:
+
+        self.directory = directory
+        self.codec = codec
+        self.subvectors = subvectors
+        self.rerank = rerank
+        self.train_size = train_size
+        self.index = index
+
+        self._lock = threading.RLock()
+        self.dimensions = None
+        self._capacity = 0
+        self._vectors = None
+        self._norms = None
+        self._codes = None
+        self._scales = None
+        self.quantizer = None
+        self._generation = 0
+
+        # row -> id, id -> row, id -> offset of its latest record
+        self._ids = list[str | None]()
+        self._rows = dict[str, int]()
+        self._offsets = dict[str, int]()
+        self._deleted_rows = set[int]()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        if index is not None:
+            index.sync(
+                [each_id for each_id in self._ids if each_id is not None],
+                lambda missing: self._vectors[[self._rows[each_id] for each_id in missing]].astype(numpy.float32)
+            )
+            index.save()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _data_path(self, name: str, generation: int | None = None) -> str:
+        # files of generation 0 keep their plain names, e.g. "vectors.f16", later ones are "vectors.1.f16"
+        generation = self._generation if generation is None else generation
+        if generation < 1:
+            return self._path(name)
+        stem, _, extension = name.partition(".")
+        return self._path(f"{stem}.{generation}.{extension}")
+
+    def _remove_other_generations(self) -> None:
+        # left behind by a compaction that crashed, or that finished but did not get to clean up
+        pattern = re.compile(r"^(vectors|norms|codes|scales|quantizer|records)(\.(\d+))?\.(f16|f32|u8|i8|npy|jsonl)$")
+        for each_name in os.listdir(self.directory):
+            each_match = pattern.match(each_name)
+            if each_match is not None and int(each_match.group(3) or 0) != self._generation:
+                os.remove(self._path(each_name))
+
+    def _load(self) -> None:
+        try:
+            with open(self._path("meta.json"), mode="r", encoding="utf-8") as file:
+                meta = json.load(file)
+        except FileNotFoundError:
+            return
+
+        self.dimensions = meta["dimensions"]
+        self.codec = meta["codec"]
+        self.subvectors = meta.get("subvectors")
+        self._capacity = meta["capacity"]
+        self._generation = meta.get("generation", 0)
+        self._remove_other_generations()
+        self._open_maps()
+
+        if os.path.exists(self._data_path("quantizer.npy")):
+            codebooks = numpy.load(self._data_path("quantizer.npy"))
+            self.quantizer = ProductQuantizer(self.dimensions, len(codebooks), codebooks=codebooks)
+
+        with open(self._data_path("records.jsonl"), mode="r+b") as file:
+            offset = 0
+            for each_line in file:
+                if not each_line.endswith(b"\n"):
+                    break
+                self._apply(json.loads(each_line), offset)
+                offset += len(each_line)
+            # a record cut off by a crash while writing, the next append starts clean
+            file.truncate(offset)
+
+    def _apply(self, record: dict[str, any], offset: int) -> None:
+        storage_id = record["id"]
+        if record.get("deleted", False):
+            row = self._rows.pop(storage_id, None)
+            self._offsets.pop(storage_id, None)
+            if row is not None:
+                self._ids[row] = None
+                self._deleted_rows.add(row)
+            return
+
+        row = record["row"]
+        while len(self._ids) <= row:
+            self._ids.append(None)
+        self._ids[row] = storage_id
+        self._rows[storage_id] = row
+        self._offsets[storage_id] = offset
+
+    def _save_meta(self) -> None:
+        meta = {
+            "dimensions": self.dimensions, "codec": self.codec, "subvectors": self.subvectors, "capacity": self._capacity,
+            "generation": self._generation,
+        }
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(file_descriptor, mode="w", encoding="utf-8") as file:
+            json.dump(meta, file)
+        os.replace(temp_path, self._path("meta.json"))
+
+    def _open_map(self, name: str, dtype: type, columns: int | None) -> numpy.memmap:
+        path = self._data_path(name)
+        shape = (self._capacity,) if columns is None else (self._capacity, columns)
+        no_bytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+        with open(path, mode="ab") as file:
+            if file.tell() < no_bytes:
+                file.truncate(no_bytes)
+        return numpy.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _open_maps(self) -> None:
+        self._vectors = self._open_map("vectors.f16", numpy.float16, self.dimensions)
+        self._norms = self._open_map("norms.f32", numpy.float32, None)
+        if self.codec == "pq":
+            if self.subvectors is None:
+                self.subvectors = ProductQuantizer.default_subvectors(self.dimensions)
+            self._codes = self._open_map("codes.u8", numpy.uint8, self.subvectors)
+        elif self.codec == "int8":
+            self._codes = self._open_map("codes.i8", numpy.int8, self.dimensions)
+            self._scales = self._open_map("scales.f32", numpy.float32, None)
+
+    def _reserve(self, no_rows: int) -> None:
+        if no_rows <= self._capacity:
+            return
+        for each_map in (self._vectors, self._norms, self._codes, self._scales):
+            if each_map is not None:
+                each_map.flush()
+        self._capacity = max(no_rows, 2 * self._capacity, 1_024)
+        self._open_maps()
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._rows)
+
+    def _write_records(self, records: list[dict[str, any]]) -> None:
+        with open(self._data_path("records.jsonl"), mode="ab") as file:
+            for each_record in records:
+                offset = file.tell()
+                file.write((json.dumps(each_record) + "\n").encode("utf-8"))
+                self._apply(each_record, offset)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _set_vectors(self, rows: list[int], embeddings: list[list[float]]) -> None:
+        vectors = numpy.asarray(embeddings, dtype=numpy.float32)
+        if self.dimensions is None:
+            # the maps are opened by `_reserve`
+            self.dimensions = vectors.shape[1]
+        if vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Expected {self.dimensions} dimensions, got {vectors.shape[1]}.")
+
+        self._reserve(max(rows) + 1)
+        compact = vectors.astype(numpy.float16)
+        self._vectors[rows] = compact
+        self._norms[rows] = (compact.astype(numpy.float32) ** 2).sum(axis=1)
+        if self.quantizer is not None:
+            self._codes[rows] = self.quantizer.encode(vectors)
+        elif self.codec == "int8":
+            scales = numpy.abs(vectors).max(axis=1) / 127.
+            scales[scales == 0.] = 1.
+            self._codes[rows] = numpy.round(vectors / scales[:, numpy.newaxis]).astype(numpy.int8)
+            self._scales[rows] = scales
+
+    def _train_if_due(self) -> None:
+        if self.codec != "pq" or self.quantizer is not None or len(self._ids) < self.train_size:
+            return
+
+        random = numpy.random.default_rng(0)
+        sample_rows = numpy.sort(random.choice(len(self._ids), size=self.train_size, replace=False))
+        self.quantizer = ProductQuantizer(self.dimensions, self.subvectors)
+        self.quantizer.train(self._vectors[sample_rows].astype(numpy.float32))
+        for start in range(0, len(self._ids), CompactVectorStore._CHUNK_ROWS):
+            end = min(start + CompactVectorStore._CHUNK_ROWS, len(self._ids))
+            self._codes[start:end] = self.quantizer.encode(self._vectors[start:end])
+        self._codes.flush()
+        numpy.save(self._data_path("quantizer.npy"), self.quantizer.codebooks)
+
+    def upsert(self,
+               ids: list[str],
+               embeddings: list[list[float]] | None = None,
+               metadatas: list[dict[str, any]] | None = None,
+               documents: list[str] | None = None) -> None:
+
+        with self._lock:
+            old_records = {each_record["id"]: each_record for each_record in self._read_records([each_id for each_id in ids if each_id in self._rows])}
+            new_ids = [each_id for each_id in ids if each_id not in self._rows]
+            if 0 < len(new_ids) and embeddings is None:
+                raise ValueError("New elements need embeddings.")
+
+            new_rows = {each_id: len(self._ids) + i for i, each_id in enumerate(dict.fromkeys(new_ids))}
+            records = list()
+            for i, each_id in enumerate(ids):
+                each_record = dict(old_records.get(each_id, {"id": each_id, "metadata": None, "document": None}))
+                each_record["row"] = new_rows[each_id] if each_id in new_rows else self._rows[each_id]
+                if metadatas is not None:
+                    each_record["metadata"] = metadatas[i]
+                if documents is not None:
+                    each_record["document"] = documents[i]
+                records.append(each_record)
+
+            # vectors before records, a record never points to a row that is not written
+            if embeddings is not None:
+                self._set_vectors([each_record["row"] for each_record in records], embeddings)
+                for each_map in (self._vectors, self._norms, self._codes, self._scales):
+                    if each_map is not None:
+                        each_map.flush()
+                self._save_meta()
+
+            self._write_records(records)
+            if self.index is not None and embeddings is not None:
+                self.index.add(ids, embeddings)
+            self._train_if_due()
+
+    def add(self,
+            ids: list[str],
+            embeddings: list[list[float]],
+            metadatas: list[dict[str, any]] | None = None,
+            documents: list[str] | None = None) -> None:
+
+        with self._lock:
+            existing = [each_id for each_id in ids if each_id in self._rows]
+            if 0 < len(existing):
+                raise ValueError(f"Ids already exist: {existing[:5]}")
+            self.upsert(ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+    def delete(self, ids: list[str]) -> None:
+        with self._lock:
+            self._write_records([{"id": each_id, "deleted": True} for each_id in ids if each_id in self._rows])
+            if self.index is not None:
+                self.index.remove(ids)
+
+    def compact(self, min_deleted: float = .25) -> bool:
+        # once deleted rows make up `min_deleted` of all rows, the live ones are copied into the files of a new generation.
+        # the meta file switches over atomically, a crash before that leaves the current generation as it was.
+        with self._lock:
+            if len(self._deleted_rows) < max(1., min_deleted * len(self._ids)):
+                return False
+
+            live_ids = [each_id for each_id in self._ids if each_id is not None]
+            old_rows = numpy.array([self._rows[each_id] for each_id in live_ids], dtype=numpy.int64)
+            old_maps = self._vectors, self._norms, self._codes, self._scales
+            old_records_path = self._data_path("records.jsonl")
+            old_generation, old_capacity = self._generation, self._capacity
+
+            self._generation += 1
+            self._capacity = max(len(live_ids), 1_024)
+            try:
+                self._open_maps()
+                new_maps = self._vectors, self._norms, self._codes, self._scales
+                for each_old, each_new in zip(old_maps, new_maps):
+                    if each_new is None:
+                        continue
+                    for start in range(0, len(live_ids), CompactVectorStore._CHUNK_ROWS):
+                        end = min(start + CompactVectorStore._CHUNK_ROWS, len(live_ids))
+                        each_new[start:end] = each_old[old_rows[start:end]]
+                    each_new.flush()
+                if self.quantizer is not None:
+                    numpy.save(self._data_path("quantizer.npy"), self.quantizer.codebooks)
+
+                offsets = dict()
+                with open(old_records_path, mode="rb") as old_file, open(self._data_path("records.jsonl"), mode="wb") as new_file:
+                    for each_row, each_id in enumerate(live_ids):
+                        old_file.seek(self._offsets[each_id])
+                        each_record = json.loads(old_file.readline())
+                        each_record["row"] = each_row
+                        offsets[each_id] = new_file.tell()
+                        new_file.write((json.dumps(each_record) + "\n").encode("utf-8"))
+                    new_file.flush()
+                    os.fsync(new_file.fileno())
+
+                self._save_meta()
+
+            except BaseException:
+                self._generation, self._capacity = old_generation, old_capacity
+                self._open_maps()
+                self._remove_other_generations()
+                raise
+
+            self._ids = list(live_ids)
+            self._rows = {each_id: each_row for each_row, each_id in enumerate(live_ids)}
+            self._offsets = offsets
+            self._deleted_rows = set()
+            self._remove_other_generations()
+
+        if self.index is not None:
+            self.index.compact()
+        return True
+
+    def _read_records(self, ids: list[str]) -> list[dict[str, any]]:
+        if len(ids) < 1:
+            return list()
+        records = list()
+        with open(self._data_path("records.jsonl"), mode="rb") as file:
+            for each_id in ids:
+                file.seek(self._offsets[each_id])
+                records.append(json.loads(file.readline()))
+        return records
+
+    def get(self,
+            ids: list[str] | str | None = None, include: list[str] | None = None,
+            limit: int | None = None, offset: int | None = None,
+            **kwargs: any) -> dict[str, any]:
+
+        include = ["metadatas", "documents"] if include is None else include
+        with self._lock:
+            if ids is None:
+                ids = [each_id for each_id in self._ids if each_id is not None]
+                ids = ids[offset or 0:None if limit is None else (offset or 0) + limit]
+            elif isinstance(ids, str):
+                ids = [ids]
+            ids = [each_id for each_id in ids if each_id in self._rows]
+            records = self._read_records(ids)
+            result = {"ids": ids}
+            if "documents" in include:
+                result["documents"] = [each_record["document"] for each_record in records]
+            if "metadatas" in include:
+                result["metadatas"] = [each_record["metadata"] for each_record in records]
+            if "embeddings" in include:
+                result["embeddings"] = self._vectors[[self._rows[each_id] for each_id in ids]].astype(numpy.float32).tolist()
+            return result
+
+    def _scan_chunk(self, query: numpy.ndarray, table: numpy.ndarray | None, start: int, end: int, buffer: numpy.ndarray) -> numpy.ndarray:
+        if table is not None:
+            return self.quantizer.distances(table, self._codes[start:end])
+
+        # converted block by block into one float32 buffer, converting whole chunks costs more than the product
+        products = numpy.empty(end - start, dtype=numpy.float32)
+        rows = self._codes if self.codec == "int8" else self._vectors
+        for block_start in range(start, end, CompactVectorStore._BLOCK_ROWS):
+            block_end = min(block_start + CompactVectorStore._BLOCK_ROWS, end)
+            block = buffer[:block_end - block_start]
+            block[...] = rows[block_start:block_end]
+            products[block_start - start:block_end - start] = block @ query
+        if self.codec == "int8":
+            products *= self._scales[start:end]
+        return self._norms[start:end] - 2. * products
+
+    def _scan(self, query: numpy.ndarray, no_candidates: int) -> numpy.ndarray:
+        # rows of the best candidates by their codes, or by their float16 rows before pq is trained
+        no_rows = len(self._ids)
+        table = None if self.quantizer is None else self.quantizer.distance_table(query)
+        buffer = numpy.empty((CompactVectorStore._BLOCK_ROWS, self.dimensions), dtype=numpy.float32)
+        deleted_rows = numpy.fromiter(self._deleted_rows, dtype=numpy.int64, count=len(self._deleted_rows))
+        best_rows = list()
+        best_distances = list()
+        for start in range(0, no_rows, CompactVectorStore._CHUNK_ROWS):
+            end = min(start + CompactVectorStore._CHUNK_ROWS, no_rows)
+            chunk_distances = self._scan_chunk(query, table, start, end, buffer)
+            chunk_distances[deleted_rows[(start <= deleted_rows) & (deleted_rows < end)] - start] = numpy.inf
+            if no_candidates < len(chunk_distances):
+                chunk_best = numpy.argpartition(chunk_distances, no_candidates)[:no_candidates]
+            else:
+                chunk_best = numpy.arange(len(chunk_distances))
+            best_rows.append(chunk_best + start)
+            best_distances.append(chunk_distances[chunk_best])
+
+        rows = numpy.concatenate(best_rows)
+        distances = numpy.concatenate(best_distances)
+        rows = rows[numpy.isfinite(distances)]
+        distances = distances[numpy.isfinite(distances)]
+        if no_candidates < len(rows):
+            rows = rows[numpy.argpartition(distances, no_candidates)[:no_candidates]]
+        return rows
+
+    def query(self,
+              query_embeddings: list[list[float]] | None = None,
+              n_results: int = 10,
+              include: list[str] | None = None,
+              **kwargs: any) -> dict[str, list[list[any]]]:
+
+        include = ["metadatas", "documents", "distances"] if include is None else include
+        result = {"ids": list(), "distances": list(), "documents": list(), "metadatas": list()}
+        with self._lock:
+            for each_embedding in query_embeddings:
+                query = numpy.asarray(each_embedding, dtype=numpy.float32)
+                ids, distances = list(), list()
+                if 0 < len(self._rows):
+                    is_approximate = self.index is not None or self.quantizer is not None or self.codec == "int8"
+                    no_candidates = n_results * (self.rerank if is_approximate else 1)
+                    if self.index is None:
+                        rows = self._scan(query, no_candidates)
+                    else:
+                        (candidate_ids,), _ = self.index.search([query], no_candidates)
+                        rows = numpy.array([self._rows[each_id] for each_id in candidate_ids if each_id in self._rows], dtype=numpy.int64)
+                    # sorted, reads from the map in file order
+                    rows = numpy.sort(rows)
+
+                    # exact re-rank from the float16 rows of the candidates alone
+                    candidates = self._vectors[rows].astype(numpy.float32)
+                    exact = ((candidates - query) ** 2).sum(axis=1)
+                    order = numpy.argsort(exact)[:n_results]
+                    ids = [self._ids[each_row] for each_row in rows[order]]
+                    distances = exact[order].tolist()
+
+                records = self._read_records(ids)
+                result["ids"].append(ids)
+                result["distances"].append(distances)
+                result["documents"].append([each_record["document"] for each_record in records])
+                result["metadatas"].append([each_record["metadata"] for each_record in records])
+
+        return {each_key: each_value for each_key, each_value in result.items() if each_key == "ids" or each_key in include}
+
+    def memory_bytes(self) -> int:
+        # what a scan touches: the codes, or the float16 rows, plus the norms
+        no_rows = len(self._ids)
+        if self.quantizer is not None:
+            return no_rows * (self.subvectors + 4)
+        if self.codec == "int8":
+            return no_rows * ((self.dimensions or 0) + 8)
+        return no_rows * (2 * (self.dimensions or 0) + 4)
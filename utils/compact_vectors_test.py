@@ -0,0 +1,45 @@
+import numpy
+import pytest
+
+from utils.compact_vectors import CompactVectorStore
+
+
+def _vectors(no_vectors: int, dimensions: int = 32, seed: int = 0) -> numpy.ndarray:
+    random = numpy.random.default_rng(seed)
+    vectors = random.normal(size=(no_vectors, dimensions)).astype(numpy.float32)
+    return vectors / numpy.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("codec", ["float16", "int8", "pq"])
+def test_query_finds_exact_neighbors(tmp_path: any, codec: str) -> None:
+    vectors = _vectors(3_000)
+    store = CompactVectorStore(str(tmp_path), codec=codec, train_size=1_000)
+    ids = [f"{i}" for i in range(len(vectors))]
+    store.add(ids, embeddings=vectors.tolist(), metadatas=[{"index": i} for i in range(len(vectors))], documents=[f"fact {i}" for i in ids])
+
+    result = store.query(query_embeddings=[vectors[42].tolist()], n_results=3)
+    assert result["ids"][0][0] == "42"
+    assert result["documents"][0][0] == "fact 42"
+    assert result["metadatas"][0][0] == {"index": 42}
+    assert result["distances"][0][0] == pytest.approx(0., abs=1e-3)
+    assert result["distances"][0] == sorted(result["distances"][0])
+
+
+def test_changes_survive_reopening(tmp_path: any) -> None:
+    vectors = _vectors(10)
+    store = CompactVectorStore(str(tmp_path))
+    store.add([f"{i}" for i in range(10)], embeddings=vectors.tolist(), metadatas=[{"last_retrieved": -1}] * 10, documents=["fact"] * 10)
+    store.upsert(["3"], metadatas=[{"last_retrieved": 5}])
+    store.delete(["4"])
+
+    # a write that was cut off is ignored
+    with open(tmp_path / "records.jsonl", mode="ab") as file:
+        file.write(b"{\"id\": \"11\", \"ro")
+
+    reopened = CompactVectorStore(str(tmp_path))
+    assert reopened.count() == 9
+    assert reopened.get(["3", "4"]) == {"ids": ["3"], "documents": ["fact"], "metadatas": [{"last_retrieved": 5}]}
+    assert "4" not in reopened.query(query_embeddings=[vectors[4].tolist()], n_results=9)["ids"][0]
+
+    reopened.upsert(["3"], metadatas=[{"last_retrieved": 6}])
+    assert CompactVectorStore(str(tmp_path)).get(["3"])["metadatas"] == [{"last_retrieved": 6}]
@@ -0,0 +1,271 @@
+# coding=utf-8
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import numpy
+from chromadb.utils import embedding_functions
+
+from utils.misc import LOGGER
+from utils.tracing import TRACER
+
+try:
+    import onnxruntime
+    from tokenizers import Tokenizer
+
+except ImportError:
+    onnxruntime = None
+
+try:
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+except ImportError:
+    SentenceTransformer = None
+
+
+class EmbeddingBackend(ABC):
+    # texts in, one vector per text out. same signature as chroma's embedding functions, so backends can be passed
+    # wherever those are expected.
+
+    @abstractmethod
+    def __call__(self, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError()
+
+
+class OpenAIEmbeddings(EmbeddingBackend):
+    def __call__(self, texts: list[str]) -> list[list[float]]:
+        # on call, the remote backend is the only one that needs the openai client
+        from utils.basic_llm_calls import get_embeddings
+        return get_embeddings(texts)
+
+
+class _Request:
+    __slots__ = "texts", "done", "vectors", "error"
+
+    def __init__(self, texts: list[str]) -> None:
+        self.texts = texts
+        self.done = threading.Event()
+        self.vectors = None
+        self.error = None
+
+
+class LocalEmbeddings(EmbeddingBackend):
+    # one resident cpu model per instance, loaded on first use. calls from all threads go through one worker that
+    # collects whatever arrives within `max_wait` seconds into a single run (dynamic batching). texts are sorted by
+    # length before they are cut into batches of `batch_size`, so padding stays short.
+
+    def __init__(self, batch_size: int = 64, max_wait: float = .005, threads: int | None = None, quantize: bool = False) -> None:
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.threads = threads or os.cpu_count() or 1
+        self.quantize = quantize
+
+        self._queue = queue.Queue[_Request]()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        self.no_texts = 0
+        self.no_runs = 0
+
+    @abstractmethod
+    def _load(self) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _encode(self, texts: list[str]) -> numpy.ndarray:
+        # one batch, at most `batch_size` texts of similar length
+        raise NotImplementedError()
+
+    def _encode_all(self, texts: list[str]) -> numpy.ndarray:
+        order = numpy.argsort([len(each_text) for each_text in texts], kind="stable")
+        vectors = None
+        for i in range(0, len(order), self.batch_size):
+            batch_indices = order[i:i + self.batch_size]
+            batch_vectors = self._encode([texts[each_index] for each_index in batch_indices])
+            if vectors is None:
+                vectors = numpy.empty((len(texts), batch_vectors.shape[1]), dtype=numpy.float32)
+            vectors[batch_indices] = batch_vectors
+        return vectors
+
+    def _take_requests(self) -> list[_Request]:
+        requests = [self._queue.get()]
+        no_texts = len(requests[0].texts)
+        deadline = time.monotonic() + self.max_wait
+        while no_texts < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.:
+                break
+            try:
+                each_request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            requests.append(each_request)
+            no_texts += len(each_request.texts)
+        return requests
+
+    def _run(self) -> None:
+        try:
+            self._load()
+            load_error = None
+
+        except Exception as e:
+            LOGGER.error(f"Loading embedding model failed: {e}")
+            load_error = e
+
+        while True:
+            requests = self._take_requests()
+            try:
+                if load_error is not None:
+                    raise load_error
+
+                texts = [each_text for each_request in requests for each_text in each_request.texts]
+                with TRACER.span("embed.batch", backend=type(self).__name__, no_texts=len(texts), no_requests=len(requests)):
+                    vectors = self._encode_all(texts)
+                self.no_texts += len(texts)
+                self.no_runs += 1
+
+                offset = 0
+                for each_request in requests:
+                    each_request.vectors = vectors[offset:offset + len(each_request.texts)].tolist()
+                    offset += len(each_request.texts)
+
+            except Exception as e:
+                for each_request in requests:
+                    each_request.error = e
+
+            finally:
+                for each_request in requests:
+                    each_request.done.set()
+
+    def _ensure_worker(self) -> None:
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def __call__(self, texts: list[str]) -> list[list[float]]:
+        if len(texts) < 1:
+            return list()
+
+        self._ensure_worker()
+        # includes the wait for the batch the texts go into
+        with TRACER.span("embed", backend=type(self).__name__, no_texts=len(texts)):
+            request = _Request(list(texts))
+            self._queue.put(request)
+            request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.vectors
+
+
+class OnnxEmbeddings(LocalEmbeddings):
+    # the onnx export of all-MiniLM-L6-v2 that chroma uses by default, vectors are interchangeable with chroma's.
+    # runs offline once `model_directory` holds model.onnx and tokenizer.json, otherwise chroma downloads them there.
+
+    def __init__(self, model_directory: str | None = None, max_length: int = 256, **kwargs: any) -> None:
+        super().__init__(**kwargs)
+        default_function = embedding_functions.ONNXMiniLM_L6_V2
+        self.is_default_model = model_directory is None
+        self.model_directory = model_directory or os.path.join(default_function.DOWNLOAD_PATH, default_function.EXTRACTED_FOLDER_NAME)
+        self.max_length = max_length
+        self._session = None
+        self._tokenizer = None
+        self._input_names = set()
+
+    def _model_path(self) -> str:
+        model_path = os.path.join(self.model_directory, "model.onnx")
+        if not self.quantize:
+            return model_path
+
+        # dynamic int8 quantization of the weights, once, next to the original
+        quantized_path = os.path.join(self.model_directory, "model_int8.onnx")
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            LOGGER.info(f"Quantizing {model_path} to int8...")
+            quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        return quantized_path
+
+    def _load(self) -> None:
+        if onnxruntime is None:
+            raise ImportError("The onnx backend needs `onnxruntime` and `tokenizers`.")
+
+        if self.is_default_model and not os.path.exists(os.path.join(self.model_directory, "model.onnx")):
+            # the only step that needs network access
+            embedding_functions.ONNXMiniLM_L6_V2()._download_model_if_not_exists()
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        options.log_severity_level = 3
+        self._session = onnxruntime.InferenceSession(self._model_path(), sess_options=options, providers=["CPUExecutionProvider"])
+        self._input_names = {each_input.name for each_input in self._session.get_inputs()}
+
+        self._tokenizer = Tokenizer.from_file(os.path.join(self.model_directory, "tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=self.max_length)
+        # pads to the longest text of each batch, not to `max_length`
+        self._tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+    def _encode(self, texts: list[str]) -> numpy.ndarray:
+        encoded = self._tokenizer.encode_batch(texts)
+        input_ids = numpy.array([each_encoding.ids for each_encoding in encoded], dtype=numpy.int64)
+        attention_mask = numpy.array([each_encoding.attention_mask for each_encoding in encoded], dtype=numpy.int64)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            inputs["token_type_ids"] = numpy.zeros_like(input_ids)
+        last_hidden_state = self._session.run(None, inputs)[0]
+
+        # mean pooling over real tokens, then unit length, like chroma
+        mask = attention_mask[:, :, numpy.newaxis].astype(numpy.float32)
+        vectors = (last_hidden_state * mask).sum(axis=1) / numpy.clip(mask.sum(axis=1), 1e-9, None)
+        norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / numpy.where(norms == 0., 1e-12, norms)).astype(numpy.float32)
+
+
+class SentenceTransformerEmbeddings(LocalEmbeddings):
+    def __init__(self, model_name: str = "ggrn/e5-small-v2", **kwargs: any) -> None:
+        super().__init__(**kwargs)
+        self.model_name = model_name
+        self._model = None
+
+    def _load(self) -> None:
+        if SentenceTransformer is None:
+            raise ImportError("The sentence-transformers backend needs `sentence_transformers`.")
+
+        torch.set_num_threads(self.threads)
+        model = SentenceTransformer(self.model_name, device="cpu")
+        if self.quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self._model = model
+
+    def _encode(self, texts: list[str]) -> numpy.ndarray:
+        return self._model.encode(texts, batch_size=len(texts), show_progress_bar=False, convert_to_numpy=True).astype(numpy.float32)
+
+
+EMBEDDING_BACKENDS = {
+    "openai": OpenAIEmbeddings,
+    "onnx": OnnxEmbeddings,
+    "sentence-transformers": SentenceTransformerEmbeddings,
+}
+
+_backends = dict[tuple, EmbeddingBackend]()
+_backends_lock = threading.Lock()
+
+
+def get_embedding_backend(backend: str | EmbeddingBackend = "onnx", **kwargs: any) -> EmbeddingBackend:
+    # one shared instance per name and settings, models stay resident between calls
+    if isinstance(backend, EmbeddingBackend):
+        return backend
+
+    key = backend, tuple(sorted(kwargs.items()))
+    with _backends_lock:
+        instance = _backends.get(key)
+        if instance is None:
+            instance = EMBEDDING_BACKENDS[backend](**kwargs)
+            _backends[key] = instance
+        return instance
@@ -0,0 +1,59 @@
+# coding=utf-8
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from chromadb.utils import embedding_functions
+
+from utils.embedding_backends import OnnxEmbeddings, SentenceTransformerEmbeddings, onnxruntime, SentenceTransformer
+from utils.misc import segment_text
+
+
+def load_segments(path: str | None, no_segments: int = 2_000, segment_length: int = 300) -> list[str]:
+    if path is None:
+        words = "the agent stores facts about its progress and retrieves the most similar ones for every new step".split()
+        return [" ".join(words[(i + j) % len(words)] for j in range(5 + i % 40)) for i in range(no_segments)]
+
+    with open(path, mode="r", encoding="utf-8", errors="replace") as file:
+        text = file.read()
+    return list(segment_text(text, segment_length=segment_length))[:no_segments]
+
+
+def benchmark(embed: Callable[[list[str]], list[list[float]]], segments: list[str], callers: int = 1, call_size: int = 8) -> float:
+    # segments per second. with several callers, each sends small requests at once, like agents do
+    calls = [segments[i:i + call_size] for i in range(0, len(segments), call_size)]
+    embed(segments[:call_size])  # loads the model
+
+    started = time.perf_counter()
+    if callers < 2:
+        embed(segments)
+    else:
+        with ThreadPoolExecutor(max_workers=callers) as executor:
+            list(executor.map(embed, calls))
+    return len(segments) / (time.perf_counter() - started)
+
+
+def main() -> None:
+    path = sys.argv[1] if 1 < len(sys.argv) else None
+    segments = load_segments(path)
+    print(f"{len(segments)} segments, {sum(len(each_segment) for each_segment in segments) / len(segments):.0f} characters on average")
+
+    methods = dict()
+    if onnxruntime is not None:
+        methods["chroma default (padded to 256)"] = embedding_functions.DefaultEmbeddingFunction()
+        methods["onnx"] = OnnxEmbeddings()
+        methods["onnx, 1 thread"] = OnnxEmbeddings(threads=1)
+        methods["onnx, int8"] = OnnxEmbeddings(quantize=True)
+    if SentenceTransformer is not None:
+        methods["sentence-transformers"] = SentenceTransformerEmbeddings()
+        methods["sentence-transformers, int8"] = SentenceTransformerEmbeddings(quantize=True)
+
+    for each_name, each_method in methods.items():
+        one_call = benchmark(each_method, segments)
+        concurrent = benchmark(each_method, segments, callers=16)
+        print(f"{each_name:<35} {one_call:10,.0f} segments/s in one call {concurrent:10,.0f} segments/s from 16 callers")
+
+
+if __name__ == "__main__":
+    main()
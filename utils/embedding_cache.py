@@ -0,0 +1,64 @@
+# coding=utf-8
+from __future__ import annotations
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from utils.embedding_backends import get_embedding_backend
+
+
+class EmbeddingCache:
+    # wraps an embedding function, only texts that were not embedded before are passed on, in one batch
+
+    def __init__(self, embed: Callable[[list[str]], list[list[float]]], max_entries: int = 16_384) -> None:
+        self.embed = embed
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._vectors = OrderedDict[bytes, list[float]]()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def __call__(self, texts: list[str]) -> list[list[float]]:
+        keys = [EmbeddingCache._key(each_text) for each_text in texts]
+        vectors = dict()
+        with self._lock:
+            for each_key in keys:
+                each_vector = self._vectors.get(each_key)
+                if each_vector is not None:
+                    self._vectors.move_to_end(each_key)
+                    vectors[each_key] = each_vector
+
+        missing = {each_key: each_text for each_key, each_text in zip(keys, texts) if each_key not in vectors}
+        if 0 < len(missing):
+            # outside of the lock, embedding takes long
+            new_vectors = self.embed(list(missing.values()))
+            vectors.update(zip(missing.keys(), new_vectors))
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+            for each_key in missing:
+                self._vectors[each_key] = vectors[each_key]
+            while self.max_entries < len(self._vectors):
+                self._vectors.popitem(last=False)
+
+        return [vectors[each_key] for each_key in keys]
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_embedding_cache() -> EmbeddingCache:
+    # chroma's default model, the one collections created without an embedding function use for their queries
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache(get_embedding_backend("onnx"))
+        return _default_cache
@@ -0,0 +1,313 @@
+# coding=utf-8
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Callable, Generator
+
+import numpy
+
+from utils.ann_index import AnnIndex
+from utils.compact_vectors import CompactVectorStore
+from utils.misc import LOGGER
+
+
+class FactArchive:
+    # facts that left the memory, as gzip compressed json lines. every append is a gzip member of its own,
+    # concatenated members read as one stream.
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def append(self, records: list[dict[str, any]]) -> None:
+        if len(records) < 1:
+            return
+
+        directory = os.path.dirname(self.path)
+        if 0 < len(directory):
+            os.makedirs(directory, exist_ok=True)
+        lines = "".join(json.dumps(each_record) + "\n" for each_record in records)
+        with open(self.path, mode="ab") as file:
+            file.write(gzip.compress(lines.encode("utf-8")))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def read(self, offset: int = 0) -> tuple[list[dict[str, any]], int]:
+        # the records appended after byte `offset` and the offset after the last complete append, to continue from
+        if not os.path.exists(self.path) or os.path.getsize(self.path) <= offset:
+            return list(), offset
+
+        with open(self.path, mode="rb") as file:
+            file.seek(offset)
+            data = file.read()
+
+        records = list()
+        while 0 < len(data):
+            decompressor = zlib.decompressobj(wbits=31)
+            try:
+                lines = decompressor.decompress(data)
+
+            except zlib.error:
+                LOGGER.warning(f"Fact archive '{self.path}' has a corrupt record after byte {offset}.")
+                break
+
+            if not decompressor.eof:
+                # still being appended, or cut off by a crash
+                break
+            offset += len(data) - len(decompressor.unused_data)
+            data = decompressor.unused_data
+            records.extend(json.loads(each_line) for each_line in lines.decode("utf-8").splitlines() if 0 < len(each_line))
+        return records, offset
+
+    def __iter__(self) -> Generator[dict[str, any], None, None]:
+        if not os.path.exists(self.path):
+            return
+
+        with gzip.open(self.path, mode="rt", encoding="utf-8") as file:
+            try:
+                for each_line in file:
+                    yield json.loads(each_line)
+
+            except (EOFError, zlib.error, json.JSONDecodeError):
+                # an append cut off by a crash, everything before it is intact
+                LOGGER.warning(f"Fact archive '{self.path}' ends with an incomplete record.")
+
+
+@dataclasses.dataclass
+class Consolidation:
+    # survivors whose document, metadata, or embedding changed, all removed facts, and the survivors duplicates were merged into
+    updated: dict[str, tuple[str, dict[str, any], list[float]]]
+    removed: dict[str, tuple[str, dict[str, any]]]
+    merged_into: dict[str, str]
+
+
+class FactConsolidator:
+    # one pass over a fact collection, anything with chroma's collection interface (a chroma collection, a CompactVectorStore).
+    # near duplicates, facts within cosine `similarity` of each other, collapse into the most recently used one, or into a
+    # text written by `merge` from all of them. facts not used for `cold_after` seconds, and the least recently used ones
+    # beyond `max_facts`, are archived. merged duplicates are archived as well, nothing is lost.
+    # the last use of a fact is its `retrieved_key` metadata, or its `created_key` metadata if it was never retrieved.
+
+    def __init__(self,
+                 archive: FactArchive,
+                 similarity: float = .95, neighbors: int = 8,
+                 merge: Callable[[list[str]], str] | None = None,
+                 embed: Callable[[list[str]], list[list[float]]] | None = None,
+                 cold_after: float | None = 30 * 24 * 60 * 60,
+                 max_facts: int | None = None,
+                 retrieved_key: str = "last_retrieved", created_key: str = "created",
+                 page_size: int = 4_096) -> None:
+
+        if merge is not None and embed is None:
+            raise ValueError("Merged facts need `embed` for their new embeddings.")
+
+        self.archive = archive
+        self.similarity = similarity
+        self.neighbors = neighbors
+        self.merge = merge
+        self.embed = embed
+        self.cold_after = cold_after
+        self.max_facts = max_facts
+        self.retrieved_key = retrieved_key
+        self.created_key = created_key
+        self.page_size = page_size
+
+    def _last_used(self, metadata: dict[str, any]) -> float:
+        # -inf if unknown, such facts are never cold but the first to go beyond `max_facts`
+        retrieved = metadata.get(self.retrieved_key)
+        if retrieved is not None and 0 < retrieved:
+            return float(retrieved)
+        created = metadata.get(self.created_key)
+        if created is not None and 0 < created:
+            return float(created)
+        return -numpy.inf
+
+    def _read(self, collection: any) -> tuple[list[str], list[dict[str, any]], numpy.ndarray]:
+        # ids, metadatas, and float32 embeddings, page by page so that only one page exists as python lists
+        no_facts = collection.count()
+        ids, metadatas = list(), list()
+        vectors = None
+        for offset in range(0, no_facts, self.page_size):
+            page = collection.get(include=["metadatas", "embeddings"], limit=self.page_size, offset=offset)
+            if len(page["ids"]) < 1:
+                break
+            page_vectors = numpy.asarray(page["embeddings"], dtype=numpy.float32)
+            if vectors is None:
+                vectors = numpy.empty((no_facts, page_vectors.shape[1]), dtype=numpy.float32)
+            # facts written since `count` are left for the next pass
+            page_vectors = page_vectors[:no_facts - len(ids)]
+            vectors[len(ids):len(ids) + len(page_vectors)] = page_vectors
+            ids.extend(page["ids"][:len(page_vectors)])
+            metadatas.extend(each_metadata or dict() for each_metadata in page["metadatas"][:len(page_vectors)])
+
+        if vectors is None:
+            return list(), list(), numpy.empty((0, 0), dtype=numpy.float32)
+        return ids, metadatas, vectors[:len(ids)]
+
+    def _clusters(self, vectors: numpy.ndarray, order: numpy.ndarray) -> list[list[int]]:
+        # greedy and without chaining: in `order`, every fact that is not taken yet takes its neighbors that are not taken
+        # yet. the first member of a cluster is the one it collapses into.
+        index = AnnIndex(space="cosine", initial_capacity=len(vectors))
+        index.add([f"{i}" for i in range(len(vectors))], vectors)
+        max_distance = 1. - self.similarity
+
+        neighbors = list()
+        for start in range(0, len(vectors), self.page_size):
+            ids, distances = index.search(vectors[start:start + self.page_size], self.neighbors + 1)
+            for each_ids, each_distances in zip(ids, distances):
+                neighbors.append([int(each_id) for each_id, each_distance in zip(each_ids, each_distances) if each_distance <= max_distance])
+
+        is_taken = numpy.zeros(len(vectors), dtype=bool)
+        clusters = list()
+        for each_row in order.tolist():
+            if is_taken[each_row]:
+                continue
+            is_taken[each_row] = True
+            members = [each_row]
+            for each_neighbor in neighbors[each_row]:
+                if not is_taken[each_neighbor]:
+                    is_taken[each_neighbor] = True
+                    members.append(each_neighbor)
+            if 1 < len(members):
+                clusters.append(members)
+        return clusters
+
+    def _merged_metadata(self, metadatas: list[dict[str, any]]) -> dict[str, any]:
+        # the first one's, last retrieved when any of them was, created when the first of them was
+        metadata = dict(metadatas[0])
+        retrieved = [each_metadata[self.retrieved_key] for each_metadata in metadatas if each_metadata.get(self.retrieved_key) is not None]
+        if 0 < len(retrieved):
+            metadata[self.retrieved_key] = max(retrieved)
+        created = [each_metadata[self.created_key] for each_metadata in metadatas if each_metadata.get(self.created_key) is not None]
+        if 0 < len(created):
+            metadata[self.created_key] = min(created)
+        return metadata
+
+    def run(self, collection: any, lock: threading.Lock | None = None) -> Consolidation:
+        # `lock` is held while writing only. facts that change while the pass runs are left for the next one.
+        consolidation = Consolidation(dict(), dict(), dict())
+        ids, metadatas, vectors = self._read(collection)
+        if len(ids) < 1:
+            return consolidation
+
+        now = time.time()
+        last_used = numpy.array([self._last_used(each_metadata) for each_metadata in metadatas])
+        order = numpy.argsort(-last_used, kind="stable")
+        clusters = self._clusters(vectors, order)
+
+        # survivors, with the last use of their cluster
+        is_merged = numpy.zeros(len(ids), dtype=bool)
+        for each_cluster in clusters:
+            is_merged[each_cluster[1:]] = True
+            last_used[each_cluster[0]] = last_used[each_cluster].max()
+
+        is_archived = numpy.zeros(len(ids), dtype=bool)
+        if self.cold_after is not None:
+            is_archived = ~is_merged & numpy.isfinite(last_used) & (last_used < now - self.cold_after)
+        if self.max_facts is not None:
+            survivors = numpy.flatnonzero(~is_merged & ~is_archived)
+            if self.max_facts < len(survivors):
+                by_use = survivors[numpy.argsort(last_used[survivors], kind="stable")]
+                is_archived[by_use[:len(survivors) - self.max_facts]] = True
+
+        affected = sorted(set(numpy.flatnonzero(is_archived).tolist()) | {each_row for each_cluster in clusters for each_row in each_cluster})
+        if len(affected) < 1:
+            return consolidation
+
+        rows = {ids[each_row]: each_row for each_row in affected}
+        current = collection.get(ids=[ids[each_row] for each_row in affected], include=["metadatas", "documents"])
+        documents = dict(zip(current["ids"], current["documents"]))
+
+        merged = dict()
+        if self.merge is not None:
+            for each_cluster in clusters:
+                if all(ids[each_row] in documents for each_row in each_cluster):
+                    each_document = self.merge([documents[ids[each_row]] for each_row in each_cluster])
+                    merged[each_cluster[0]] = each_document, self.embed([each_document])[0]
+
+        with lock or contextlib.nullcontext():
+            # unchanged since they were read
+            current = collection.get(ids=list(rows), include=["metadatas", "documents"])
+            unchanged = {
+                rows[each_id]
+                for each_id, each_metadata, each_document in zip(current["ids"], current["metadatas"], current["documents"])
+                if (each_metadata or dict()) == metadatas[rows[each_id]] and each_document == documents.get(each_id)
+            }
+
+            records = list()
+            for each_cluster in clusters:
+                if not all(each_row in unchanged for each_row in each_cluster):
+                    continue
+                keeper = ids[each_cluster[0]]
+                document, embedding = merged.get(each_cluster[0], (documents[keeper], vectors[each_cluster[0]].tolist()))
+                metadata = self._merged_metadata([metadatas[each_row] for each_row in each_cluster])
+                for each_row in each_cluster[1:]:
+                    consolidation.removed[ids[each_row]] = documents[ids[each_row]], metadatas[each_row]
+                    consolidation.merged_into[ids[each_row]] = keeper
+                if is_archived[each_cluster[0]]:
+                    consolidation.removed[keeper] = document, metadata
+                else:
+                    consolidation.updated[keeper] = document, metadata, embedding
+
+            for each_row in numpy.flatnonzero(is_archived).tolist():
+                if each_row in unchanged and ids[each_row] not in consolidation.removed:
+                    consolidation.removed[ids[each_row]] = documents[ids[each_row]], metadatas[each_row]
+
+            for each_id, (each_document, each_metadata) in consolidation.removed.items():
+                each_record = {
+                    "id": each_id, "document": each_document, "metadata": each_metadata,
+                    "embedding": numpy.round(vectors[rows[each_id]], 5).tolist(), "archived": now,
+                }
+                if each_id in consolidation.merged_into:
+                    each_record["merged_into"] = consolidation.merged_into[each_id]
+                records.append(each_record)
+
+            # archived before they are removed, a crash can archive a fact twice but never lose it
+            self.archive.append(records)
+            if 0 < len(consolidation.updated):
+                updated_ids = list(consolidation.updated)
+                collection.upsert(
+                    updated_ids,
+                    embeddings=[consolidation.updated[each_id][2] for each_id in updated_ids],
+                    metadatas=[consolidation.updated[each_id][1] for each_id in updated_ids],
+                    documents=[consolidation.updated[each_id][0] for each_id in updated_ids]
+                )
+            if 0 < len(consolidation.removed):
+                collection.delete(ids=list(consolidation.removed))
+            if isinstance(collection, CompactVectorStore):
+                collection.compact()
+
+        no_merged = len(consolidation.merged_into)
+        LOGGER.info(f"Consolidated {len(ids)} facts: {no_merged} duplicates merged, {len(consolidation.removed) - no_merged} archived.")
+        return consolidation
+
+
+class PeriodicJob:
+    # calls `job` every `interval` seconds on a daemon thread until stopped. failures are logged, the next run retries.
+
+    def __init__(self, job: Callable[[], any], interval: float, name: str = "periodic job") -> None:
+        self.job = job
+        self.interval = interval
+        self.name = name
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.job()
+
+            except Exception as e:
+                LOGGER.error(f"Running {self.name} failed: {e}")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
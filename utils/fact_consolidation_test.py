@@ -0,0 +1,68 @@
+import numpy
+
+from utils.compact_vectors import CompactVectorStore
+from utils.fact_consolidation import FactArchive, FactConsolidator
+
+
+def _vectors(no_vectors: int, dimensions: int = 32, seed: int = 0) -> numpy.ndarray:
+    random = numpy.random.default_rng(seed)
+    vectors = random.normal(size=(no_vectors, dimensions)).astype(numpy.float32)
+    return vectors / numpy.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_merges_duplicates_and_archives_cold_facts(tmp_path: any) -> None:
+    vectors = _vectors(20)
+    # 20 and 21 nearly repeat 0, 22 repeats 1
+    duplicates = vectors[[0, 0, 1]] + .01 * _vectors(3, seed=1)
+    vectors = numpy.concatenate([vectors, duplicates])
+    store = CompactVectorStore(str(tmp_path / "facts"))
+    ids = [f"{i}" for i in range(len(vectors))]
+    metadatas = [{"last_retrieved": -1, "created": 1_000} for _ in ids]
+    metadatas[21] = {"last_retrieved": 5_000, "created": 2_000}
+    metadatas[1] = {"last_retrieved": 4_000, "created": 500}
+    metadatas[5] = {"last_retrieved": -1, "created": 10}
+    store.add(ids, embeddings=vectors.tolist(), metadatas=metadatas, documents=[f"fact {i}" for i in ids])
+
+    archive = FactArchive(str(tmp_path / "archive.jsonl.gz"))
+    consolidator = FactConsolidator(archive, cold_after=None, max_facts=17)
+    consolidation = consolidator.run(store)
+
+    # duplicates collapse into the most recently retrieved fact, with the earliest creation
+    assert consolidation.merged_into == {"0": "21", "20": "21", "22": "1"}
+    assert store.get(["21"])["metadatas"] == [{"last_retrieved": 5_000, "created": 1_000}]
+    assert store.get(["1"])["metadatas"] == [{"last_retrieved": 4_000, "created": 500}]
+    # the least recently used of the rest go beyond `max_facts`
+    assert set(consolidation.removed) - set(consolidation.merged_into) == {"5", "2", "3"}
+    assert store.count() == 17
+
+    archived = {each_record["id"]: each_record for each_record in archive}
+    assert set(archived) == {"0", "20", "22", "5", "2", "3"}
+    assert archived["20"]["merged_into"] == "21" and archived["5"]["document"] == "fact 5"
+
+    # deleted rows were compacted away, the store still answers
+    assert len(store._ids) == 17
+    assert store.query(query_embeddings=[vectors[0].tolist()], n_results=1)["ids"] == [["21"]]
+    assert CompactVectorStore(str(tmp_path / "facts")).get(["21"])["documents"] == ["fact 21"]
+
+
+def test_leaves_facts_that_changed_during_the_pass(tmp_path: any) -> None:
+    vectors = _vectors(2)
+    store = CompactVectorStore(str(tmp_path / "facts"))
+    store.add(["0", "1"], embeddings=vectors.tolist(), metadatas=[{"created": 1}, {"created": 1}], documents=["old", "older"])
+
+    merge_calls = list()
+
+    def merge(facts: list[str]) -> str:
+        # retrieved while the merge runs
+        merge_calls.append(facts)
+        store.upsert(["0"], metadatas=[{"created": 1, "last_retrieved": 2}])
+        return "merged"
+
+    consolidator = FactConsolidator(FactArchive(str(tmp_path / "archive.jsonl.gz")), merge=merge, embed=lambda texts: vectors[:1].tolist(), cold_after=1.)
+    store.add(["2"], embeddings=vectors[:1].tolist(), metadatas=[{"created": 1}], documents=["copy"])
+    consolidation = consolidator.run(store)
+
+    assert len(merge_calls) == 1
+    # the cluster of 0 and 2 changed, 1 is archived as cold
+    assert list(consolidation.removed) == ["1"]
+    assert store.get(include=["documents"])["documents"] == ["old", "copy"]
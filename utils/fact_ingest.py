@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import annotations
+
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable
+
+import numpy
+from chromadb.api.models.Collection import Collection
+
+from utils.misc import LOGGER
+
+
+class FactIngest:
+    # facts get their ids on submission and are written by a background thread. everything that queued up while the
+    # previous write was running goes into the next one, as one chroma batch and one journal append (group commit).
+    # until a fact is written, `nearest` serves it from memory.
+
+    def __init__(self,
+                 collection: Collection,
+                 journal_path: str,
+                 embed: Callable[[list[str]], list[list[float]]],
+                 max_batch: int = 256) -> None:
+
+        self.collection = collection
+        self.journal_path = journal_path
+        self.embed = embed
+        self.max_batch = max_batch
+
+        self._id_lock = threading.Lock()
+        # not the count, consolidation removes facts
+        stored_ids = collection.get(include=[])["ids"]
+        self._next_id = max((int(each_id) for each_id in stored_ids if each_id.isdigit()), default=-1) + 1
+        self._pending = dict[int, str]()
+
+        self._queue = queue.Queue[tuple[int, str] | None]()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, facts: list[str]) -> list[str]:
+        # returns immediately with the ids the facts will be stored under
+        with self._id_lock:
+            first_id = self._next_id
+            self._next_id += len(facts)
+            for i, each_fact in enumerate(facts):
+                self._pending[first_id + i] = each_fact
+
+        for i, each_fact in enumerate(facts):
+            self._queue.put((first_id + i, each_fact))
+        return [f"{first_id + i}" for i in range(len(facts))]
+
+    def pending(self) -> dict[str, str]:
+        with self._id_lock:
+            return {f"{each_index}": each_fact for each_index, each_fact in self._pending.items()}
+
+    def nearest(self, embedding: list[float], n: int) -> list[tuple[float, str, str]]:
+        # (distance, id, fact) of the n closest facts that are not written yet, squared l2 like chroma's default space.
+        # `embed` is expected to cache, the writer gets these vectors for free then.
+        pending = self.pending()
+        if len(pending) < 1:
+            return list()
+
+        ids = list(pending)
+        matrix = numpy.array(self.embed([pending[each_id] for each_id in ids]), dtype=numpy.float32)
+        distances = ((matrix - numpy.array(embedding, dtype=numpy.float32)) ** 2).sum(axis=1)
+        best = numpy.argsort(distances)[:n]
+        return [(float(distances[i]), ids[i], pending[ids[i]]) for i in best]
+
+    def _take_batch(self) -> tuple[list[tuple[int, str]], bool]:
+        first = self._queue.get()
+        if first is None:
+            return list(), True
+
+        batch = [first]
+        while len(batch) < self.max_batch:
+            try:
+                each_item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if each_item is None:
+                return batch, True
+            batch.append(each_item)
+
+        return batch, False
+
+    def _write(self, batch: list[tuple[int, str]]) -> None:
+        indices = [each_index for each_index, _ in batch]
+        documents = [each_fact for _, each_fact in batch]
+        now = round(time.time())
+
+        # journal first, chroma can be rebuilt from it
+        lines = "".join(json.dumps({"content": each_fact, "index": each_index}) + "\n" for each_index, each_fact in batch)
+        with open(self.journal_path, mode="a", encoding="utf-8") as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.collection.add(
+            [f"{each_index}" for each_index in indices],
+            embeddings=self.embed(documents),
+            metadatas=[{"index": each_index, "last_retrieved": -1, "created": now} for each_index in indices],
+            documents=documents
+        )
+
+        with self._id_lock:
+            for each_index in indices:
+                self._pending.pop(each_index, None)
+
+    def _run(self) -> None:
+        is_closed = False
+        while not is_closed:
+            batch, is_closed = self._take_batch()
+            try:
+                if 0 < len(batch):
+                    self._write(batch)
+
+            except Exception as e:
+                LOGGER.error(f"Writing {len(batch)} facts failed: {e}")
+
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+        # the closing sentinel
+        self._queue.task_done()
+
+    def flush(self) -> None:
+        # blocks until every submitted fact is written
+        self._queue.join()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._worker.join()
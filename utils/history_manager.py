@@ -0,0 +1,125 @@
+# coding=utf-8
+from __future__ import annotations
+
+import json
+import threading
+from concurrent import futures
+from typing import Callable
+
+from utils.basic_llm_calls import num_tokens_from_messages
+from utils.misc import LOGGER
+from utils.prompts import HISTORY_SUMMARIZER
+
+
+def _message_text(message: dict[str, any]) -> str:
+    content = message.get("content")
+    if content is None and "function_call" in message:
+        content = json.dumps(message["function_call"])
+    return f"{message['role']}: {content}"
+
+
+class HistoryManager:
+    # message history as `prefix + summary + recent`. the prefix is pinned and never changes, so every prompt starts with
+    # the same tokens. once the history exceeds `token_budget`, everything but the last `keep_recent` messages is folded
+    # into the summary in the background. until the fold lands, the oldest unfolded messages are left out if necessary.
+
+    def __init__(self,
+                 prefix: list[dict[str, any]],
+                 summarize: Callable[[str], str],
+                 model: str = "gpt-4-0613",
+                 token_budget: int = 4_096,
+                 keep_recent: int = 4,
+                 _summary: str | None = None,
+                 _recent: list[dict[str, any]] | None = None) -> None:
+
+        self.prefix = prefix
+        self.summarize = summarize
+        self.model = model
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+
+        self.summary = _summary
+        self.recent = list(_recent or list())
+
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._folding = list[dict[str, any]]()
+        self._fold = None
+
+    def _summary_message(self) -> list[dict[str, any]]:
+        if self.summary is None:
+            return list()
+        return [{"role": "system", "content": f"Summary of the conversation so far:\n{self.summary}"}]
+
+    def _count(self, messages: list[dict[str, any]]) -> int:
+        return num_tokens_from_messages(messages, model=self.model)
+
+    def _apply_fold(self) -> None:
+        if self._fold is None or not self._fold.done():
+            return
+
+        try:
+            self.summary = self._fold.result()
+            self._folding.clear()
+
+        except Exception as e:
+            # unfolded messages are put back and folded with the next batch
+            LOGGER.error(f"Summarizing message history failed: {e}")
+            self.recent[:0] = self._folding
+            self._folding.clear()
+
+        self._fold = None
+
+    def _start_fold(self) -> None:
+        if self._fold is not None or len(self.recent) <= self.keep_recent:
+            return
+
+        self._folding = self.recent[:-self.keep_recent]
+        del self.recent[:-self.keep_recent]
+
+        previous_summary = self.summary or "No summary yet."
+        messages_text = "\n\n".join(_message_text(each_message) for each_message in self._folding)
+        prompt = HISTORY_SUMMARIZER.format(summary=previous_summary, messages=messages_text)
+        self._fold = self._executor.submit(self.summarize, prompt)
+
+    def extend(self, messages: list[dict[str, any]]) -> None:
+        with self._lock:
+            self._apply_fold()
+            self.recent.extend(messages)
+            if self.token_budget < self._count(self._messages()):
+                self._start_fold()
+
+    def _messages(self) -> list[dict[str, any]]:
+        return self.prefix + self._summary_message() + self._folding + self.recent
+
+    def messages(self) -> list[dict[str, any]]:
+        # a fresh list, callers may append to it
+        with self._lock:
+            self._apply_fold()
+            pinned = self.prefix + self._summary_message()
+            unfolded = self._folding + self.recent
+
+            budget = self.token_budget - self._count(pinned)
+            while self.keep_recent < len(unfolded) and budget < self._count(unfolded):
+                unfolded.pop(0)
+
+            return pinned + unfolded
+
+    def to_dict(self) -> dict[str, any]:
+        # messages that are still being folded are saved as unfolded
+        with self._lock:
+            return {"summary": self.summary, "recent": self._folding + self.recent}
+
+    def restore(self, history_dict: dict[str, any]) -> None:
+        with self._lock:
+            self.summary = history_dict["summary"]
+            self.recent = list(history_dict["recent"])
+            self._folding.clear()
+
+    def wait(self) -> None:
+        # blocks until a running fold is applied
+        fold = self._fold
+        if fold is not None:
+            futures.wait([fold])
+        with self._lock:
+            self._apply_fold()
@@ -0,0 +1,90 @@
+# coding=utf-8
+from typing import Generator
+
+from bs4 import BeautifulSoup, NavigableString, Tag
+
+try:
+    import lxml.html
+    from lxml import etree
+
+except ImportError:
+    lxml = None
+
+
+PRUNED_TAGS = ("head", "script", "style", "noscript", "template", "svg", "iframe")
+BOILERPLATE_TAGS = ("nav", "header", "footer", "aside", "form")
+BOILERPLATE_ROLES = ("navigation", "banner", "contentinfo", "search")
+
+_BOILERPLATE_XPATH = "//*[" + " or ".join(
+    [f"self::{each_tag}" for each_tag in BOILERPLATE_TAGS] +
+    [f"@role='{each_role}'" for each_role in BOILERPLATE_ROLES]
+) + "]"
+
+
+def _iter_text_lxml(html: str, drop_boilerplate: bool) -> Generator[str, None, None]:
+    # bytes, because lxml refuses unicode strings that carry an xml encoding declaration
+    parser = lxml.html.HTMLParser(encoding="utf-8")
+    # a whole document, a fragment's root could be a boilerplate element that cannot be dropped
+    try:
+        root = lxml.html.document_fromstring(html.encode("utf-8", errors="replace"), parser=parser)
+
+    except etree.ParserError:
+        # nothing but comments or whitespace
+        return
+
+    # pruned before the walk, so their text nodes are never visited. the text around a removed element joins.
+    etree.strip_elements(root, etree.Comment, *PRUNED_TAGS, with_tail=False)
+    if drop_boilerplate:
+        for each_element in root.xpath(_BOILERPLATE_XPATH):
+            each_element.drop_tree()
+
+    for each_text in root.itertext():
+        each_stripped = each_text.strip()
+        if 0 < len(each_stripped):
+            yield each_stripped
+
+
+def _iter_text_soup(html: str, drop_boilerplate: bool) -> Generator[str, None, None]:
+    soup = BeautifulSoup(html, "html.parser")
+    skipped_tags = set(PRUNED_TAGS) | (set(BOILERPLATE_TAGS) if drop_boilerplate else set())
+    skipped_roles = set(BOILERPLATE_ROLES) if drop_boilerplate else set()
+
+    # single depth-first walk that does not descend into pruned subtrees. like lxml, text only breaks where an
+    # element that is kept starts or ends, the text around pruned elements and comments joins.
+    stack = [iter(soup.contents)]
+    text = list()
+    while 0 < len(stack):
+        each_node = next(stack[-1], None)
+        if each_node is None:
+            stack.pop()
+
+        elif isinstance(each_node, Tag):
+            if each_node.name in skipped_tags or each_node.get("role") in skipped_roles:
+                continue
+            stack.append(iter(each_node.contents))
+
+        else:
+            # exact type, subclasses are comments, doctypes, cdata, etc.
+            if type(each_node) is NavigableString:
+                text.append(str(each_node))
+            continue
+
+        each_stripped = "".join(text).strip()
+        text.clear()
+        if 0 < len(each_stripped):
+            yield each_stripped
+
+
+def iter_text(html: str, drop_boilerplate: bool = False) -> Generator[str, None, None]:
+    # visible text nodes in document order, uses lxml if it is installed
+    if len(html.strip()) < 1:
+        return
+
+    if lxml is None:
+        yield from _iter_text_soup(html, drop_boilerplate)
+    else:
+        yield from _iter_text_lxml(html, drop_boilerplate)
+
+
+def extract_text(html: str, drop_boilerplate: bool = False) -> str:
+    return " ".join(iter_text(html, drop_boilerplate=drop_boilerplate))
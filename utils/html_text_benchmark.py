@@ -0,0 +1,72 @@
+# coding=utf-8
+import os
+import sys
+import time
+from typing import Callable
+
+from bs4 import BeautifulSoup, Comment
+
+from utils.html_text import extract_text, _iter_text_soup, lxml
+
+
+def legacy_extract_text(html: str) -> str:
+    # previous implementation of `get_text_from_website`
+    soup = BeautifulSoup(html, 'html.parser')
+    texts = soup.findAll(text=True)
+
+    def visible_text(element: any) -> bool:
+        if element.parent.name in ['style', 'script', '[document]', 'head', 'title']:
+            return False
+        elif isinstance(element, Comment):
+            return False
+        return True
+
+    return ' '.join(t.strip() for t in filter(visible_text, texts))
+
+
+def load_corpus(directory: str) -> list[str]:
+    pages = list()
+    for each_name in sorted(os.listdir(directory)):
+        if not each_name.endswith((".html", ".htm")):
+            continue
+        with open(os.path.join(directory, each_name), mode="r", encoding="utf-8", errors="replace") as file:
+            pages.append(file.read())
+    return pages
+
+
+def benchmark(extract: Callable[[str], str], pages: list[str], repetitions: int = 3) -> tuple[float, int]:
+    best = float("inf")
+    no_characters = 0
+    for _ in range(repetitions):
+        started = time.perf_counter()
+        no_characters = sum(len(extract(each_page)) for each_page in pages)
+        best = min(best, time.perf_counter() - started)
+    return best, no_characters
+
+
+def main() -> None:
+    directory = sys.argv[1] if 1 < len(sys.argv) else "resources/html_corpus"
+    pages = load_corpus(directory)
+    if len(pages) < 1:
+        print(f"No .html files in {directory}. Save some pages there, e.g. with `curl -o`.")
+        return
+
+    megabytes = sum(len(each_page.encode("utf-8")) for each_page in pages) / 1_000_000
+    print(f"{len(pages)} pages, {megabytes:.1f} MB")
+
+    methods = {
+        "legacy (findAll + filter)": legacy_extract_text,
+        "pruned (html.parser)": lambda html: " ".join(_iter_text_soup(html, False)),
+        "pruned (html.parser, no boilerplate)": lambda html: " ".join(_iter_text_soup(html, True)),
+    }
+    if lxml is not None:
+        methods["pruned (lxml)"] = lambda html: extract_text(html)
+        methods["pruned (lxml, no boilerplate)"] = lambda html: extract_text(html, drop_boilerplate=True)
+
+    for each_name, each_method in methods.items():
+        seconds, no_characters = benchmark(each_method, pages)
+        print(f"{each_name:<40} {seconds:8.3f} s {megabytes / seconds:8.1f} MB/s {no_characters:>12,} characters of text")
+
+
+if __name__ == "__main__":
+    main()
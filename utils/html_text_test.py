@@ -0,0 +1,29 @@
+import pytest
+
+from utils.html_text import _iter_text_lxml, _iter_text_soup, extract_text
+
+FIXTURES = [
+    "<nav>menu</nav><p>body</p>",
+    "<nav>only a menu</nav>",
+    "<!DOCTYPE html><html><head><title>t</title><style>p {}</style></head><body>a<br>b</body></html>",
+    "a<!-- comment -->b",
+    "a<script>var x;</script>b",
+    "x<nav>n</nav>y",
+    "<p>a <b>bold</b> c &amp; d</p><footer>f</footer>",
+    "<div role='navigation'>n</div>text<aside>side</aside>",
+    "<ul><li>one</li><li>two</li></ul>",
+    "<!-- only a comment -->",
+    "plain text",
+]
+
+
+@pytest.mark.parametrize("html", FIXTURES)
+@pytest.mark.parametrize("drop_boilerplate", [False, True])
+def test_backends_extract_the_same_text(html: str, drop_boilerplate: bool) -> None:
+    assert list(_iter_text_lxml(html, drop_boilerplate)) == list(_iter_text_soup(html, drop_boilerplate))
+
+
+def test_drops_boilerplate_and_joins_around_pruned_elements() -> None:
+    assert extract_text("<nav>menu</nav>", drop_boilerplate=True) == ""
+    assert extract_text("<nav>menu</nav><p>body</p>", drop_boilerplate=True) == "body"
+    assert extract_text("a<script>var x;</script>b<p>c</p>") == "ab c"
@@ -0,0 +1,165 @@
+# coding=utf-8
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from utils.misc import LOGGER
+
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0 Safari/537.36"
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+# query parameters and headers that carry credentials, never written to disk
+SECRET_PARAMS = ("key", "api_key", "apikey", "access_token", "token", "secret", "client_secret", "password", "signature", "sig")
+SECRET_HEADERS = ("Set-Cookie", "Authorization", "WWW-Authenticate")
+
+
+def redact_url(url: str) -> str:
+    parts = urllib.parse.urlsplit(url)
+    query = [
+        (each_name, "REDACTED" if each_name.lower() in SECRET_PARAMS else each_value)
+        for each_name, each_value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    ]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+def _make_session(pool_size: int = 16) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+SESSION = _make_session()
+
+
+class HttpCache:
+    # GET responses on disk, one file per request. fresh entries are answered without touching the network,
+    # stale ones are revalidated with their ETag / Last-Modified validators.
+
+    def __init__(self, directory: str = "resources/cache/http", session: requests.Session = SESSION, default_ttl: float = 86_400.) -> None:
+        self.directory = directory
+        self.session = session
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(url: str, params: dict[str, any] | None) -> str:
+        # a hash, credentials in the url do not show in file names
+        prepared_url = requests.Request("GET", url, params=params).prepare().url
+        return hashlib.sha256(prepared_url.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _load(self, key: str) -> dict[str, any] | None:
+        try:
+            with open(self._path(key), mode="r", encoding="utf-8") as file:
+                return json.load(file)
+
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _save(self, key: str, entry: dict[str, any]) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # atomic replace, concurrent agents never read half written entries
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(file_descriptor, mode="w", encoding="utf-8") as file:
+            json.dump(entry, file)
+        os.replace(temp_path, path)
+
+    def _ttl(self, response: requests.Response, ttl: float | None) -> float | None:
+        cache_control = response.headers.get("Cache-Control", "").lower()
+        if "no-store" in cache_control:
+            return None
+        if ttl is not None:
+            return ttl
+        max_age = _MAX_AGE.search(cache_control)
+        if max_age is not None:
+            return float(max_age.group(1))
+        return self.default_ttl
+
+    @staticmethod
+    def _to_entry(response: requests.Response, expires: float) -> dict[str, any]:
+        secret_headers = {each_header.lower() for each_header in SECRET_HEADERS}
+        return {
+            "status_code": response.status_code,
+            "headers": {each_name: each_value for each_name, each_value in response.headers.items() if each_name.lower() not in secret_headers},
+            "content": base64.b64encode(response.content).decode("ascii"),
+            "encoding": response.encoding,
+            "url": redact_url(response.url),
+            "expires": expires,
+        }
+
+    @staticmethod
+    def _to_response(entry: dict[str, any]) -> requests.Response:
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = base64.b64decode(entry["content"])
+        response.encoding = entry["encoding"]
+        response.url = entry["url"]
+        return response
+
+    def get(self,
+            url: str,
+            params: dict[str, any] | None = None,
+            headers: dict[str, str] | None = None,
+            ttl: float | None = None,
+            timeout: float = 10.,
+            **kwargs: any) -> requests.Response:
+
+        key = HttpCache._key(url, params)
+        entry = self._load(key)
+        now = time.time()
+
+        if entry is not None and now < entry["expires"]:
+            self.hits += 1
+            return HttpCache._to_response(entry)
+
+        request_headers = dict(headers or dict())
+        if entry is not None:
+            validators = CaseInsensitiveDict(entry["headers"])
+            if "ETag" in validators:
+                request_headers["If-None-Match"] = validators["ETag"]
+            if "Last-Modified" in validators:
+                request_headers["If-Modified-Since"] = validators["Last-Modified"]
+
+        response = self.session.get(url, params=params, headers=request_headers, timeout=timeout, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.revalidations += 1
+            entry_ttl = self._ttl(response, ttl)
+            entry["expires"] = now + (self.default_ttl if entry_ttl is None else entry_ttl)
+            self._save(key, entry)
+            return HttpCache._to_response(entry)
+
+        self.misses += 1
+        entry_ttl = self._ttl(response, ttl)
+        if response.status_code == 200 and entry_ttl is not None:
+            try:
+                self._save(key, HttpCache._to_entry(response, now + entry_ttl))
+            except OSError as e:
+                LOGGER.warning(f"Could not cache response for {redact_url(response.url)}: {e}")
+
+        return response
+
+
+HTTP_CACHE = HttpCache()
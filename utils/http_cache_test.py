@@ -0,0 +1,84 @@
+import http.server
+import threading
+from typing import Generator
+
+import pytest
+
+from utils.http_cache import HttpCache
+
+
+class CountingHandler(http.server.BaseHTTPRequestHandler):
+    requests_seen = list()
+
+    def do_GET(self) -> None:
+        CountingHandler.requests_seen.append(self.path)
+        if self.headers.get("If-None-Match") == "\"v1\"":
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = b"{\"data\": [\"paper\"]}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", "\"v1\"")
+        if self.path.startswith("/private"):
+            self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: any) -> None:
+        pass
+
+
+@pytest.fixture(scope="module")
+def local_server() -> Generator[str, None, None]:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture
+def cache(tmp_path) -> HttpCache:
+    CountingHandler.requests_seen.clear()
+    return HttpCache(directory=str(tmp_path))
+
+
+def test_fresh_entry_needs_no_request(local_server: str, cache: HttpCache):
+    first = cache.get(f"{local_server}/search", params={"query": "moon"}, ttl=60.)
+    second = cache.get(f"{local_server}/search", params={"query": "moon"}, ttl=60.)
+
+    assert first.json() == second.json() == {"data": ["paper"]}
+    assert len(CountingHandler.requests_seen) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_params_are_part_of_the_key(local_server: str, cache: HttpCache):
+    cache.get(f"{local_server}/search", params={"query": "moon"}, ttl=60.)
+    cache.get(f"{local_server}/search", params={"query": "sun"}, ttl=60.)
+    assert len(CountingHandler.requests_seen) == 2
+
+
+def test_stale_entry_is_revalidated(local_server: str, cache: HttpCache):
+    cache.get(f"{local_server}/search", ttl=0.)
+    revalidated = cache.get(f"{local_server}/search", ttl=0.)
+
+    assert revalidated.status_code == 200
+    assert revalidated.json() == {"data": ["paper"]}
+    assert cache.revalidations == 1
+
+
+def test_no_store_is_not_cached(local_server: str, cache: HttpCache):
+    cache.get(f"{local_server}/private", ttl=60.)
+    cache.get(f"{local_server}/private", ttl=60.)
+    assert len(CountingHandler.requests_seen) == 2
+
+
+def test_credentials_are_not_written_to_disk(local_server: str, cache: HttpCache, tmp_path: any):
+    response = cache.get(f"{local_server}/search", params={"query": "moon", "key": "s3cr3t"}, ttl=60.)
+    cached = cache.get(f"{local_server}/search", params={"query": "moon", "key": "s3cr3t"}, ttl=60.)
+
+    assert "s3cr3t" in response.url and "s3cr3t" not in cached.url and "query=moon" in cached.url
+    assert all("s3cr3t" not in each_path.read_text() for each_path in tmp_path.rglob("*.json"))
@@ -0,0 +1,179 @@
+# coding=utf-8
+from __future__ import annotations
+
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import numpy
+
+from utils.misc import LOGGER
+
+
+class LLMCache:
+    # in-process cache for chat completions, keyed on model, messages, functions and temperature.
+    # exact matches are looked up by hash. if `embed` and `similarity_threshold` are set, near duplicate prompts
+    # with the same model, functions and temperature are matched by the cosine similarity of their embeddings.
+    # prompts longer than `max_semantic_length` characters only match exactly, embedding models truncate them and
+    # prompts that differ beyond the cut would match. calls without a temperature sample at the api's default of 1.
+
+    def __init__(self,
+                 max_entries: int = 1_024,
+                 ttl: float | None = None,
+                 max_temperature: float = 0.,
+                 similarity_threshold: float | None = None,
+                 embed: Callable[[list[str]], list[list[float]]] | None = None,
+                 max_semantic_length: int = 1_000) -> None:
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.similarity_threshold = similarity_threshold
+        self.embed = embed
+        self.max_semantic_length = max_semantic_length
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict[str, tuple[str, float, any]]()
+        self._vectors = dict[str, dict[str, numpy.ndarray]]()
+        self._pending_vectors = dict[str, numpy.ndarray]()
+
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(value: any) -> str:
+        value_json = json.dumps(value, sort_keys=True, default=str)
+        return hashlib.sha256(value_json.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _namespace(model: str, parameters: dict[str, any]) -> str:
+        return LLMCache._hash({
+            "model": model,
+            "functions": parameters.get("functions"),
+            "function_call": parameters.get("function_call"),
+            "temperature": parameters.get("temperature", 1.),
+        })
+
+    @staticmethod
+    def _prompt_text(messages: list[dict[str, any]]) -> str:
+        return "\n".join(f"{each_message['role']}: {each_message.get('content') or ''}" for each_message in messages)
+
+    def _is_semantic(self) -> bool:
+        return self.embed is not None and self.similarity_threshold is not None
+
+    def is_cacheable(self, parameters: dict[str, any]) -> bool:
+        if parameters.get("stream", False):
+            return False
+        return self.max_temperature >= parameters.get("temperature", 1.)
+
+    def _remove(self, key: str) -> None:
+        namespace, _, _ = self._entries.pop(key)
+        namespace_vectors = self._vectors.get(namespace)
+        if namespace_vectors is not None:
+            namespace_vectors.pop(key, None)
+
+    def _is_expired(self, stored: float, now: float) -> bool:
+        return self.ttl is not None and self.ttl <= now - stored
+
+    def _similar_key(self, namespace: str, vector: numpy.ndarray, now: float) -> str | None:
+        namespace_vectors = self._vectors.get(namespace)
+        if namespace_vectors is None:
+            return None
+
+        keys = [each_key for each_key in namespace_vectors if not self._is_expired(self._entries[each_key][1], now)]
+        if len(keys) < 1:
+            return None
+
+        matrix = numpy.stack([namespace_vectors[each_key] for each_key in keys])
+        similarities = matrix @ vector
+        best = int(numpy.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        return keys[best]
+
+    def lookup(self, model: str, messages: list[dict[str, any]], **parameters: any) -> any | None:
+        # a copy of the cached response, callers may change theirs
+        namespace = LLMCache._namespace(model, parameters)
+        key = LLMCache._hash([namespace, messages])
+        now = time.time()
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and self._is_expired(cached[1], now):
+                self._remove(key)
+                cached = None
+
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(cached[2])
+
+        prompt_text = LLMCache._prompt_text(messages)
+        if not self._is_semantic() or self.max_semantic_length < len(prompt_text):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # outside of the lock, embedding might be a remote call
+        try:
+            vector = numpy.array(self.embed([prompt_text])[0], dtype=numpy.float32)
+
+        except Exception as e:
+            # the call goes to the api then, a cache must not fail it
+            LOGGER.warning(f"Embedding the prompt for a semantic cache lookup failed: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+        vector /= numpy.linalg.norm(vector) or 1.
+
+        with self._lock:
+            similar_key = self._similar_key(namespace, vector, now)
+            if similar_key is None:
+                if self.max_entries < len(self._pending_vectors):
+                    # lookups whose calls failed are never stored
+                    self._pending_vectors.clear()
+                self._pending_vectors[key] = vector
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(similar_key)
+            self.semantic_hits += 1
+            return copy.deepcopy(self._entries[similar_key][2])
+
+    def store(self, model: str, messages: list[dict[str, any]], response: any, **parameters: any) -> None:
+        namespace = LLMCache._namespace(model, parameters)
+        key = LLMCache._hash([namespace, messages])
+        response = copy.deepcopy(response)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = namespace, time.time(), response
+            vector = self._pending_vectors.pop(key, None)
+            if vector is not None:
+                self._vectors.setdefault(namespace, dict())[key] = vector
+
+            while self.max_entries < len(self._entries):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._vectors.clear()
+            self._pending_vectors.clear()
@@ -0,0 +1,79 @@
+import time
+
+from utils.llm_cache import LLMCache
+
+
+def _messages(content: str) -> list[dict[str, any]]:
+    return [{"role": "user", "content": content}]
+
+
+def _response(content: str) -> dict[str, any]:
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+def _embed(texts: list[str]) -> list[list[float]]:
+    # prompts about the same topic word point in the same direction
+    topics = ["moon", "sun", "sea"]
+    return [[float(each_topic in each_text) + .01 * len(each_text) for each_topic in topics] for each_text in texts]
+
+
+def test_exact_hits_are_copies() -> None:
+    cache = LLMCache()
+    assert cache.lookup("gpt-4", _messages("moon?"), temperature=0.) is None
+    response = _response("round")
+    cache.store("gpt-4", _messages("moon?"), response, temperature=0.)
+    response["choices"][0]["message"]["content"] = "changed by the caller"
+
+    cached = cache.lookup("gpt-4", _messages("moon?"), temperature=0.)
+    assert cached == _response("round")
+    cached["choices"].clear()
+    assert cache.lookup("gpt-4", _messages("moon?"), temperature=0.) == _response("round")
+    # other models and functions do not match
+    assert cache.lookup("gpt-3.5-turbo", _messages("moon?"), temperature=0.) is None
+    assert cache.lookup("gpt-4", _messages("moon?"), temperature=0., functions=[{"name": "f"}]) is None
+    assert cache.stats() == {"entries": 1, "hits": 2, "semantic_hits": 0, "misses": 3}
+
+
+def test_near_duplicates_hit_semantically() -> None:
+    cache = LLMCache(similarity_threshold=.99, embed=_embed, max_semantic_length=100)
+    cache.lookup("gpt-4", _messages("tell me about the moon"), temperature=0.)
+    cache.store("gpt-4", _messages("tell me about the moon"), _response("round"), temperature=0.)
+
+    assert cache.lookup("gpt-4", _messages("tell me about the moon!"), temperature=0.) == _response("round")
+    assert cache.lookup("gpt-4", _messages("tell me about the sea"), temperature=0.) is None
+    # beyond what the embedding model reads, only exact matches count
+    assert cache.lookup("gpt-4", _messages("tell me about the moon" + 100 * "."), temperature=0.) is None
+    assert cache.semantic_hits == 1
+
+
+def test_entries_expire_and_the_least_recently_used_go_first() -> None:
+    cache = LLMCache(max_entries=2, ttl=.05)
+    for each_prompt in ["a", "b"]:
+        cache.store("gpt-4", _messages(each_prompt), _response(each_prompt), temperature=0.)
+    cache.lookup("gpt-4", _messages("a"), temperature=0.)
+    cache.store("gpt-4", _messages("c"), _response("c"), temperature=0.)
+
+    assert cache.lookup("gpt-4", _messages("b"), temperature=0.) is None
+    assert cache.lookup("gpt-4", _messages("a"), temperature=0.) == _response("a")
+    time.sleep(.06)
+    assert cache.lookup("gpt-4", _messages("c"), temperature=0.) is None
+
+
+def test_only_deterministic_calls_are_cacheable() -> None:
+    cache = LLMCache()
+    assert cache.is_cacheable({"temperature": 0.})
+    # the api samples at temperature 1 if none is given
+    assert not cache.is_cacheable(dict())
+    assert not cache.is_cacheable({"temperature": .7})
+    assert not cache.is_cacheable({"temperature": 0., "stream": True})
+    assert LLMCache(max_temperature=1.).is_cacheable(dict())
+
+
+def test_failing_embeddings_are_misses() -> None:
+    def fail(texts: list[str]) -> list[list[float]]:
+        raise ConnectionError("offline")
+
+    cache = LLMCache(similarity_threshold=.99, embed=fail)
+    assert cache.lookup("gpt-4", _messages("moon?"), temperature=0.) is None
+    cache.store("gpt-4", _messages("moon?"), _response("round"), temperature=0.)
+    assert cache.lookup("gpt-4", _messages("moon?"), temperature=0.) == _response("round")
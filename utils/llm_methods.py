@@ -1,16 +1,17 @@
 # coding=utf-8
 import json
 from abc import ABC
+from typing import Callable, Generator
 
-import hyperdb
-import numpy
 import openai
-from hyperdb import hyper_SVM_ranking_algorithm_sort
 
-from utils.basic_llm_calls import openai_chat, get_embeddings
-from utils.misc import extract_code_blocks, segment_text, LOGGER
-from utils.prompts import REQUEST_IMPROVER
+from utils.ann_index import AnnIndex
+from utils.basic_llm_calls import openai_chat, openai_chat_stream
+from utils.embedding_backends import EmbeddingBackend, get_embedding_backend
+from utils.misc import iter_code_blocks, segment_text, LOGGER
+from utils.prompts import REQUEST_IMPROVER, FACT_MERGER
 from utils.toolbox import ToolBox
+from utils.tracing import TRACER
 
 
 class ExtractionException(Exception):
@@ -27,7 +28,11 @@ class LLMMethods(ABC):
         return improved_request.strip()
 
     @staticmethod
-    def vector_summarize(request: str, text: str, segment_size: int = 500, overlap: int = 100, nearest_neighbors: int = 5, **parameters: any) -> str:
+    @TRACER.traced()
+    def vector_summarize(request: str, text: str,
+                         segment_size: int = 500, overlap: int = 100, nearest_neighbors: int = 5,
+                         embedding_backend: str | EmbeddingBackend = "openai",
+                         **parameters: any) -> str:
         # segment text
         segments = list(segment_text(text.strip(), segment_length=segment_size, overlap=overlap))
         LOGGER.info(f"Summarizing {len(segments)} segments...")
@@ -36,29 +41,23 @@ class LLMMethods(ABC):
         if 1 >= no_segments:
             return segments[0]
 
-        LOGGER.info("Initializing database...")
-        db = hyperdb.HyperDB()
-
         # embed
         LOGGER.info("Embedding...")
-        embeddings = get_embeddings([request] + segments)
+        embeddings = get_embedding_backend(embedding_backend)([request] + segments)
 
         request_vector = embeddings[0]
         segment_vectors = embeddings[1:]
 
-        # put embeddings in database
-        LOGGER.info("Adding to database...")
-        db.add_documents(segments, vectors=segment_vectors)
+        # put embeddings in index
+        LOGGER.info("Adding to index...")
+        index = AnnIndex(space="cosine", initial_capacity=no_segments)
+        index.add([f"{i}" for i in range(no_segments)], segment_vectors)
 
         # get nearest neighbors
         LOGGER.info("Getting nearest neighbors...")
-        nearest_neighbor_indices, _ = hyper_SVM_ranking_algorithm_sort(
-            db.vectors,
-            numpy.array(request_vector),
-            top_k=nearest_neighbors
-        )
+        (nearest_neighbor_ids,), _ = index.search([request_vector], nearest_neighbors)
 
-        nearest_neighbors = [db.documents[i].strip() for i in nearest_neighbor_indices]
+        nearest_neighbors = [segments[int(each_id)].strip() for each_id in nearest_neighbor_ids]
         concatenated = "\n\n".join(nearest_neighbors)
 
         prompt = (f"<!-- BEGIN REQUEST>\n"
@@ -101,12 +100,21 @@ class LLMMethods(ABC):
             f"{text.strip()}\n"
             f"<!-- END TEXT -->")
 
-        response = LLMMethods.respond(prompt, list(), function_id="extract_arguments", **parameters)
-        code_block = extract_code_blocks(response)[0]
+        # the first json block is parsed as soon as it is complete, the rest of the response is not awaited
+        chunks = LLMMethods.stream_respond(prompt, list(), function_id="extract_arguments", **parameters)
+        code_blocks = iter_code_blocks(chunks)
+        try:
+            code_block = next(code_blocks)
+        except StopIteration as e:
+            raise ExtractionException("No code block in response.") from e
+        finally:
+            code_blocks.close()
+
         arguments = json.loads(code_block)
         return arguments
 
     @staticmethod
+    @TRACER.traced()
     def openai_extract_arguments(full_description: str,
                                  tool_schema: dict[str, any],
                                  history: list[dict[str, any]] | None = None,
@@ -176,7 +184,33 @@ class LLMMethods(ABC):
         return missing_keys
 
     @staticmethod
-    def respond(prompt: str, message_history: list[dict[str, str]], function_id: str = "respond", **parameters: any) -> str:
+    def stream_respond(prompt: str, message_history: list[dict[str, str]], function_id: str = "respond", **parameters: any) -> Generator[str, None, None]:
+        yield from openai_chat_stream(
+            function_id,
+            **parameters,
+            messages=message_history + [{"role": "user", "content": prompt}],
+        )
+
+    @staticmethod
+    def _collect(chunks: Generator[str, None, None], on_partial: Callable[[str], None]) -> str:
+        content = ""
+        for each_chunk in chunks:
+            content += each_chunk
+            on_partial(content)
+        return content
+
+    @staticmethod
+    @TRACER.traced()
+    def respond(prompt: str,
+                message_history: list[dict[str, str]],
+                function_id: str = "respond",
+                on_partial: Callable[[str], None] | None = None,
+                **parameters: any) -> str:
+        # `on_partial` receives the response so far whenever a new token arrives
+        if on_partial is not None:
+            chunks = LLMMethods.stream_respond(prompt, message_history, function_id=function_id, **parameters)
+            return LLMMethods._collect(chunks, on_partial).strip()
+
         response = openai_chat(
             function_id,
             **parameters,
@@ -189,6 +223,7 @@ class LLMMethods(ABC):
         return content.strip()
 
     @staticmethod
+    @TRACER.traced()
     def openai_naturalize(request: str, tool_schema: dict[str, any], arguments_json: str, result_json: str, **parameters: any) -> str:
         tool_name = tool_schema["name"]
         messages = [
@@ -210,7 +245,8 @@ class LLMMethods(ABC):
         return content.strip()
 
     @staticmethod
-    def naturalize(request: str, result_str: str, **parameters: any) -> str:
+    @TRACER.traced()
+    def naturalize(request: str, result_str: str, on_partial: Callable[[str], None] | None = None, **parameters: any) -> str:
         prompt = (
             f"<-- BEGIN REQUEST -->\n"
             f"{request.strip()}\n"
@@ -224,6 +260,10 @@ class LLMMethods(ABC):
             f"Formulate a concise, coherent, and complete natural language response to the above request based on the provided result."
         )
 
+        if on_partial is not None:
+            chunks = openai_chat_stream("naturalize", **parameters, messages=[{"role": "user", "content": prompt}])
+            return LLMMethods._collect(chunks, on_partial).strip()
+
         messages = [
             {"role": "user", "content": prompt},
         ]
@@ -238,6 +278,12 @@ class LLMMethods(ABC):
         content = response_message["content"]
         return content.strip()
 
+    @staticmethod
+    def merge_facts(facts: list[str], **parameters: any) -> str:
+        prompt = FACT_MERGER.format(facts="\n\n".join(each_fact.strip() for each_fact in facts))
+        response = LLMMethods.respond(prompt, list(), function_id="merge_facts", **parameters)
+        return response.strip()
+
     @staticmethod
     def sample_first_action(request: str, **parameters: any) -> str:
         prompt = (
@@ -252,7 +298,7 @@ class LLMMethods(ABC):
         return response.strip()
 
     @staticmethod
-    def sample_next_action(progress_report: str, **parameters: any) -> str:
+    def sample_next_action(progress_report: str, on_partial: Callable[[str], None] | None = None, **parameters: any) -> str:
         prompt = (
             f"<! -- BEGIN PROGRESS REPORT -->\n"
             f"{progress_report.strip()}\n"
@@ -265,21 +311,16 @@ class LLMMethods(ABC):
             f"Consider memorizing / recalling relevant information from previous steps.\n"
             f"\n"
             f"Check thoroughly if the request is _already_ fulfilled according to the progress report. In this case respond only with \"[FINALIZE]\".")
-        response = LLMMethods.respond(prompt, list(), function_id="sample_next_step_summary", **parameters)
+        response = LLMMethods.respond(prompt, list(), function_id="sample_next_step_summary", on_partial=on_partial, **parameters)
         return response.strip()
 
     @staticmethod
-    def select_tool_name(toolbox: ToolBox, function_description: str) -> tuple[str, float]:
-        # get embedding for task_description
-        embedding, = get_embeddings([function_description])
-
-        # query for most similar function name
-        (document_index,), (fitness,) = hyper_SVM_ranking_algorithm_sort(
-            toolbox.vector_db.vectors,
-            numpy.array(embedding),
-            top_k=1,
-            metric=toolbox.vector_db.similarity_metric
-        )
+    @TRACER.traced()
+    def select_tool_names(toolbox: ToolBox, function_description: str, top_k: int = 1, min_fitness: float | None = None) -> list[tuple[str, float]]:
+        # most promising tool names by similarity and past success, best first, with their cosine similarity as fitness
+        return toolbox.rank_tools(function_description, top_k=top_k, min_fitness=min_fitness)
 
-        tool_name = toolbox.vector_db.documents[document_index]
-        return tool_name.strip(), fitness
+    @staticmethod
+    def select_tool_name(toolbox: ToolBox, function_description: str) -> tuple[str, float]:
+        (tool_name, fitness), = LLMMethods.select_tool_names(toolbox, function_description, top_k=1)
+        return tool_name, fitness
@@ -4,7 +4,7 @@ import datetime
 import re
 import logging
 
-from typing import Generator
+from typing import Generator, Iterable
 
 from utils.logging_handler import logging_handlers
 
@@ -46,6 +46,38 @@ def extract_code_blocks(text: str, code_type: str | None = None) -> tuple[str, .
         for each_block in re.findall(rf"```{code_type}(.*?)```", text, re.DOTALL | re.IGNORECASE))
 
 
+def iter_code_blocks(chunks: Iterable[str], code_type: str | None = None) -> Generator[str, None, None]:
+    """
+    Parses the code blocks from streamed text, each block as soon as its closing fence arrived.
+
+    Args:
+    chunks: Iterable[str]: the text in consecutive pieces.
+
+    Returns:
+    Generator[str, None, None]: the code blocks, same as `extract_code_blocks`.
+    """
+
+    if code_type is None:
+        pattern = re.compile(r'```(?:[a-zA-Z]+\n)?(.*?)```', re.DOTALL)
+    else:
+        pattern = re.compile(rf"```{code_type}(.*?)```", re.DOTALL | re.IGNORECASE)
+
+    text = ""
+    cursor = 0
+    try:
+        for each_chunk in chunks:
+            text += each_chunk
+            # `search` from the cursor, since a block can only complete after the last completed one
+            while (match := pattern.search(text, cursor)) is not None:
+                cursor = match.end()
+                yield match.group(1).strip("`").strip()
+
+    finally:
+        # closing early also abandons a streamed response
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
 def insert_docstring(func_code: str, docstring: str) -> str:
     # Parse the function code into an AST
     module = ast.parse(func_code)
@@ -4,20 +4,31 @@ import dataclasses
 import json
 import logging
 import os
+import threading
 import time
 import types
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from traceback import format_exc
+from typing import Literal
 
 import colorama
 import chromadb
 
-from utils.basic_llm_calls import openai_chat
+from utils.basic_llm_calls import openai_chat_stream
+from utils.checkpoint import Checkpoint
+from utils.ann_index import AnnIndex
+from utils.compact_vectors import CompactVectorStore
+from utils.embedding_cache import get_default_embedding_cache
+from utils.fact_consolidation import FactArchive, FactConsolidator, PeriodicJob
+from utils.fact_ingest import FactIngest
+from utils.history_manager import HistoryManager
 from utils.json_schemata import docstring_schema, proceed
 from utils.llm_methods import LLMMethods, ExtractionException
-from utils.prompts import CODER
+from utils.prompts import CODER, AGENT_PREAMBLE
 from utils.logging_handler import logging_handlers
-from utils.misc import truncate, extract_code_blocks, insert_docstring, compose_docstring, get_date_name, segment_text, LOGGER
-from utils.toolbox import ToolBox, SchemaExtractionException
+from utils.misc import truncate, iter_code_blocks, insert_docstring, compose_docstring, get_date_name, segment_text, LOGGER
+from utils.toolbox import ToolBox
+from utils.tracing import TRACER, ChromeTraceExporter, JsonlExporter
 
 
 class ToolSelectionException(Exception):
@@ -45,22 +56,36 @@ class ToolCall:
     output: any
 
 
+@dataclasses.dataclass
+class ToolCandidate:
+    code: str
+    tool: types.FunctionType | None = None
+    schema: dict[str, any] | None = None
+    error: str | None = None
+
+
 class StepProcessor:
     # todo: extract
     # what does it do?
     # extract code generation
 
-    def __init__(self, toolbox: ToolBox, implementation_attempts: int = 3, result_limit: int = 2_000) -> None:
+    def __init__(self, toolbox: ToolBox, implementation_attempts: int = 3, result_limit: int = 2_000, candidates: int = 1) -> None:
         self.toolbox = toolbox
         self.implementation_attempts = implementation_attempts
         self.result_limit = result_limit
+        self.candidates = candidates
 
-    def _make_code(self, message_history: list[dict[str, any]]) -> str:
-        response = openai_chat("make_code", messages=message_history, model="gpt-4")
-        message = response["choices"][0]["message"]
-        content = message["content"]
+    def _make_code(self, message_history: list[dict[str, any]], cancel: threading.Event | None = None) -> str:
+        # stops reading the response once the first code block is complete
+        chunks = openai_chat_stream("make_code", cancel=cancel, messages=message_history, model="gpt-4")
+        code_blocks = iter_code_blocks(chunks)
+        try:
+            tool_code = next(code_blocks)
+        except StopIteration as e:
+            raise ToolCreationException("No code block in response.") from e
+        finally:
+            code_blocks.close()
 
-        tool_code = extract_code_blocks(content)[0]
         message_history.append(
             {"role": "assistant", "content": f"```python\n{tool_code}\n```"}
         )
@@ -80,66 +105,126 @@ class StepProcessor:
             del tool
             return ToolCall("reject", {"tool_call": tool_call_str}, "Tool call rejected by user.")
 
-        result = tool(**arguments)
+        # without the confirmation, that is waiting for the user
+        with TRACER.span("tool", tool=tool_name):
+            result = tool(**arguments)
         return ToolCall(tool_name, arguments, result)
 
-    def apply_new_tool(self, text: str, docstring_dict: dict[str, any]) -> ToolCall:
+    def _code_prompt(self, docstring_dict: dict[str, any]) -> list[dict[str, any]]:
         tool_descriptions_string = self.toolbox.get_all_descriptions_string()
         docstring = compose_docstring(docstring_dict)
         code_prompt = CODER.format(tool_descriptions=tool_descriptions_string, docstring=docstring)
-        message_history = [
+        return [
             {"role": "user", "content": code_prompt}
         ]
 
-        for i in range(self.implementation_attempts):
-            print(f"{colorama.Back.YELLOW}New tool:{colorama.Style.RESET_ALL}")
+    def draft_new_tool(self, docstring_dict: dict[str, any], cancel: threading.Event | None = None) -> tuple[list[dict[str, any]], str]:
+        # first implementation, generated before it is clear whether it is needed (see `PerpetualAgent.implement_thought`)
+        message_history = self._code_prompt(docstring_dict)
+        tool_code = self._make_code(list(message_history), cancel=cancel)
+        return message_history, tool_code
+
+    @TRACER.traced()
+    def _make_candidate(self,
+                        message_history: list[dict[str, any]], docstring: str, docstring_dict: dict[str, any],
+                        cancel: threading.Event, tool_code: str | None = None) -> ToolCandidate:
+        # generates and validates one implementation without touching the tool folder, so candidates can run concurrently
+        if tool_code is None:
+            tool_code = self._make_code(list(message_history), cancel=cancel)
+
+        candidate = ToolCandidate(tool_code)
+        try:
+            candidate.code = insert_docstring(tool_code, docstring)
+            candidate.tool = self.toolbox.compile_tool(candidate.code)
+            candidate.schema = self.toolbox.get_tool_schema(candidate.code, docstring_dict)
 
-            new_tool_code = self._make_code(message_history)
-            new_tool_code = insert_docstring(new_tool_code, docstring)
+        except Exception:
+            candidate.error = format_exc()
 
-            try:
-                tmp_tool = self.toolbox.get_temp_tool_from_code(new_tool_code, docstring_dict)
+        return candidate
 
-            except Exception as e:
-                msg = f"Tool creation failed: {e} ({i + 1} of {self.implementation_attempts} attempts)"
-                LOGGER.error(msg)
-                print(f"{colorama.Back.RED}{colorama.Style.DIM}{msg}{colorama.Style.RESET_ALL}")
-                message_history.append(
-                    {"role": "user", "content": format_exc()}
-                )
-                continue
+    def _first_valid_candidate(self,
+                               message_history: list[dict[str, any]], docstring: str, docstring_dict: dict[str, any],
+                               draft_code: str | None) -> tuple[ToolCandidate | None, list[ToolCandidate]]:
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.candidates)
+        try:
+            futures = list()
+            make_candidate = TRACER.propagate(self._make_candidate)
+            if draft_code is not None:
+                futures.append(executor.submit(make_candidate, message_history, docstring, docstring_dict, cancel, draft_code))
+            while len(futures) < self.candidates:
+                futures.append(executor.submit(make_candidate, message_history, docstring, docstring_dict, cancel))
 
-            try:
-                tool_schema = self.toolbox.get_tool_schema(new_tool_code, docstring_dict)
+            failed = list()
+            for each_future in as_completed(futures):
+                try:
+                    each_candidate = each_future.result()
+
+                except Exception as e:
+                    LOGGER.error(f"Code generation failed: {e}")
+                    continue
+
+                if each_candidate.error is None:
+                    # the remaining generations stop at their next token
+                    cancel.set()
+                    return each_candidate, failed
+
+                failed.append(each_candidate)
+
+            return None, failed
 
-            except SchemaExtractionException as e:
-                del tmp_tool
-                msg = f"Schema extraction failed: {e} ({i + 1} of {self.implementation_attempts} attempts)"
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @TRACER.traced()
+    def apply_new_tool(self, text: str, docstring_dict: dict[str, any], draft: tuple[list[dict[str, any]], str] | None = None) -> ToolCall:
+        docstring = compose_docstring(docstring_dict)
+        if draft is None:
+            message_history = self._code_prompt(docstring_dict)
+            draft_code = None
+        else:
+            message_history, draft_code = draft
+
+        for i in range(self.implementation_attempts):
+            print(f"{colorama.Back.YELLOW}New tool:{colorama.Style.RESET_ALL}")
+
+            candidate, failed = self._first_valid_candidate(message_history, docstring, docstring_dict, draft_code if i < 1 else None)
+            if candidate is None:
+                msg = f"Tool creation failed for {len(failed)} of {self.candidates} candidates ({i + 1} of {self.implementation_attempts} attempts)"
                 LOGGER.error(msg)
                 print(f"{colorama.Back.RED}{colorama.Style.DIM}{msg}{colorama.Style.RESET_ALL}")
+                if 0 < len(failed):
+                    # all failures go into the next round at once
+                    message_history.append(
+                        {"role": "assistant", "content": "\n\n".join(f"```python\n{each_candidate.code}\n```" for each_candidate in failed)}
+                    )
+                    message_history.append(
+                        {"role": "user", "content": "\n\n".join(f"Implementation {j + 1}:\n{each_candidate.error}" for j, each_candidate in enumerate(failed))}
+                    )
                 continue
 
             try:
-                arguments = LLMMethods.openai_extract_arguments(text, tool_schema)
+                arguments = LLMMethods.openai_extract_arguments(text, candidate.schema)
 
             except ExtractionException as e:
-                del tmp_tool
                 msg = f"Argument extraction failed: {e} ({i + 1} of {self.implementation_attempts} attempts)"
                 LOGGER.error(msg)
                 print(f"{colorama.Back.RED}{colorama.Style.DIM}{msg}{colorama.Style.RESET_ALL}")
                 continue
 
             try:
-                tool_result = self.apply_tool(tmp_tool, arguments)
-                del tmp_tool
-                self.toolbox.save_tool_code(new_tool_code, docstring_dict, False)
+                tool_result = self.apply_tool(candidate.tool, arguments)
+                self.toolbox.save_tool_code(candidate.code, docstring_dict, False)
                 return tool_result
 
             except Exception as e:
-                del tmp_tool
                 msg = f"Tool application failed: {e} ({i + 1} of {self.implementation_attempts} attempts)"
                 LOGGER.error(msg)
                 print(f"{colorama.Back.RED}{colorama.Style.DIM}{msg}{colorama.Style.RESET_ALL}")
+                message_history.append(
+                    {"role": "assistant", "content": f"```python\n{candidate.code}\n```"}
+                )
                 message_history.append(
                     {"role": "user", "content": format_exc()}
                 )
@@ -149,29 +234,58 @@ class StepProcessor:
 
 
 class PerpetualAgent:
-    def __init__(self, request: str, vector_database: chromadb.Client, fact_limit: int = -1, _previous_state: tuple[list[dict[str, any]], str] | None = None) -> None:
+    def __init__(self,
+                 request: str, vector_database: chromadb.Client, fact_limit: int = -1,
+                 speculative: bool = False, speculative_candidates: int = 2, fitness_threshold: float = .75, tool_candidates: int = 1,
+                 history_budget: int = 4_096, snapshot_every: int = 10,
+                 compact_facts: Literal["float16", "int8", "pq"] | None = None, fact_index: bool = False,
+                 global_facts: CompactVectorStore | None = None,
+                 consolidate_every: float | None = None, consolidate_global_facts: bool = False, merge_facts: bool = False,
+                 trace: bool = False,
+                 _previous_state: tuple[list[dict[str, any]], str] | None = None) -> None:
         self.main_logger = logging.getLogger()
         self.main_logger.setLevel(logging.INFO)
         for each_handler in logging_handlers():
             self.main_logger.addHandler(each_handler)
 
         self.toolbox = ToolBox("tools/")
-        self.processor = StepProcessor(self.toolbox)
+        self.processor = StepProcessor(self.toolbox, candidates=tool_candidates)
+
+        self.speculative = speculative
+        self.speculative_candidates = speculative_candidates
+        # a tool is reused from this cosine similarity of its description (minilm) on, paraphrases of one task rarely
+        # reach .9 with it
+        self.fitness_threshold = fitness_threshold
 
         self.request = request
         self.vector_database = vector_database
         if _previous_state is None:
-            self.history, self.project_name = self.__initialize_new_project()
+            history, self.project_name = self.__initialize_new_project()
             self.project_directory = os.path.join("projects/", self.project_name)
 
             os.makedirs(self.project_directory)
             PerpetualAgent._save_request(self.request, self.project_directory)
 
         else:
-            self.history, self.project_name = _previous_state
+            history, self.project_name = _previous_state
 
         self.project_directory = os.path.join("projects/", self.project_name)
 
+        if trace:
+            # spans of steps, llm calls, tools, embeddings and vector queries. `python -m utils.tracing <trace.jsonl> step`
+            # shows the critical path of each step, trace.json loads in chrome://tracing or https://ui.perfetto.dev.
+            TRACER.add_exporter(JsonlExporter(os.path.join(self.project_directory, "trace.jsonl")))
+            TRACER.add_exporter(ChromeTraceExporter(os.path.join(self.project_directory, "trace.json")))
+
+        # the request is pinned at the start of every prompt, older steps are folded into a summary
+        preamble = {"role": "system", "content": AGENT_PREAMBLE.format(request=self.request)}
+        self.history = HistoryManager(
+            [preamble],
+            lambda prompt: LLMMethods.respond(prompt, list(), function_id="summarize_history", model="gpt-3.5-turbo"),
+            token_budget=history_budget,
+            _recent=history
+        )
+
         self.progress = {
             "report": "No progress yet.",
             "was_step_effective": False,
@@ -181,10 +295,107 @@ class PerpetualAgent:
 
         self.last_action = ""
         self.last_fact = "No step has been taken yet."
+        self.step = 0
+
+        # results of the current step that are already journaled, a resumed step continues after them
+        self._pending = dict[str, any]()
+        self.checkpoint = Checkpoint(self.project_directory, snapshot_every=snapshot_every)
+
+        if compact_facts is None:
+            self.local_facts = vector_database.get_or_create_collection(f"facts_{self.project_name}")
+        else:
+            # vectors in compact memory mapped files instead of chroma, for memories of millions of facts
+            fact_directory = os.path.join(self.project_directory, "fact_vectors")
+            index = AnnIndex(directory=os.path.join(fact_directory, "index")) if fact_index else None
+            self.local_facts = CompactVectorStore(fact_directory, codec=compact_facts, index=index)
+        self.global_facts = global_facts
+        facts_path = os.path.join(self.project_directory, "facts.jsonl")
+        self.fact_ingest = FactIngest(self.local_facts, facts_path, get_default_embedding_cache())
+
+        # if `consolidate_every` seconds are given, near duplicate facts are merged and cold ones archived that often.
+        # the local facts are kept to `fact_limit` (unless negative). the global ones are shared with other agents and
+        # processes, only the one agent with `consolidate_global_facts` consolidates them and they only lose cold facts.
+        self.consolidate_global_facts = consolidate_global_facts
+        self._facts_lock = threading.Lock()
+        merge = (lambda facts: LLMMethods.merge_facts(facts, model="gpt-3.5-turbo")) if merge_facts else None
+        self.local_consolidator = FactConsolidator(
+            FactArchive(os.path.join(self.project_directory, "facts_archive.jsonl.gz")),
+            merge=merge, embed=get_default_embedding_cache(), max_facts=None if fact_limit < 0 else fact_limit
+        )
+        self.global_consolidator = FactConsolidator(
+            FactArchive(os.path.join("projects/", "facts_archive.jsonl.gz")),
+            merge=merge, embed=get_default_embedding_cache()
+        )
+        self.consolidation = None if consolidate_every is None else PeriodicJob(self._consolidate_facts, consolidate_every, name="fact consolidation")
+
+    @staticmethod
+    def resume(project_name: str, vector_database: chromadb.Client, **kwargs: any) -> PerpetualAgent:
+        # restores the last snapshot and replays the journal after it, nothing that was journaled is computed again
+        project_directory = os.path.join("projects/", project_name)
+        if not Checkpoint(project_directory).exists():
+            # projects from before checkpoints only have their message log
+            history, request = PerpetualAgent.__read_project_data(project_name)
+            return PerpetualAgent(request, vector_database, _previous_state=(history, project_name), **kwargs)
+
+        request = PerpetualAgent._read_request(project_directory)
+        agent = PerpetualAgent(request, vector_database, _previous_state=(list(), project_name), **kwargs)
+        state, records = agent.checkpoint.load()
+        if state is not None:
+            agent._restore(state)
+        for each_record in records:
+            agent._replay(each_record)
+
+        agent.main_logger.info(f"Resumed project '{project_name}' at step {agent.step} from {len(records)} journal records.")
+        return agent
+
+    def _state(self) -> dict[str, any]:
+        return {
+            "step": self.step,
+            "progress": self.progress,
+            "last_fact": self.last_fact,
+            "last_action": self.last_action,
+            "history": self.history.to_dict(),
+        }
+
+    def _restore(self, state: dict[str, any]) -> None:
+        self.step = state["step"]
+        self.progress = state["progress"]
+        self.last_fact = state["last_fact"]
+        self.last_action = state["last_action"]
+        self.history.restore(state["history"])
+
+    def _replay(self, record: dict[str, any]) -> None:
+        match record["type"]:
+            case "progress":
+                self.progress = record["progress"]
+                self.history.extend(record["exchange"])
+                self._pending = {"progress": record["progress"], "exchange": record["exchange"]}
+
+            case "tool_call":
+                self._pending["tool_call"] = ToolCall(**record["tool_call"])
+
+            case "step":
+                self.step = record["step"]
+                self.last_fact = record["last_fact"]
+                self.last_action = record["last_action"]
+                self._pending = dict()
+
+            case _:
+                raise ValueError(f"Unknown journal record type {record['type']!r}.")
+
+    def _journal(self, record_type: str, **data: any) -> None:
+        self.checkpoint.append({"type": record_type, **data})
+
+    def _finish_step(self) -> None:
+        self.step += 1
+        self._journal("step", step=self.step, last_fact=self.last_fact, last_action=self.last_action)
+        self._pending = dict()
+        if self.checkpoint.is_snapshot_due():
+            self.checkpoint.snapshot(self._state())
 
     @staticmethod
     def _read_history(project_directory: str) -> list[dict[str, any]]:
-        history_path = os.path.join(project_directory, "history.json")
+        history_path = os.path.join(project_directory, "history.jsonl")
         with open(history_path, mode="r") as file:
             history = list()
             for each_line in file:
@@ -208,27 +419,15 @@ class PerpetualAgent:
                 json.dump(each_message, file)
                 file.write("\n")
 
-    def _save_facts(self, facts: list[str]) -> None:
-        local_facts: chromadb.api.models.Collection.Collection = self.vector_database.get_collection(f"facts_{self.project_name}")
-        no_facts = local_facts.count()
-
-        local_facts.add(
-            [f"{i}" for i in range(no_facts, no_facts + len(facts))],
-            embeddings=None,
-            metadatas=[{"index": i, "last_retrieved": -1} for i in range(no_facts, no_facts + len(facts))],
-            documents=facts
-        )
-
-        facts_json = list()
-        for i, each_fact in enumerate(facts):
-            each_fact_json = json.dumps({"content": each_fact, "index": i + no_facts})
-            facts_json.append(each_fact_json)
+    def _consolidate_facts(self) -> None:
+        self.local_consolidator.run(self.local_facts, lock=self._facts_lock)
+        if self.consolidate_global_facts:
+            global_facts = self.global_facts or self.vector_database.get_collection("facts")
+            self.global_consolidator.run(global_facts, lock=self._facts_lock)
 
-        facts_path = os.path.join(self.project_directory, "facts.jsonl")
-        with open(facts_path, mode="a") as file:
-            for each_fact in facts_json:
-                file.write(each_fact)
-                file.write("\n")
+    def _save_facts(self, facts: list[str]) -> None:
+        # returns right away, the facts are embedded and written in the background
+        self.fact_ingest.submit(facts)
 
     @staticmethod
     def _save_request(request: str, project_directory: str) -> None:
@@ -257,6 +456,7 @@ class PerpetualAgent:
 
         PerpetualAgent._save_messages(last_exchange, self.project_directory)
 
+    @TRACER.traced()
     def _make_facts(self, thought: str, tool_call: ToolCall) -> list[str]:
         segments = segment_text(str(tool_call.output), segment_length=1_000, overlap=200)
 
@@ -267,53 +467,71 @@ class PerpetualAgent:
 
         return facts
 
+    @TRACER.traced()
     def _summarize_facts(self, thought: str, n: int = 5) -> str:
         now = round(time.time())
-
-        global_facts = self.vector_database.get_collection("facts")
-        global_results = global_facts.query(
-            query_texts=thought,
-            n_results=n
-        )
-        # todo: results might be in lists of lists. take only the first list then
-        fact_fitness = {
-            ("global", each_id): {
-                "content": each_fact,
-                "distance": each_distance,
-                "metadata": each_metadata
+        # one embedding for the thought, the same one is compared to facts that are not written yet
+        embedding, = get_default_embedding_cache()([thought])
+
+        # consolidation does not remove facts between finding them and updating their `last_retrieved`
+        with self._facts_lock:
+            global_facts = self.global_facts or self.vector_database.get_collection("facts")
+            with TRACER.span("vector.query", store="global facts", n=n):
+                global_results = global_facts.query(
+                    query_embeddings=[embedding],
+                    n_results=n
+                )
+            fact_fitness = {
+                ("global", each_id): {
+                    "content": each_fact,
+                    "distance": each_distance,
+                    "metadata": each_metadata
+                }
+                for each_id, each_fact, each_distance, each_metadata in zip(
+                    global_results["ids"][0], global_results["documents"][0], global_results["distances"][0], global_results["metadatas"][0]
+                )
             }
-            for each_id, each_fact, each_distance, each_metadata in zip(
-                global_results["ids"], global_results["documents"], global_results["distances"], global_results["metadatas"]
-            )
-        }
 
-        local_facts = self.vector_database.get_collection(f"facts_{self.project_name}")
-        local_results = local_facts.query(
-            query_texts=thought,
-            n_results=n
-        )
-        fact_fitness.update({
-            ("local", each_id): {
-                "content": each_fact,
-                "distance": each_distance,
-                "metadata": each_metadata
-            }
-            for each_id, each_fact, each_distance, each_metadata in zip(
-                local_results["ids"], local_results["documents"], local_results["distances"], local_results["metadatas"]
-            )
-        })
-
-        best_facts = sorted(fact_fitness.keys(), key=lambda x: fact_fitness[x]["distance"], reverse=True)
-        best_n_facts = best_facts[:n]
-
-        local_upsert_ids = [each_id for each_id, each_location in best_n_facts if each_location == "local"]
-        local_upsert_metadatas = [fact_fitness[each_id]["metadata"] | {"last_retrieved": now} for each_id in local_upsert_ids]
-        local_facts.upsert(local_upsert_ids, metadatas=local_upsert_metadatas)
-        global_upsert_ids = [each_id for each_id, each_location in best_n_facts if each_location == "global"]
-        global_upsert_metadatas = [fact_fitness[each_id]["metadata"] | {"last_retrieved": now} for each_id in global_upsert_ids]
-        global_facts.upsert(global_upsert_ids, metadatas=global_upsert_metadatas)
-
-        relevant_facts = "\n\n".join(best_n_facts)
+            local_facts = self.local_facts
+            with TRACER.span("vector.query", store="local facts", n=n):
+                local_results = local_facts.query(
+                    query_embeddings=[embedding],
+                    n_results=n
+                )
+            fact_fitness.update({
+                ("local", each_id): {
+                    "content": each_fact,
+                    "distance": each_distance,
+                    "metadata": each_metadata
+                }
+                for each_id, each_fact, each_distance, each_metadata in zip(
+                    local_results["ids"][0], local_results["documents"][0], local_results["distances"][0], local_results["metadatas"][0]
+                )
+            })
+
+            # facts of this agent that are still queued for writing
+            fact_fitness.update({
+                ("pending", each_id): {
+                    "content": each_fact,
+                    "distance": each_distance,
+                    "metadata": dict()
+                }
+                for each_distance, each_id, each_fact in self.fact_ingest.nearest(embedding, n)
+            })
+
+            best_n_facts = sorted(fact_fitness.keys(), key=lambda x: fact_fitness[x]["distance"])[:n]
+
+            # pending facts are written with `last_retrieved` unset, they are fresh anyway
+            local_upsert_ids = [each_id for each_location, each_id in best_n_facts if each_location == "local"]
+            local_upsert_metadatas = [fact_fitness[("local", each_id)]["metadata"] | {"last_retrieved": now} for each_id in local_upsert_ids]
+            if 0 < len(local_upsert_ids):
+                local_facts.upsert(local_upsert_ids, metadatas=local_upsert_metadatas)
+            global_upsert_ids = [each_id for each_location, each_id in best_n_facts if each_location == "global"]
+            global_upsert_metadatas = [fact_fitness[("global", each_id)]["metadata"] | {"last_retrieved": now} for each_id in global_upsert_ids]
+            if 0 < len(global_upsert_ids):
+                global_facts.upsert(global_upsert_ids, metadatas=global_upsert_metadatas)
+
+        relevant_facts = "\n\n".join(fact_fitness[each_key]["content"] for each_key in best_n_facts)
         prompt = (
             f"<!-- BEGIN FACTS -->\n"
             f"{relevant_facts}\n"
@@ -325,6 +543,7 @@ class PerpetualAgent:
         response = LLMMethods.respond(prompt, list(), function_id="summarize", model="gpt-3.5-turbo")
         return response
 
+    @TRACER.traced()
     def _naturalize(self, thought: str, tool_call: ToolCall) -> str:
         action = tool_call.tool_name
         arguments = tool_call.input
@@ -339,6 +558,46 @@ class PerpetualAgent:
         fact = LLMMethods.openai_naturalize(thought, action_schema, arguments_json, observation_json, model="gpt-3.5-turbo")
         return fact
 
+    def _speculate(self,
+                   summary: str, docstring_dict: dict[str, any], candidates: list[tuple[str, float]]
+                   ) -> tuple[str | None, dict[str, any] | None, tuple[list[dict[str, any]], str] | None]:
+        # arguments for all candidate tools are extracted while a new tool is drafted. the best candidate that passes
+        # the fitness threshold and whose arguments could be extracted wins, otherwise the draft is used.
+        # returns the winning tool name and its arguments, or `None, None` and the draft (`None` if drafting failed).
+        fitting = [(each_name, self.toolbox.get_schema_from_name(each_name)) for each_name, each_fitness in candidates if self.fitness_threshold <= each_fitness]
+
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(fitting) + 1)
+        try:
+            draft_future = executor.submit(TRACER.propagate(self.processor.draft_new_tool), docstring_dict, cancel)
+            extraction_futures = [
+                (each_name, executor.submit(TRACER.propagate(LLMMethods.openai_extract_arguments), summary, each_schema))
+                for each_name, each_schema in fitting
+            ]
+
+            for each_name, each_future in extraction_futures:
+                try:
+                    arguments = each_future.result()
+
+                except ExtractionException as e:
+                    self.main_logger.warning(f"Argument extraction for `{each_name}` failed: {e}")
+                    continue
+
+                # the draft stream stops at its next token, pending extractions never start
+                cancel.set()
+                return each_name, arguments, None
+
+            try:
+                return None, None, draft_future.result()
+
+            except Exception as e:
+                self.main_logger.error(f"Drafting new tool failed: {e}")
+                return None, None, None
+
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @TRACER.traced()
     def implement_thought(self, thought: str, summary: str) -> ToolCall:
         try:
             docstring_dict = LLMMethods.openai_extract_arguments(thought, docstring_schema, strict=True, model="gpt-4-0613")
@@ -347,20 +606,36 @@ class PerpetualAgent:
             raise ToolSelectionException("Error while extracting docstring.") from e
 
         description = self.toolbox.description_from_docstring_dict(docstring_dict)
-        tool_name, fitness = LLMMethods.select_tool_name(self.toolbox, description)
+        candidates = LLMMethods.select_tool_names(
+            self.toolbox, description, top_k=self.speculative_candidates if self.speculative else 1, min_fitness=self.fitness_threshold
+        )
+        if len(candidates) < 1:
+            # no tool is similar at all
+            tool_call = self.processor.apply_new_tool(summary, docstring_dict)
+            return tool_call
+
+        tool_name, fitness = candidates[0]
 
         msg = f"Found tool `{tool_name}` with a fitness of {fitness:.2f}"
         self.main_logger.info(msg)
         print(f"{colorama.Fore.MAGENTA}{msg}{colorama.Style.RESET_ALL}")
 
-        if fitness < .9:
-            tool_call = self.processor.apply_new_tool(summary, docstring_dict)
-            return tool_call
+        if self.speculative:
+            tool_name, arguments, draft = self._speculate(summary, docstring_dict, candidates)
+            if tool_name is None:
+                tool_call = self.processor.apply_new_tool(summary, docstring_dict, draft=draft)
+                return tool_call
+
+        else:
+            if fitness < self.fitness_threshold:
+                tool_call = self.processor.apply_new_tool(summary, docstring_dict)
+                return tool_call
+
+            tool_schema = self.toolbox.get_schema_from_name(tool_name)
+            arguments = LLMMethods.openai_extract_arguments(summary, tool_schema)
 
         print(f"{colorama.Back.YELLOW}Tool:{colorama.Style.RESET_ALL}")
         tool = self.toolbox.get_tool_from_name(tool_name)
-        tool_schema = self.toolbox.get_schema_from_name(tool_name)
-        arguments = LLMMethods.openai_extract_arguments(summary, tool_schema)
         try:
             tool_call = self.processor.apply_tool(tool, arguments)
 
@@ -375,51 +650,67 @@ class PerpetualAgent:
     def process(self) -> str:
         # "gpt-3.5-turbo-16k-0613", "gpt-4-32k-0613", "gpt-4-0613", "gpt-3.5-turbo-0613"
 
-        step = 0
         while not self.progress["is_done"]:
-            data_prompt = {"request": self.request, "last_step": self.last_fact}
-            prompt = (
-                f"```json\n"
-                f"{json.dumps(data_prompt, indent=4, sort_keys=True)}\n"
-                f"```"
-            )
-            progress = LLMMethods.openai_extract_arguments(prompt, proceed, history=self.history, model="gpt-4-0613")
-            if progress["is_done"]:
-                break
-
-            if 0 < len(self.last_action):
-                self.toolbox.update_tool_stats(self.last_action, progress["was_step_effective"])
-
-            thought = progress["thought"]
-            print(
-                f"{colorama.Back.BLUE}Thought:{colorama.Style.RESET_ALL}\n"
-                f"{colorama.Fore.BLUE}{thought}{colorama.Style.RESET_ALL}"
-            )
-
-            if step < 1:
-                summary = (
-                    f"{self.request}\n\n"
-                    f"{thought}"
+            with TRACER.span("step", step=self.step):
+                if "progress" not in self._pending:
+                    data_prompt = {"last_step": self.last_fact}
+                    prompt = (
+                        f"```json\n"
+                        f"{json.dumps(data_prompt, indent=4, sort_keys=True)}\n"
+                        f"```"
+                    )
+                    messages = self.history.messages()
+                    no_messages = len(messages)
+                    progress = LLMMethods.openai_extract_arguments(prompt, proceed, history=messages, model="gpt-4-0613")
+                    last_exchange = messages[no_messages:]
+                    self.history.extend(last_exchange)
+
+                    if not progress["is_done"] and 0 < len(self.last_action):
+                        self.toolbox.update_tool_stats(self.last_action, progress["was_step_effective"])
+
+                    self.progress = progress
+                    self._pending = {"progress": progress, "exchange": last_exchange}
+                    self._journal("progress", progress=progress, exchange=last_exchange)
+
+                if self.progress["is_done"]:
+                    break
+
+                thought = self.progress["thought"]
+                print(
+                    f"{colorama.Back.BLUE}Thought:{colorama.Style.RESET_ALL}\n"
+                    f"{colorama.Fore.BLUE}{thought}{colorama.Style.RESET_ALL}"
                 )
-            else:
-                summary = self._summarize_facts(thought)
-
-            tool_call = self.implement_thought(thought, summary)
-            print(
-                f"{colorama.Back.CYAN}Observation:{colorama.Style.RESET_ALL}\n"
-                f"{colorama.Fore.CYAN}{tool_call.output}{colorama.Style.RESET_ALL}"
-            )
-            if tool_call.tool_name in {"reject", "create_tool", "tool_execution"}:
-                self.last_fact = LLMMethods.naturalize(thought, tool_call.output, model="gpt-3.5-turbo")
-            else:
-                self.last_fact = self._naturalize(thought, tool_call)
-                # if len(tool_output) >= 5_000:
-                #   naturalize and shorten tool output for summary
-                #   segment and naturalize for long term memory
-
-            self.last_action = tool_call.tool_name
-            self._save_state(thought, tool_call, self.history[:-2])
-
-            step += 1
 
+                if "tool_call" not in self._pending:
+                    if self.step < 1:
+                        summary = (
+                            f"{self.request}\n\n"
+                            f"{thought}"
+                        )
+                    else:
+                        summary = self._summarize_facts(thought)
+
+                    tool_call = self.implement_thought(thought, summary)
+                    self._pending["tool_call"] = tool_call
+                    self._journal("tool_call", tool_call=dataclasses.asdict(tool_call))
+
+                tool_call = self._pending["tool_call"]
+                print(
+                    f"{colorama.Back.CYAN}Observation:{colorama.Style.RESET_ALL}\n"
+                    f"{colorama.Fore.CYAN}{tool_call.output}{colorama.Style.RESET_ALL}"
+                )
+                if tool_call.tool_name in {"reject", "create_tool", "tool_execution"}:
+                    self.last_fact = LLMMethods.naturalize(thought, tool_call.output, model="gpt-3.5-turbo")
+                else:
+                    self.last_fact = self._naturalize(thought, tool_call)
+                    # if len(tool_output) >= 5_000:
+                    #   naturalize and shorten tool output for summary
+                    #   segment and naturalize for long term memory
+
+                self.last_action = tool_call.tool_name
+                self._save_state(thought, tool_call, self._pending["exchange"])
+                self._finish_step()
+
+        self.fact_ingest.flush()
+        TRACER.flush()
         return self.progress["report"]
@@ -116,3 +116,32 @@ CODER = (
     "import calculate`).\n"
     "Do not simulate behavior or use placeholder logic or variables that must be filled in manually (e.g. API keys)!\n"
     "Respond with a single Python code block containing as statements nothing else but the required imports and one single definition of a working function.")
+
+AGENT_PREAMBLE = (
+    "You work step by step towards fulfilling the request below. Every user message reports the outcome of the last step, "
+    "answer each with the `proceed` function.\n"
+    "\n"
+    "## Request\n"
+    "{request}")
+
+HISTORY_SUMMARIZER = (
+    "<!-- BEGIN SUMMARY -->\n"
+    "{summary}\n"
+    "<!-- END SUMMARY -->\n"
+    "\n"
+    "<!-- BEGIN MESSAGES -->\n"
+    "{messages}\n"
+    "<!-- END MESSAGES -->\n"
+    "\n"
+    "## Instructions\n"
+    "Extend the summary of the conversation above with the messages that follow it. Keep all steps taken, their results, and the "
+    "latest progress report. Preserve literal information such as names, numbers, and file paths. Respond only with the extended summary.")
+
+FACT_MERGER = (
+    "<!-- BEGIN FACTS -->\n"
+    "{facts}\n"
+    "<!-- END FACTS -->\n"
+    "\n"
+    "## Instructions\n"
+    "The facts above say nearly the same thing. Merge them into a single fact that keeps everything any of them states. Preserve "
+    "literal information such as names, numbers, and file paths. Respond only with the merged fact.")
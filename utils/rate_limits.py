@@ -0,0 +1,227 @@
+# coding=utf-8
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+
+from utils.tracing import TRACER
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    requests_per_minute: int
+    tokens_per_minute: int
+
+
+class _LocalBuckets:
+    # token buckets of this process. threads that wait for a take are woken up whenever tokens are given back.
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._given = threading.Condition(self._lock)
+        self._buckets = dict[str, list[float]]()
+
+    def _refill(self, key: str, capacity: float, per_second: float, now: float) -> list[float]:
+        bucket = self._buckets.setdefault(key, [capacity, now, 0.])
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * per_second)
+        bucket[1] = now
+        return bucket
+
+    def _take(self, keys: list[str], capacities: list[float], rates: list[float], amounts: list[float]) -> float:
+        # with the lock held
+        now = time.monotonic()
+        buckets = [self._refill(each_key, each_capacity, each_rate, now) for each_key, each_capacity, each_rate in zip(keys, capacities, rates)]
+        wait = max(
+            max(each_bucket[2] - now, (min(each_amount, each_capacity) - each_bucket[0]) / each_rate)
+            for each_bucket, each_capacity, each_rate, each_amount in zip(buckets, capacities, rates, amounts)
+        )
+        if 0. < wait:
+            return wait
+        for each_bucket, each_amount in zip(buckets, amounts):
+            each_bucket[0] -= each_amount
+        return 0.
+
+    def take(self, keys: list[str], capacities: list[float], rates: list[float], amounts: list[float]) -> float:
+        # takes the amounts from all buckets or from none. returns zero if they were taken, otherwise the seconds until
+        # they could be. an amount beyond a bucket's capacity is taken from the full bucket.
+        with self._lock:
+            return self._take(keys, capacities, rates, amounts)
+
+    def take_waiting(self, keys: list[str], capacities: list[float], rates: list[float], amounts: list[float]) -> None:
+        # blocks until the amounts are taken, tokens that are given back meanwhile shorten the wait
+        with self._given:
+            wait = self._take(keys, capacities, rates, amounts)
+            while 0. < wait:
+                self._given.wait(wait)
+                wait = self._take(keys, capacities, rates, amounts)
+
+    def give(self, key: str, capacity: float, per_second: float, amount: float) -> None:
+        # gives back, or takes if negative, without waiting. the level may drop below zero.
+        with self._lock:
+            bucket = self._refill(key, capacity, per_second, time.monotonic())
+            bucket[0] = min(capacity, bucket[0] + amount)
+            if 0. < amount:
+                self._given.notify_all()
+
+    def block(self, key: str, seconds: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(key, [float("inf"), now, 0.])
+            bucket[2] = max(bucket[2], now + seconds)
+
+
+class _RedisBuckets:
+    # token buckets in redis, shared by all processes on it. the scripts run atomically on the server's clock.
+    # waiting takes are retried at least every `poll_interval` seconds, to notice tokens other processes gave back.
+
+    _REFILL = """
+        local now = redis.call("TIME")
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local function refill(key, capacity, per_second)
+            local bucket = redis.call("HMGET", key, "level", "time", "blocked")
+            local level = math.min(capacity, (tonumber(bucket[1]) or capacity) + (now - (tonumber(bucket[2]) or now)) * per_second)
+            return level, tonumber(bucket[3]) or 0
+        end
+        local function store(key, level)
+            redis.call("HSET", key, "level", tostring(level), "time", tostring(now))
+            redis.call("EXPIRE", key, 3600)
+        end
+    """
+
+    _TAKE = _REFILL + """
+        local levels, wait = {}, 0
+        for i, key in ipairs(KEYS) do
+            local capacity, per_second, amount = tonumber(ARGV[3 * i - 2]), tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i])
+            local level, blocked = refill(key, capacity, per_second)
+            levels[i] = level
+            wait = math.max(wait, blocked - now, (math.min(amount, capacity) - level) / per_second)
+        end
+        for i, key in ipairs(KEYS) do
+            if wait <= 0 then
+                store(key, levels[i] - tonumber(ARGV[3 * i]))
+            else
+                store(key, levels[i])
+            end
+        end
+        return tostring(math.max(0, wait))
+    """
+
+    _GIVE = _REFILL + """
+        local capacity = tonumber(ARGV[1])
+        local level = refill(KEYS[1], capacity, tonumber(ARGV[2]))
+        store(KEYS[1], math.min(capacity, level + tonumber(ARGV[3])))
+    """
+
+    _BLOCK = """
+        local now = redis.call("TIME")
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local blocked = tonumber(redis.call("HGET", KEYS[1], "blocked")) or 0
+        redis.call("HSET", KEYS[1], "blocked", tostring(math.max(blocked, now + tonumber(ARGV[1]))))
+        redis.call("EXPIRE", KEYS[1], 3600)
+    """
+
+    def __init__(self, client: any, poll_interval: float = 1.) -> None:
+        self.poll_interval = poll_interval
+        self._take = client.register_script(_RedisBuckets._TAKE)
+        self._give = client.register_script(_RedisBuckets._GIVE)
+        self._block = client.register_script(_RedisBuckets._BLOCK)
+
+    def take(self, keys: list[str], capacities: list[float], rates: list[float], amounts: list[float]) -> float:
+        args = [each_value for each_triple in zip(capacities, rates, amounts) for each_value in each_triple]
+        return float(self._take(keys=keys, args=args))
+
+    def take_waiting(self, keys: list[str], capacities: list[float], rates: list[float], amounts: list[float]) -> None:
+        wait = self.take(keys, capacities, rates, amounts)
+        while 0. < wait:
+            time.sleep(min(wait, self.poll_interval))
+            wait = self.take(keys, capacities, rates, amounts)
+
+    def give(self, key: str, capacity: float, per_second: float, amount: float) -> None:
+        self._give(keys=[key], args=[capacity, per_second, amount])
+
+    def block(self, key: str, seconds: float) -> None:
+        self._block(keys=[key], args=[seconds])
+
+
+class RateLimiter:
+    # admits requests to rate limited apis, per model, before they are sent. every request takes one from the model's
+    # request bucket and its estimated tokens from the token bucket, both at once once both hold enough. the buckets
+    # refill at the per minute limits, with up to `burst` seconds of them saved up, so requests go out at the limit
+    # and not beyond it. once the response tells the tokens actually used, `settle` gives back or takes the difference
+    # to the estimate. completions are estimated from the running average of the model's.
+    # models without limits are not held back. with a `redis` client (e.g. redislite), the buckets are shared by all
+    # processes that use it.
+
+    def __init__(self,
+                 limits: dict[str, RateLimit],
+                 burst: float = 6.,
+                 expected_completion_tokens: int = 256,
+                 redis: any = None, prefix: str = "rate_limits") -> None:
+
+        self.limits = limits
+        self.burst = burst
+        self.prefix = prefix
+        self.expected_completion_tokens = expected_completion_tokens
+
+        self._lock = threading.Lock()
+        self._completion_tokens = dict[str, float]()
+        self._buckets = _LocalBuckets() if redis is None else _RedisBuckets(redis)
+
+    def use_redis(self, redis: any) -> None:
+        # from now on, share the buckets through `redis`
+        self._buckets = _RedisBuckets(redis)
+
+    def limited_model(self, model: str) -> str | None:
+        # the model itself or the longest limited model name it starts with, e.g. "gpt-4" for "gpt-4-0613". versions of
+        # a model share its limit.
+        if model in self.limits:
+            return model
+        prefixes = [each_model for each_model in self.limits if model.startswith(each_model)]
+        return max(prefixes, key=len) if 0 < len(prefixes) else None
+
+    def expected_completion(self, model: str) -> int:
+        with self._lock:
+            return round(self._completion_tokens.get(model, self.expected_completion_tokens))
+
+    def _buckets_of(self, model: str) -> tuple[list[str], list[float], list[float]]:
+        # keys, capacities and refill rates of the request and the token bucket
+        limit = self.limits[model]
+        rates = [limit.requests_per_minute / 60., limit.tokens_per_minute / 60.]
+        keys = [f"{self.prefix}:{model}:requests", f"{self.prefix}:{model}:tokens"]
+        return keys, [self.burst * each_rate for each_rate in rates], rates
+
+    def admit(self, model: str, prompt_tokens: int, completion_tokens: int | None = None) -> int:
+        # blocks until the request may be sent. returns the tokens it was admitted with, for `settle`.
+        limited_model = self.limited_model(model)
+        if limited_model is None:
+            return 0
+
+        tokens = prompt_tokens + (self.expected_completion(model) if completion_tokens is None else completion_tokens)
+        keys, capacities, rates = self._buckets_of(limited_model)
+        if 0. < self._buckets.take(keys, capacities, rates, [1, tokens]):
+            with TRACER.span("rate_limit", model=model, tokens=tokens):
+                self._buckets.take_waiting(keys, capacities, rates, [1, tokens])
+        return tokens
+
+    def settle(self, model: str, admitted_tokens: int, used_tokens: int, completion_tokens: int | None = None) -> None:
+        # `used_tokens` replaces the estimate of an admitted request, `completion_tokens` updates the average
+        limited_model = self.limited_model(model)
+        if limited_model is None:
+            return
+
+        if completion_tokens is not None:
+            with self._lock:
+                average = self._completion_tokens.get(model, self.expected_completion_tokens)
+                self._completion_tokens[model] = .9 * average + .1 * completion_tokens
+        if used_tokens != admitted_tokens:
+            (_, key), (_, capacity), (_, per_second) = self._buckets_of(limited_model)
+            self._buckets.give(key, capacity, per_second, admitted_tokens - used_tokens)
+
+    def back_off(self, model: str, seconds: float) -> None:
+        # the api refused a request for its rate, nothing for the model is admitted for `seconds`
+        limited_model = self.limited_model(model)
+        if limited_model is None:
+            return
+        self._buckets.block(f"{self.prefix}:{limited_model}:requests", seconds)
+        self._buckets.block(f"{self.prefix}:{limited_model}:tokens", seconds)
@@ -0,0 +1,62 @@
+import threading
+import time
+
+import redislite
+
+from utils.rate_limits import RateLimit, RateLimiter
+
+
+def test_admits_at_the_limit_across_threads() -> None:
+    # 1,000 tokens per second with a tenth of a second saved up
+    limiter = RateLimiter({"model": RateLimit(requests_per_minute=6_000, tokens_per_minute=60_000)}, burst=.1)
+    assert limiter.limited_model("model-0613") == "model" and limiter.admit("other", 1_000) == 0
+
+    def requests() -> None:
+        for _ in range(10):
+            limiter.admit("model-0613", 10, completion_tokens=10)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=requests) for _ in range(4)]
+    for each_thread in threads:
+        each_thread.start()
+    for each_thread in threads:
+        each_thread.join()
+    # 800 tokens, 100 of them saved up
+    assert .6 < time.monotonic() - start < .9
+
+
+def test_settles_backs_off_and_shares_through_redis(tmp_path: any) -> None:
+    limits = {"model": RateLimit(requests_per_minute=60_000, tokens_per_minute=600)}
+    client = redislite.StrictRedis(str(tmp_path / "redis.db"), decode_responses=True)
+    first = RateLimiter(limits, burst=1., redis=client)
+    second = RateLimiter(limits, burst=1., redis=client)
+
+    # 10 tokens per second and 10 saved up. the 5 estimated tokens that were not used are given back.
+    admitted = first.admit("model", 5, completion_tokens=5)
+    first.settle("model", admitted, 5, completion_tokens=0)
+    assert first.expected_completion("model") == 230
+
+    # the other limiter waits for the 3 tokens the shared bucket lacks
+    start = time.monotonic()
+    second.admit("model", 8, completion_tokens=0)
+    assert .2 < time.monotonic() - start < .5
+
+    start = time.monotonic()
+    second.back_off("model", .5)
+    first.admit("model", 0, completion_tokens=0)
+    assert .4 < time.monotonic() - start < .7
+
+
+def test_given_back_tokens_wake_up_waiting_requests() -> None:
+    # 10 tokens per second and 10 saved up
+    limiter = RateLimiter({"model": RateLimit(requests_per_minute=60_000, tokens_per_minute=600)}, burst=1.)
+    admitted = limiter.admit("model", 10, completion_tokens=0)
+
+    waiting = threading.Thread(target=limiter.admit, args=("model", 10), kwargs={"completion_tokens": 0})
+    start = time.monotonic()
+    waiting.start()
+    time.sleep(.1)
+    # the first request failed, it used none of its tokens
+    limiter.settle("model", admitted, 0)
+    waiting.join()
+    assert time.monotonic() - start < .5
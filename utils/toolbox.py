@@ -8,7 +8,11 @@ import importlib.util
 
 from chromadb.api.models.Collection import Collection
 
+from utils.action_values import ActionRanker
+from utils.ann_index import AnnIndex
+from utils.embedding_backends import EmbeddingBackend, get_embedding_backend
 from utils.misc import LOGGER
+from utils.tracing import TRACER
 
 
 class SchemaExtractionException(Exception):
@@ -16,14 +20,21 @@ class SchemaExtractionException(Exception):
 
 
 class ToolBox:
-    def __init__(self, tool_folder: str, tool_collection_global: Collection, tool_collection_local: Collection, tool_limit: int = -1):
+    def __init__(self,
+                 tool_folder: str, tool_collection_global: Collection, tool_collection_local: Collection, tool_limit: int = -1,
+                 embedding_backend: str | EmbeddingBackend = "onnx", ranker: ActionRanker | None = None):
         # todo: add "success" & "failure" to tool metadata
         # add project subfolder to tools
 
         self.tool_folder = tool_folder
         self.tool_limit = tool_limit
+        # tool descriptions and the queries for them are embedded with the same backend
+        self.embed = get_embedding_backend(embedding_backend)
+        self.tool_index = AnnIndex(space="cosine", directory=os.path.join(tool_folder, ".index"))
         self.tool_collection_global = tool_collection_global
         self.tool_collection_local = tool_collection_local
+        # similar tools are ranked by their success so far as well
+        self.ranker = ranker or ActionRanker()
         self._initialize_local_tool_database()
 
     def _initialize_local_tool_database(self) -> None:
@@ -44,9 +55,18 @@ class ToolBox:
             metadatas.append({"success": 0, "failure": 0, "last_call": -1})
             tool_ids.append(each_name)
 
+        # the index may be missing tools added or removed by hand
+        descriptions = {each_name: self.description_from_docstring_dict(self.get_docstring_dict(each_name)) for each_name in tool_names}
+        self.tool_index.sync(tool_names, lambda missing: self.embed([descriptions[each_name] for each_name in missing]))
+        self.tool_index.save()
+
         LOGGER.info(f"Adding {len(tool_ids)} tools to database.")
+        if len(tool_ids) < 1:
+            return
+
         self.tool_collection_local.add(
             tool_ids,
+            embeddings=self.embed(documents),
             documents=documents,
             metadatas=metadatas
         )
@@ -94,11 +114,46 @@ class ToolBox:
         if not is_temp:
             description = self.description_from_docstring_dict(docstring_dict)
             tool_name = docstring_dict["name"]
+            embeddings = self.embed([description])
             self.tool_collection_local.add(
                 [tool_name],
+                embeddings=embeddings,
                 documents=[description],
                 metadatas=[{"success": 0, "failure": 0, "last_call": -1}],
             )
+            self.tool_index.add([tool_name], embeddings)
+            self.tool_index.save()
+
+    def similar_tools(self, description: str, top_k: int = 1) -> list[tuple[str, float]]:
+        embedding = self.embed([description])
+        with TRACER.span("vector.query", store="tools", n=top_k):
+            (names,), (distances,) = self.tool_index.search(embedding, top_k)
+        return [(each_name, 1. - each_distance) for each_name, each_distance in zip(names, distances)]
+
+    def _tool_stats(self, tool_names: list[str]) -> tuple[list[int], list[int]]:
+        # successes and failures, local entries win over global ones
+        metadatas = dict()
+        for each_collection in (self.tool_collection_global, self.tool_collection_local):
+            results = each_collection.get(ids=tool_names, include=["metadatas"])
+            metadatas.update(zip(results["ids"], results["metadatas"]))
+        successes = [(metadatas.get(each_name) or dict()).get("success", 0) for each_name in tool_names]
+        failures = [(metadatas.get(each_name) or dict()).get("failure", 0) for each_name in tool_names]
+        return successes, failures
+
+    def rank_tools(self, description: str, top_k: int = 1, min_fitness: float | None = None, no_candidates: int = 16) -> list[tuple[str, float]]:
+        # the most promising of the tools similar to `description`, best first, with their similarity as fitness.
+        # tools of at least `min_fitness` come before all others.
+        candidates = self.similar_tools(description, top_k=max(top_k, no_candidates))
+        if len(candidates) < 1:
+            return list()
+
+        tool_names = [each_name for each_name, _ in candidates]
+        successes, failures = self._tool_stats(tool_names)
+        ranked = self.ranker.rank(tool_names, [each_fitness for _, each_fitness in candidates], successes, failures)
+        fitness = dict(candidates)
+        if min_fitness is not None:
+            ranked.sort(key=lambda each_name: fitness[each_name] < min_fitness)
+        return [(each_name, fitness[each_name]) for each_name in ranked[:top_k]]
 
     def description_from_docstring_dict(self, docstring_dict: dict[str, any]) -> str:
         return docstring_dict["summary"] + "\n" + docstring_dict["description"]
@@ -147,7 +202,7 @@ class ToolBox:
 
         args_docstring = docstring_dict["args"]
 
-        tool = self.get_temp_tool_from_code(code, docstring_dict)
+        tool = self.compile_tool(code)
         arguments = tuple(each_argument for each_argument in tool.__annotations__.items() if each_argument[0] != 'return')
         properties = dict()
 
@@ -243,6 +298,13 @@ class ToolBox:
         with open(os.path.join(self.tool_folder, f"{name}.py"), mode="r") as file:
             return file.read()
 
+    def compile_tool(self, code: str) -> types.FunctionType:
+        # in memory instead of through `_tmp.py`, so several threads can load candidate tools at once
+        name = self.get_name_from_code(code)
+        module = types.ModuleType(name)
+        exec(compile(code, f"<{name}>", "exec"), module.__dict__)
+        return getattr(module, name)
+
     def get_temp_tool_from_code(self, code: str, docstring_dict: dict[str, any]) -> types.FunctionType:
         self.save_tool_code(code, docstring_dict, True)
         name = self.get_name_from_code(code)
@@ -259,9 +321,7 @@ class ToolBox:
             return
 
         selected_collection = self.tool_collection_local if was_local else self.tool_collection_global
-        results = selected_collection.get(
-            where={"id": tool_name},
-        )
+        results = selected_collection.get(tool_name)
         if len(results["ids"]) < 1:
             selected_collection = self.tool_collection_global
             results = selected_collection.get(tool_name)
@@ -277,5 +337,5 @@ class ToolBox:
         else:
             tool_metadata["failure"] = tool_metadata.get("failure", 0) + 1
 
-        document = results["documents"][0]
-        selected_collection.update(tool_id, metadatas=[tool_metadata], documents=[document])
+        # without the unchanged document, chroma would embed it again
+        selected_collection.update(tool_id, metadatas=[tool_metadata])
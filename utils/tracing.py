@@ -0,0 +1,409 @@
+# coding=utf-8
+from __future__ import annotations
+
+import atexit
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import urllib.request
+from typing import Callable, Generator, Iterable
+
+from utils.misc import LOGGER
+
+
+class Span:
+    # one timed operation. `start` and `end` are unix times in nanoseconds, `attributes` hold json values.
+    # spans of one root share its `trace_id`.
+
+    def __init__(self, tracer: Tracer | None, name: str, parent: Span | None, attributes: dict[str, any]) -> None:
+        self._tracer = tracer
+        self.name = name
+        self.trace_id = f"{random.getrandbits(128):032x}" if parent is None else parent.trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = None if parent is None else parent.span_id
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.attributes = attributes
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+    @property
+    def is_recording(self) -> bool:
+        return True
+
+    @property
+    def duration(self) -> float:
+        # seconds, up to now while the span is open
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def set(self, **attributes: any) -> None:
+        self.attributes.update(attributes)
+
+    def finish(self, error: BaseException | None = None) -> None:
+        if self.end is not None:
+            return
+        self.end = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        if self._tracer is not None:
+            self._tracer._export(self)
+
+    def to_dict(self) -> dict[str, any]:
+        return {
+            "name": self.name, "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "start": self.start, "end": self.end, "thread_id": self.thread_id, "thread_name": self.thread_name,
+            "attributes": self.attributes, "error": self.error,
+        }
+
+    @staticmethod
+    def from_dict(span_dict: dict[str, any]) -> Span:
+        span = Span.__new__(Span)
+        span._tracer = None
+        for each_key, each_value in span_dict.items():
+            setattr(span, each_key, each_value)
+        return span
+
+
+class _NoSpan:
+    # what a tracer without exporters hands out, so instrumented code costs next to nothing
+    is_recording = False
+    duration = 0.
+    attributes = dict()
+
+    def set(self, **attributes: any) -> None:
+        pass
+
+    def finish(self, error: BaseException | None = None) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    # spans nest along the call stack of a thread. work handed to other threads is attached to the span that handed it
+    # over with `propagate`. spans only record while the tracer has exporters, finished spans go to all of them.
+
+    def __init__(self) -> None:
+        self.exporters = list()
+        self._current = contextvars.ContextVar[Span | None]("current_span", default=None)
+
+    @property
+    def is_enabled(self) -> bool:
+        return 0 < len(self.exporters)
+
+    def add_exporter(self, exporter: any) -> None:
+        self.exporters.append(exporter)
+
+    def current(self) -> Span | None:
+        return self._current.get()
+
+    def start(self, name: str, **attributes: any) -> Span | _NoSpan:
+        # a child of the current span that does not become current itself, e.g. for generators, which run in the
+        # context of whoever iterates them. `finish` it when done.
+        if not self.is_enabled:
+            return NO_SPAN
+        return Span(self, name, self._current.get(), attributes)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: any) -> Generator[Span | _NoSpan, None, None]:
+        span = self.start(name, **attributes)
+        if not span.is_recording:
+            yield span
+            return
+
+        token = self._current.set(span)
+        try:
+            yield span
+
+        except Exception as e:
+            span.finish(error=e)
+            raise
+
+        finally:
+            self._current.reset(token)
+            span.finish()
+
+    def traced(self, name: str | None = None) -> Callable[[Callable], Callable]:
+        # decorator, a span per call named `name` or after the function
+        def decorator(function: Callable) -> Callable:
+            span_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args: any, **kwargs: any) -> any:
+                with self.span(span_name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def propagate(self, function: Callable) -> Callable:
+        # `function` runs as a child of the current span, wherever it is called. for thread pools and worker threads.
+        parent = self._current.get()
+        if parent is None:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args: any, **kwargs: any) -> any:
+            token = self._current.set(parent)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._current.reset(token)
+
+        return wrapper
+
+    def _export(self, span: Span) -> None:
+        for each_exporter in self.exporters:
+            try:
+                each_exporter.export(span)
+
+            except Exception as e:
+                LOGGER.error(f"Exporting span {span.name} failed: {e}")
+
+    def flush(self) -> None:
+        for each_exporter in self.exporters:
+            each_exporter.flush()
+
+    def close(self) -> None:
+        for each_exporter in self.exporters:
+            each_exporter.close()
+        self.exporters = list()
+
+
+class _LineExporter:
+    # appends one line per span to a file, from all threads
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if 0 < len(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, mode="a", encoding="utf-8")
+
+    def _line(self, span: Span) -> str:
+        raise NotImplementedError()
+
+    def export(self, span: Span) -> None:
+        line = self._line(span)
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class JsonlExporter(_LineExporter):
+    # one `Span.to_dict` per line, in the order the spans finished. `read_spans` reads them back.
+
+    def _line(self, span: Span) -> str:
+        return json.dumps(span.to_dict(), default=str)
+
+
+class ChromeTraceExporter(_LineExporter):
+    # chrome's trace event format, for chrome://tracing or https://ui.perfetto.dev. one complete event per span, one
+    # track per thread. the format allows leaving the event array open, so events are only ever appended and an
+    # interrupted run still loads.
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        with self._lock:
+            if self._file.tell() < 1:
+                self._file.write("[\n")
+
+    def _line(self, span: Span) -> str:
+        event = {
+            "name": span.name, "cat": span.name.split(".")[0], "ph": "X",
+            "ts": span.start / 1_000, "dur": (span.end - span.start) / 1_000,
+            "pid": os.getpid(), "tid": span.thread_id,
+            "args": span.attributes | ({} if span.error is None else {"error": span.error}),
+        }
+        return json.dumps(event, default=str) + ","
+
+
+class OtlpExporter:
+    # sends spans to an opentelemetry collector (or anything that accepts otlp/http json, like jaeger) in the background,
+    # in batches of up to `batch_size` at least every `interval` seconds. spans that cannot be sent are dropped.
+
+    def __init__(self,
+                 endpoint: str = "http://localhost:4318/v1/traces", service_name: str = "perpetual-agent",
+                 batch_size: int = 512, interval: float = 2., timeout: float = 5.) -> None:
+
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+
+        self._queue = queue.Queue[Span | threading.Event]()
+        self._worker = threading.Thread(target=self._run, name="otlp exporter", daemon=True)
+        self._worker.start()
+
+    @staticmethod
+    def _value(value: any) -> dict[str, any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        if isinstance(value, str):
+            return {"stringValue": value}
+        return {"stringValue": json.dumps(value, default=str)}
+
+    def _otlp_span(self, span: Span) -> dict[str, any]:
+        attributes = span.attributes | {"thread.id": span.thread_id, "thread.name": span.thread_name}
+        otlp_span = {
+            "traceId": span.trace_id, "spanId": span.span_id, "name": span.name, "kind": 1,
+            "startTimeUnixNano": str(span.start), "endTimeUnixNano": str(span.end),
+            "attributes": [{"key": each_key, "value": OtlpExporter._value(each_value)} for each_key, each_value in attributes.items()],
+            "status": {"code": 1} if span.error is None else {"code": 2, "message": span.error},
+        }
+        if span.parent_id is not None:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def _send(self, spans: list[Span]) -> None:
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [self._otlp_span(each_span) for each_span in spans]}],
+        }]}
+        request = urllib.request.Request(
+            self.endpoint, data=json.dumps(payload, default=str).encode("utf-8"), headers={"Content-Type": "application/json"}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+
+        except Exception as e:
+            LOGGER.warning(f"Sending {len(spans)} spans to {self.endpoint} failed: {e}")
+
+    def _run(self) -> None:
+        batch = list()
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0., deadline - time.monotonic()))
+
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, Span):
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+
+            # a full batch, the interval is over or `flush` waits for everything before its event
+            if 0 < len(batch):
+                self._send(batch)
+                batch = list()
+            deadline = time.monotonic() + self.interval
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def export(self, span: Span) -> None:
+        self._queue.put(span)
+
+    def flush(self) -> None:
+        sent = threading.Event()
+        self._queue.put(sent)
+        sent.wait(self.timeout + 1.)
+
+    def close(self) -> None:
+        self.flush()
+
+
+TRACER = Tracer()
+atexit.register(TRACER.close)
+
+
+def read_spans(path: str) -> list[Span]:
+    # the spans of a `JsonlExporter` file, a torn last line is skipped
+    spans = list()
+    with open(path, mode="r", encoding="utf-8") as file:
+        for each_line in file:
+            try:
+                spans.append(Span.from_dict(json.loads(each_line)))
+
+            except json.JSONDecodeError:
+                continue
+    return spans
+
+
+def critical_path(spans: Iterable[Span], root: Span) -> list[Span]:
+    # the spans that determined when `root` ended, in the order they ran: the child that ended last, before it the
+    # child that ended last before that one started, and so on, each expanded the same way. a parent's time outside
+    # of its children on the path is its own work.
+    children = collections.defaultdict(list)
+    for each_span in spans:
+        if each_span.parent_id is not None and each_span.end is not None:
+            children[each_span.parent_id].append(each_span)
+
+    def expand(span: Span) -> list[Span]:
+        path = list()
+        limit = float("inf")
+        candidates = children[span.span_id]
+        while 0 < len(candidates):
+            last = max(candidates, key=lambda each_child: each_child.end)
+            path.append(last)
+            limit = last.start
+            candidates = [each_child for each_child in candidates if each_child.end <= limit]
+
+        expanded = [span]
+        for each_child in reversed(path):
+            expanded.extend(expand(each_child))
+        return expanded
+
+    return expand(root)
+
+
+def main() -> None:
+    # python -m utils.tracing <trace.jsonl> [<root span name>]: the critical path of every root span (or every span
+    # of that name), with each span's duration and own share of the path
+    path = sys.argv[1]
+    root_name = sys.argv[2] if 2 < len(sys.argv) else None
+    spans = read_spans(path)
+    by_id = {each_span.span_id: each_span for each_span in spans}
+    if root_name is None:
+        roots = [each_span for each_span in spans if each_span.parent_id not in by_id]
+    else:
+        roots = [each_span for each_span in spans if each_span.name == root_name]
+    for each_root in sorted(roots, key=lambda each_span: each_span.start):
+        on_path = critical_path(spans, each_root)
+        path_ids = {each_span.span_id for each_span in on_path}
+        print(f"{each_root.name} {each_root.attributes} {each_root.duration:.3f}s")
+        for each_span in on_path[1:]:
+            depth = 0
+            parent_id = each_span.parent_id
+            while parent_id != each_root.span_id and parent_id in by_id:
+                depth += 1
+                parent_id = by_id[parent_id].parent_id
+            path_children = sum(
+                (each_child.end - each_child.start) / 1e9
+                for each_child in on_path if each_child.parent_id == each_span.span_id and each_child.span_id in path_ids
+            )
+            print(f"{'  ' * (depth + 1)}{each_span.name} {each_span.duration:.3f}s (own {each_span.duration - path_children:.3f}s)")
+        print()
+
+
+if __name__ == "__main__":
+    main()
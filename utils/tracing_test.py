@@ -0,0 +1,63 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.tracing import Tracer, JsonlExporter, ChromeTraceExporter, read_spans, critical_path
+
+
+def test_spans_nest_across_threads_and_export(tmp_path: any) -> None:
+    tracer = Tracer()
+    with tracer.span("disabled") as span:
+        assert not span.is_recording
+
+    tracer.add_exporter(JsonlExporter(str(tmp_path / "trace.jsonl")))
+    tracer.add_exporter(ChromeTraceExporter(str(tmp_path / "trace.json")))
+
+    @tracer.traced("work")
+    def work(i: int) -> int:
+        with tracer.span("inner", i=i):
+            return threading.get_ident()
+
+    with tracer.span("step", step=0) as step:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(tracer.propagate(work), range(2)))
+        try:
+            with tracer.span("failing"):
+                raise ValueError("boom")
+        except ValueError:
+            pass
+        step.set(done=True)
+    tracer.close()
+
+    spans = {each_span.name + str(each_span.attributes.get("i", "")): each_span for each_span in read_spans(str(tmp_path / "trace.jsonl"))}
+    assert set(spans) == {"step", "work", "inner0", "inner1", "failing"}
+    assert spans["step"].parent_id is None and spans["step"].attributes == {"step": 0, "done": True}
+    assert spans["inner0"].parent_id != spans["inner1"].parent_id
+    assert {spans["inner0"].trace_id, spans["failing"].trace_id} == {spans["step"].trace_id}
+    assert spans["failing"].error == "ValueError: boom"
+    assert tracer.current() is None
+
+    # chrome's format allows the open array, closed here to parse it
+    with open(tmp_path / "trace.json", encoding="utf-8") as file:
+        events = json.loads(file.read().rstrip().rstrip(",") + "]")
+    assert len(events) == 6 and all(each_event["ph"] == "X" for each_event in events)
+
+
+def test_critical_path_follows_the_last_child() -> None:
+    tracer = Tracer()
+    spans = list()
+    tracer.add_exporter(type("Collect", (), {"export": lambda self, span: spans.append(span)})())
+
+    with tracer.span("step") as step:
+        with tracer.span("a"):
+            time.sleep(.01)
+        # b runs alongside c and ends first, c is on the path
+        b = tracer.start("b")
+        with tracer.span("c"):
+            time.sleep(.02)
+            b.finish()
+            with tracer.span("d"):
+                time.sleep(.01)
+
+    assert [each_span.name for each_span in critical_path(spans, step)] == ["step", "a", "c", "d"]
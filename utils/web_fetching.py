@@ -0,0 +1,117 @@
+# coding=utf-8
+from __future__ import annotations
+
+import atexit
+import queue
+import re
+import threading
+from contextlib import contextmanager
+from typing import Generator
+
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.support.wait import WebDriverWait
+
+from utils.http_cache import SESSION, USER_AGENT
+from utils.misc import LOGGER
+
+
+_SCRIPT_OR_STYLE = re.compile(r"<(script|style|noscript)\b.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+_TAG = re.compile(r"<[^>]+>")
+_NEEDS_JAVASCRIPT = re.compile(r"enable javascript|javascript is (disabled|required)", re.IGNORECASE)
+
+
+class BrowserPool:
+    def __init__(self, size: int = 2, page_timeout: float = 10.) -> None:
+        self.size = size
+        self.page_timeout = page_timeout
+        self._idle = queue.LifoQueue[webdriver.Chrome]()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _new_driver(self) -> webdriver.Chrome:
+        LOGGER.info("Starting headless browser session...")
+        options = webdriver.ChromeOptions()
+        options.add_argument("--headless=new")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--no-sandbox")
+        options.add_argument("--disable-dev-shm-usage")
+        options.add_argument(f"--user-agent={USER_AGENT}")
+        driver = webdriver.Chrome(options=options)
+        driver.set_page_load_timeout(self.page_timeout)
+        return driver
+
+    @contextmanager
+    def session(self) -> Generator[webdriver.Chrome, None, None]:
+        self._slots.acquire()
+        try:
+            driver = self._idle.get_nowait()
+        except queue.Empty:
+            driver = None
+
+        is_healthy = True
+        try:
+            if driver is None:
+                driver = self._new_driver()
+            yield driver
+
+        except WebDriverException:
+            is_healthy = False
+            raise
+
+        finally:
+            if driver is not None:
+                if is_healthy:
+                    self._idle.put(driver)
+                else:
+                    # crashed or hung sessions are replaced on next use
+                    driver.quit()
+            self._slots.release()
+
+    def get_html(self, url: str) -> str:
+        with self.session() as driver:
+            driver.get(url)
+            WebDriverWait(driver, self.page_timeout).until(
+                lambda each_driver: each_driver.execute_script("return document.readyState") == "complete"
+            )
+            return driver.page_source
+
+    def close(self) -> None:
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            driver.quit()
+
+
+_browser_pool = None
+_browser_pool_lock = threading.Lock()
+
+
+def get_browser_pool() -> BrowserPool:
+    global _browser_pool
+    with _browser_pool_lock:
+        if _browser_pool is None:
+            _browser_pool = BrowserPool()
+            atexit.register(_browser_pool.close)
+        return _browser_pool
+
+
+def needs_javascript(html: str, min_text_length: int = 200) -> bool:
+    if _NEEDS_JAVASCRIPT.search(html) is not None:
+        return True
+    text = _TAG.sub(" ", _SCRIPT_OR_STYLE.sub(" ", html))
+    return len("".join(text.split())) < min_text_length
+
+
+def fetch_html(url: str, javascript: bool | None = None, timeout: float = 10.) -> str:
+    # `javascript=None` tries a plain request first and only renders in the browser if the page looks like a script shell
+    if not javascript:
+        response = SESSION.get(url, timeout=timeout)
+        response.raise_for_status()
+        html = response.text
+        if javascript is False or not needs_javascript(html):
+            return html
+        LOGGER.info(f"Page requires JavaScript, rendering in browser: {url}")
+
+    return get_browser_pool().get_html(url)
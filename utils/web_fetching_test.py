@@ -0,0 +1,48 @@
+import http.server
+import threading
+from functools import partial
+from typing import Generator
+
+import pytest
+import requests
+
+from utils.web_fetching import fetch_html, needs_javascript
+
+
+ARTICLE = "<html><head><title>Moon</title></head><body><p>" + "The core of the moon is small and partly molten. " * 10 + "</p></body></html>"
+SCRIPT_SHELL = "<html><body><div id=\"app\"></div><noscript>Please enable JavaScript.</noscript><script>render()</script></body></html>"
+
+
+@pytest.fixture(scope="module")
+def local_server(tmp_path_factory: pytest.TempPathFactory) -> Generator[str, None, None]:
+    directory = tmp_path_factory.mktemp("site")
+    (directory / "article.html").write_text(ARTICLE, encoding="utf-8")
+    (directory / "shell.html").write_text(SCRIPT_SHELL, encoding="utf-8")
+
+    handler = partial(http.server.SimpleHTTPRequestHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_static_page_without_browser(local_server: str):
+    assert fetch_html(f"{local_server}/article.html") == ARTICLE
+
+
+def test_script_shell_is_detected():
+    assert needs_javascript(SCRIPT_SHELL)
+    assert not needs_javascript(ARTICLE)
+
+
+def test_forced_plain_request(local_server: str):
+    assert fetch_html(f"{local_server}/shell.html", javascript=False) == SCRIPT_SHELL
+
+
+def test_local_files_are_not_read(tmp_path):
+    # the url can come from a model, local files like api keys stay out of reach
+    page = tmp_path / "page.html"
+    page.write_text(ARTICLE, encoding="utf-8")
+    with pytest.raises(requests.exceptions.InvalidSchema):
+        fetch_html(page.as_uri(), javascript=False)